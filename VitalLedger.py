@@ -4,8 +4,31 @@ import os
 import sys
 import difflib
 import unicodedata
+import uuid
+import json
+import calendar
+import hashlib
+import contextlib
+import csv
+import html
+from collections import OrderedDict
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from array import array
 from datetime import timedelta
 
+try:
+	import numpy as np
+except ImportError:
+	np = None  # 類似検索などのベクトル計算機能でのみ使用
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	import pyarrow.feather as pa_feather
+except ImportError:
+	pa = pq = pa_feather = None  # 分析用のカラムナ出力でのみ使用
+
 # ==========================================
 # 0. 定数・ユーティリティ
 # ==========================================
@@ -116,23 +139,83 @@ table_map = {
 	'OUT_EAT': 'm_foods_processed' # 外食は加工食品DBを利用
 }
 
+# 食品マスタ共通の栄養素・味覚カラム
+NUTRIENT_FIELDS = ['energy_kcal', 'protein_g', 'fat_g', 'carb_g', 'salt_equiv_g']
+NUTRIENT_LABELS = {'energy_kcal': 'エネルギー(kcal)', 'protein_g': 'たんぱく質(g)', 'fat_g': '脂質(g)', 'carb_g': '炭水化物(g)', 'salt_equiv_g': '食塩相当量(g)'}
+TASTE_FIELDS = ['taste_sweet', 'taste_salty', 'taste_sour', 'taste_bitter', 'taste_umami',
+	'taste_pungent', 'taste_cooling', 'taste_astringency', 'taste_richness', 'taste_sharpness']
+
+# 変更をバージョン番号で追跡するテーブル（キャッシュ・集計テーブルの再構築判定に使用）
+VERSIONED_TABLES = [
+	'm_foods_universal', 'm_foods_measured', 'm_foods_processed',
+	't_transactions', 't_transaction_details', 't_meal_logs', 't_meal_details',
+	't_inventory', 't_payments', 't_wallet_balances', 'm_wallets', 'm_currencies', 'm_store_branches', 'm_brands',
+	'm_categories', 't_currency_rates',
+]
+
+def nutrient_per_qty_sql(field, type_col='f_type'):
+	"""
+	数量1あたりの栄養素を求めるSQL式 (Measuredは100gあたり、それ以外は1単位あたり)
+	食品マスタは fm / fu / fp の別名で LEFT JOIN されている前提
+	"""
+	return f"""
+		CASE
+			WHEN {type_col} = 'MEASURED' THEN COALESCE(fm.{field}, 0) / 100.0
+			WHEN {type_col} = 'UNIVERSAL' THEN COALESCE(fu.{field}, 0)
+			WHEN {type_col} IN ('PROCESSED', 'OUT_EAT') THEN COALESCE(fp.{field}, 0)
+			ELSE 0
+		END"""
+
+# Excelシリアル値 + この値 = ユリウス日 (SQLiteの日付関数で使用)
+SERIAL_TO_JULIAN = 2415018.5
+
+def serial_month_sql(col):
+	"""シリアル値のカラムを 'YYYYMM' 文字列にするSQL式"""
+	return f"strftime('%Y%m', {col} + {SERIAL_TO_JULIAN})"
+
+# 明細1行の税込金額 (create_transaction の合計計算と同じ: 割引後に税率を掛けて切り捨て)
+LINE_GROSS_SQL = "CAST(MAX(td.unit_price_ex_tax * td.quantity - COALESCE(td.discount_amount, 0), 0) * (1 + td.tax_rate) AS INTEGER)"
+# 取引IDのJSON配列 (パラメータ1つ) に含まれる明細 (集計テーブルの差分更新で使う)
+TRANSACTION_IDS_SQL = "td.transaction_id IN (SELECT value FROM json_each(?))"
+
+FOOD_TYPE_LABELS = {
+	'NONE': 'その他', 'ADJUSTMENT': '残高調整', 'UNIVERSAL': '食品(普遍)',
+	'MEASURED': '食品(計測)', 'PROCESSED': '食品(加工)', 'OUT_EAT': '外食'
+}
+
+def require_numpy(feature_name):
+	"""numpyが無い環境では機能を使えない旨を表示してFalseを返す"""
+	if np is None:
+		print(f"[Error] {feature_name} には numpy が必要です (pip install numpy)")
+		return False
+	return True
+
+def require_pyarrow(feature_name):
+	"""pyarrowが無い環境では機能を使えない旨を表示してFalseを返す"""
+	if pa is None:
+		print(f"[Error] {feature_name} には pyarrow が必要です (pip install pyarrow)")
+		return False
+	return True
+
 # ==========================================
 # 1. データベース管理クラス
 # ==========================================
 class Database:
-	def __init__(self):
+	def __init__(self, path=DB_NAME):
+		self.path = path
 		self.conn = None
 		self.cursor = None
 		self.connect()
 
 	def connect(self):
-		needs_init = not os.path.exists(DB_NAME)
-		self.conn = sqlite3.connect(DB_NAME)
+		needs_init = not os.path.exists(self.path)
+		self.conn = sqlite3.connect(self.path)
 		self.conn.row_factory = sqlite3.Row
 		self.cursor = self.conn.cursor()
 		self.cursor.execute("PRAGMA foreign_keys = ON;")
 		if needs_init: self.init_db_from_file()
 		self.ensure_snapshot_tables()
+		self.ensure_version_tracking()
 
 	def init_db_from_file(self):
 		if not os.path.exists(SQL_FILE):
@@ -165,84 +248,119 @@ class Database:
 			if 'expiration_type' not in cols:
 				print("DB Update: t_inventory に expiration_type を追加します")
 				cur.execute("ALTER TABLE t_inventory ADD COLUMN expiration_type TEXT DEFAULT 'ESTIMATE'")
+			# 取引単位の明細参照 (集計テーブルの差分更新・一括登録で使う)
+			cur.execute("CREATE INDEX IF NOT EXISTS idx_transaction_details_transaction ON t_transaction_details(transaction_id)")
 
 			self.conn.commit()
 		except:
 			pass
 
+	def ensure_version_tracking(self):
+		"""
+		VERSIONED_TABLES の変更(INSERT/UPDATE/DELETE)ごとにバージョンを加算するトリガーを張る。
+		メモリ上のキャッシュはこのバージョンを比較して、変化があった時だけ再構築する。
+		"""
+		cur = self.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_table_versions (
+				table_name TEXT PRIMARY KEY,
+				version INTEGER NOT NULL DEFAULT 0
+			)
+		""")
+		for table in VERSIONED_TABLES:
+			for op in ('INSERT', 'UPDATE', 'DELETE'):
+				cur.execute(f"""
+					CREATE TRIGGER IF NOT EXISTS trg_ver_{table}_{op.lower()}
+					AFTER {op} ON {table}
+					BEGIN
+						INSERT INTO t_table_versions (table_name, version) VALUES ('{table}', 1)
+						ON CONFLICT(table_name) DO UPDATE SET version = version + 1;
+					END
+				""")
+		# 集計テーブルがどのバージョンの元データから作られたか
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_derived_state (
+				name TEXT PRIMARY KEY,
+				source_version TEXT NOT NULL
+			)
+		""")
+		self.conn.commit()
+
+	def table_version(self, *tables):
+		"""指定テーブル群のバージョンをタプルで返す（未変更のテーブルは0）"""
+		marks = ",".join("?" * len(tables))
+		self.cursor.execute(f"SELECT table_name, version FROM t_table_versions WHERE table_name IN ({marks})", tables)
+		versions = {r['table_name']: r['version'] for r in self.cursor.fetchall()}
+		return tuple(versions.get(t, 0) for t in tables)
+
+	def derived_is_fresh(self, name, tables):
+		"""集計テーブル name が tables の現在のバージョンから作られていれば True"""
+		self.cursor.execute("SELECT source_version FROM t_derived_state WHERE name = ?", (name,))
+		row = self.cursor.fetchone()
+		return row is not None and row[0] == json.dumps(self.table_version(*tables))
+
+	def mark_derived(self, name, tables):
+		"""集計テーブル name を tables の現在のバージョンで作り直したことを記録"""
+		self.cursor.execute("INSERT OR REPLACE INTO t_derived_state (name, source_version) VALUES (?, ?)",
+			(name, json.dumps(self.table_version(*tables))))
+
 	def close(self):
 		if self.conn: self.conn.close()
 
+class ReadOnlyDatabase(Database):
+	"""
+	並列集計用の参照専用接続。スレッド・プロセスごとに1つ開き、初期化やマイグレーションは行わない。
+	"""
+	def connect(self):
+		self.conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+		self.conn.row_factory = sqlite3.Row
+		self.cursor = self.conn.cursor()
+
 # ==========================================
 # 2. マスタ登録マネージャ
 # ==========================================
 class MasterManager:
 	def __init__(self, db: Database):
 		self.db = db
+		self.store = FoodMasterStore(db)
 
 	def find_items_fuzzy(self, name):
-		cur = self.db.cursor
-		masters = [
-			('m_foods_universal', 'UNIVERSAL'),
-			('m_foods_measured', 'MEASURED'),
-			('m_foods_processed', 'PROCESSED')
-		]
+		store = self.store
+		store.refresh()
+		masters = ['UNIVERSAL', 'MEASURED', 'PROCESSED']
 
 		# 完全一致
-		for table, f_type in masters:
-			cur.execute(f"SELECT id, name FROM {table} WHERE name = ?", (name,))
-			res = cur.fetchone()
-			if res:
-				return {'exact': {'id': res['id'], 'name': res['name'], 'type': f_type}, 'candidates': []}
+		for f_type in masters:
+			ids, names = store.names(f_type)
+			if name in names:
+				i = names.index(name)
+				return {'exact': {'id': ids[i], 'name': name, 'type': f_type}, 'candidates': []}
 
 		# あいまい検索
-		candidates = []
-		for table, f_type in masters:
-			cur.execute(f"SELECT id, name FROM {table}")
-			rows = cur.fetchall()
-			names = [r['name'] for r in rows]
-			matches = difflib.get_close_matches(name, names, n=3, cutoff=0.4)
-			for m in matches:
-				for r in rows:
-					if r['name'] == m:
-						candidates.append({'id': r['id'], 'name': r['name'], 'type': f_type})
-						break
-		return {'exact': None, 'candidates': candidates}
+		return {'exact': None, 'candidates': self.find_food_master_fuzzy(name)}
 
 	def find_food_master_fuzzy(self, search_name):
 		"""食品DB(3つのテーブル)からあいまい検索を行う"""
-		cur = self.db.cursor
-		tables = [
-			('m_foods_universal', 'UNIVERSAL'),
-			('m_foods_measured', 'MEASURED'),
-			('m_foods_processed', 'PROCESSED')
-		]
+		store = self.store
+		store.refresh()
 		candidates = []
-		for table, f_type in tables:
-			cur.execute(f"SELECT id, name FROM {table}")
-			rows = cur.fetchall()
-			names = [r['name'] for r in rows]
+		for f_type in ('UNIVERSAL', 'MEASURED', 'PROCESSED'):
+			ids, names = store.names(f_type)
 			matches = difflib.get_close_matches(search_name, names, n=3, cutoff=0.4)
 			for m in matches:
-				for r in rows:
-					if r['name'] == m:
-						candidates.append({'id': r['id'], 'name': r['name'], 'type': f_type})
-						break
+				candidates.append({'id': ids[names.index(m)], 'name': m, 'type': f_type})
 		return candidates
 
 	def find_food_master_fuzzy_strict(self, search_name, food_type):
 		"""指定された food_type に対応するテーブルのみを検索"""
-		cur = self.db.cursor
-		table = table_map.get(food_type)
-		if not table: return []
-
-		cur.execute(f"SELECT id, name FROM {table}")
-		rows = cur.fetchall()
-		names = [r['name'] for r in rows]
+		if not table_map.get(food_type): return []
+		store = self.store
+		store.refresh()
+		ids, names = store.names(food_type)
 		matches = difflib.get_close_matches(search_name, names, n=3, cutoff=0.4)
 
-		return [{'id': r['id'], 'name': r['name'], 'type': food_type}
-			for r in rows if r['name'] in matches]
+		return [{'id': i, 'name': n, 'type': food_type}
+			for i, n in zip(ids, names) if n in matches]
 
 	def register_new_food(self, food_name, food_type):
 		"""指定された food_type のテーブルにのみ登録"""
@@ -296,8 +414,47 @@ class MasterManager:
 # 3. レポートマネージャ (完全版)
 # ==========================================
 class ReportManager:
+	# レポートごとの参照テーブル (キャッシュの無効化判定に使う)
+	REPORT_TABLES = {
+		'nutrition': ['t_transactions', 't_transaction_details', 't_meal_logs', 't_meal_details',
+			'm_foods_universal', 'm_foods_measured', 'm_foods_processed'],
+		'wallets': ['m_wallets', 'm_currencies', 't_wallet_balances'],
+		'inventory': ['t_inventory', 't_transaction_details', 't_transactions', 'm_foods_universal'],
+		'transactions': ['t_transactions', 't_payments', 'm_store_branches', 'm_brands'],
+	}
+	CACHE_SIZE = 32
+
 	def __init__(self, db: Database):
 		self.db = db
+		self._cache = OrderedDict()  # (report, params) -> {'state', 'versions', 'result'}
+
+	# --- 結果キャッシュ ---
+	def _cached(self, report, params, func):
+		"""
+		(report, params) の結果を LRU で保持する。
+		PRAGMA data_version(他接続のコミット)と total_changes(この接続の書き込み)が前回と同じなら即座に返し、
+		変化があれば参照テーブルのバージョン(t_table_versions)を比べて、変わっていた時だけ再集計する。
+		"""
+		key = (report, params)
+		conn = self.db.conn
+		state = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+		entry = self._cache.get(key)
+		if entry is not None:
+			if entry['state'] != state:
+				versions = self.db.table_version(*self.REPORT_TABLES[report])
+				if versions != entry['versions']: entry = None
+				else: entry['state'] = state
+			if entry is not None:
+				self._cache.move_to_end(key)
+				return entry['result']
+
+		versions = self.db.table_version(*self.REPORT_TABLES[report])
+		result = func()
+		self._cache[key] = {'state': (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes), 'versions': versions, 'result': result}
+		self._cache.move_to_end(key)
+		while len(self._cache) > self.CACHE_SIZE:
+			self._cache.popitem(last=False)
+		return result
 
 	# --- 共通ヘルパー: 表出力 ---
 	def _print_header(self, cols):
@@ -318,6 +475,10 @@ class ReportManager:
 
 	# --- データ取得ロジック ---
 	def _fetch_daily_nutrition(self, start_serial, end_serial):
+		return self._cached('nutrition', (int(start_serial), int(end_serial)),
+			lambda: self._query_daily_nutrition(start_serial, end_serial))
+
+	def _query_daily_nutrition(self, start_serial, end_serial):
 		"""
 		指定期間の栄養素を日別(serial)で集計して辞書で返す
 		対象: 'EAT_NOW'(購入時即食) + 'SELF'(在庫消費)
@@ -325,26 +486,17 @@ class ReportManager:
 		"""
 		cur = self.db.cursor
 		# 栄養素と味覚のカラム定義 (スキーマに基づき energy_kcal, protein_g, fat_g, carb_g, salt_equiv_g, taste_...)
-		base_nutrients = ['energy_kcal', 'protein_g', 'fat_g', 'carb_g', 'salt_equiv_g']
-		tastes = ['taste_sweet', 'taste_salty', 'taste_sour', 'taste_bitter', 'taste_umami',
-				'taste_pungent', 'taste_cooling', 'taste_astringency', 'taste_richness', 'taste_sharpness']
-		all_fields = base_nutrients + tastes
+		all_fields = NUTRIENT_FIELDS + TASTE_FIELDS
 
 		# 栄養素計算式 (Measuredは100gあたり、それ以外は1単位あたり)
 		def calc_field(field):
-			return f"""
-			SUM(
-				CASE
-					WHEN f_type = 'MEASURED' THEN qty * (COALESCE(fm.{field}, 0) / 100.0)
-					WHEN f_type = 'UNIVERSAL' THEN qty * COALESCE(fu.{field}, 0)
-					WHEN f_type IN ('PROCESSED', 'OUT_EAT') THEN qty * COALESCE(fp.{field}, 0)
-					ELSE 0
-				END
-			) as {field}
-			"""
+			return f"SUM(qty * {nutrient_per_qty_sql(field)}) as {field}"
 
 		fields_sql = ", ".join([calc_field(f) for f in all_fields])
 
+		# アーカイブ済みの年を含む期間は、アーカイブを ATTACH して UNION した表を参照する
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details', 't_meal_details', 't_meal_logs'], start_serial, end_serial)
+
 		sql = f"""
 		SELECT
 			target_date,
@@ -356,9 +508,9 @@ class ReportManager:
 				td.food_type as f_type,
 				td.food_id as f_id,
 				td.quantity as qty
-			FROM t_transaction_details td
-			JOIN t_transactions t ON td.transaction_id = t.id
-			WHERE td.destination = 'EAT_NOW'
+			FROM {src['t_transaction_details']} td
+			JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+			WHERE td.destination = 'EAT_NOW' AND CAST(t.transaction_at AS INTEGER) BETWEEN :s AND :e
 
 			UNION ALL
 
@@ -368,25 +520,34 @@ class ReportManager:
 				td.food_type as f_type,
 				td.food_id as f_id,
 				md.amount_consumed as qty
-			FROM t_meal_details md
-			JOIN t_meal_logs ml ON md.meal_id = ml.id
-			JOIN t_transaction_details td ON md.detail_id = td.id
-			WHERE md.consume_type = 'SELF'
+			FROM {src['t_meal_details']} md
+			JOIN {src['t_meal_logs']} ml ON md.meal_id = ml.id
+			JOIN {src['t_transaction_details']} td ON md.detail_id = td.id
+			WHERE md.consume_type = 'SELF' AND CAST(ml.eaten_at AS INTEGER) BETWEEN :s AND :e
 		) as combined
 		LEFT JOIN m_foods_measured fm ON f_id = fm.id AND f_type = 'MEASURED'
 		LEFT JOIN m_foods_universal fu ON f_id = fu.id AND f_type = 'UNIVERSAL'
 		LEFT JOIN m_foods_processed fp ON f_id = fp.id AND (f_type = 'PROCESSED' OR f_type = 'OUT_EAT')
-		WHERE target_date BETWEEN ? AND ?
 		GROUP BY target_date
 		ORDER BY target_date
 		"""
 
-		cur.execute(sql, (int(start_serial), int(end_serial)))
-		return cur.fetchall()
+		cur.execute(sql, {'s': int(start_serial), 'e': int(end_serial)})
+		# 表示側で使う短い名前(kcal, prot, ...)も付けて {日付シリアル: 値の辞書} にする
+		short = {'energy_kcal': 'kcal', 'protein_g': 'prot', 'fat_g': 'fat', 'carb_g': 'carb', 'salt_equiv_g': 'salt'}
+		result = {}
+		for r in cur.fetchall():
+			row = {f: r[f] or 0 for f in all_fields}
+			row.update({short[f]: row[f] for f in NUTRIENT_FIELDS})
+			result[r['target_date']] = row
+		return result
 
 	# --- 表示メソッド ---
 
-	def show_wallets(self):
+	def _fetch_wallets(self):
+		return self._cached('wallets', (), self._query_wallets)
+
+	def _query_wallets(self):
 		cur = self.db.cursor
 		cur.execute("""
 			SELECT w.name, c.display_unit, COALESCE(wb.current_amount, 0) as total
@@ -394,19 +555,22 @@ class ReportManager:
 			LEFT JOIN t_wallet_balances wb ON w.id = wb.wallet_id
 			WHERE w.is_active = 1 ORDER BY w.id
 		""")
+		return cur.fetchall()
+
+	def show_wallets(self, rows=None):
+		"""rows: 取得済みの _fetch_wallets() の結果 (省略時はここで取得)"""
+		if rows is None: rows = self._fetch_wallets()
 		print("\n=== 財布残高 ===")
 		cols = [("財布名", 32, 'left'), ("残高", 12, 'right')]
 		self._print_header(cols)
-		for r in cur.fetchall():
+		for r in rows:
 			amt = f"{int(r['total']):,}{r['display_unit']}"
 			self._print_row([(r['name'], 32, 'left'), (amt, 12, 'right')])
 
-	def show_inventory(self):
-		"""
-		最新の在庫一覧を表示。
-		期限(limit_date)がない場合、m_foods_universalの目安(shelf_life_days_guideline)
-		を購入日に加算して動的に計算し「目安」として表示します。
-		"""
+	def _fetch_inventory(self):
+		return self._cached('inventory', (), self._query_inventory)
+
+	def _query_inventory(self):
 		# 1. データの取得
 		# t_inventory(残量) -> t_transaction_details(期限、場所、名前)
 		# -> t_transactions(購入日) -> m_foods_universal(目安日数)
@@ -430,7 +594,16 @@ class ReportManager:
 
 		cur = self.db.cursor
 		cur.execute(sql)
-		rows = cur.fetchall()
+		return cur.fetchall()
+
+	def show_inventory(self, rows=None):
+		"""
+		最新の在庫一覧を表示。
+		期限(limit_date)がない場合、m_foods_universalの目安(shelf_life_days_guideline)
+		を購入日に加算して動的に計算し「目安」として表示します。
+		rows: 取得済みの _fetch_inventory() の結果 (省略時はここで取得)
+		"""
+		if rows is None: rows = self._fetch_inventory()
 
 		if not rows:
 			print("現在、在庫はありません。")
@@ -475,20 +648,28 @@ class ReportManager:
 			# 3. 行の表示
 			self._print_row([(r['item_name_receipt'], 32, 'left'), (location, 8, 'left'), (f"{r['current_quantity']:>5.1f}", 5, 'right'), (f"{date_str}{label}", 12, 'left'), (status, 12, 'left')])
 
-	def _list_transactions(self, s, e):
+	def _fetch_transactions(self, s, e):
+		return self._cached('transactions', (s, e), lambda: self._query_transactions(s, e))
+
+	def _query_transactions(self, s, e):
+		"""期間内の取引一覧と、詳細表示に使う参照先(アーカイブを含む)"""
 		cur = self.db.cursor
-		sql = """
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details', 't_payments'], s, e)
+		sql = f"""
 			SELECT t.id, t.transaction_at, t.transaction_name, b.name as brand,
 			COALESCE(SUM(p.amount),0) as total
-			FROM t_transactions t
+			FROM {src['t_transactions']} t
 			LEFT JOIN m_store_branches sb ON t.branch_id=sb.id
 			LEFT JOIN m_brands b ON sb.brand_id=b.id
-			LEFT JOIN t_payments p ON t.id=p.transaction_id
+			LEFT JOIN {src['t_payments']} p ON t.id=p.transaction_id
 			WHERE t.transaction_at BETWEEN ? AND ?
 			GROUP BY t.id ORDER BY t.transaction_at DESC
 		"""
 		cur.execute(sql, (s, e))
-		rows = cur.fetchall()
+		return cur.fetchall(), src
+
+	def _list_transactions(self, s, e):
+		rows, src = self._fetch_transactions(s, e)
 		if not rows:
 			print("該当なし")
 			return
@@ -512,16 +693,17 @@ class ReportManager:
 			sel = get_input("詳細No (Enter戻る)", required=False)
 			if not sel: break
 			if sel.isdigit() and 1 <= int(sel) <= len(t_ids):
-				self._show_transaction_detail(t_ids[int(sel)-1])
+				self._show_transaction_detail(t_ids[int(sel)-1], src)
 
-	def _show_transaction_detail(self, trans_id):
-		"""取引詳細の完全表示"""
+	def _show_transaction_detail(self, trans_id, src=None):
+		"""取引詳細の完全表示 (src: アーカイブを含む参照先。省略時は現役テーブル)"""
 		cur = self.db.cursor
+		src = src or {t: t for t in ('t_transactions', 't_transaction_details', 't_payments')}
 
 		# 基本情報
-		cur.execute("""
+		cur.execute(f"""
 			SELECT t.*, b.name as brand_name, sb.branch_name
-			FROM t_transactions t
+			FROM {src['t_transactions']} t
 			LEFT JOIN m_store_branches sb ON t.branch_id = sb.id
 			LEFT JOIN m_brands b ON sb.brand_id = b.id
 			WHERE t.id=?
@@ -537,7 +719,7 @@ class ReportManager:
 		cols_d = [("商品名", 20, 'left'), ("単価", 8, 'right'), ("数量", 6, 'right'), ("小計", 8, 'right'), ("行先", 6, 'center')]
 		self._print_header(cols_d)
 
-		cur.execute("SELECT * FROM t_transaction_details WHERE transaction_id=?", (trans_id,))
+		cur.execute(f"SELECT * FROM {src['t_transaction_details']} WHERE transaction_id=?", (trans_id,))
 		details = cur.fetchall()
 
 		calc_sum = 0
@@ -564,9 +746,9 @@ class ReportManager:
 		cols_p = [("財布", 32, 'left'), ("金額", 10, 'right'), ("種別", 6, 'center'), ("備考", 14, 'left')]
 		self._print_header(cols_p)
 
-		cur.execute("""
+		cur.execute(f"""
 			SELECT p.*, w.name as wallet_name
-			FROM t_payments p
+			FROM {src['t_payments']} p
 			JOIN m_wallets w ON p.wallet_id=w.id
 			WHERE transaction_id=?
 		""", (trans_id,))
@@ -587,7 +769,8 @@ class ReportManager:
 		print("")
 
 	def show_recent_transactions(self):
-		now = datetime.datetime.now()
+		# 分単位に丸めて、続けて開いた時に同じキャッシュを使えるようにする
+		now = datetime.datetime.now().replace(second=0, microsecond=0) + timedelta(minutes=1)
 		start = datetime_to_serial(now - timedelta(days=30))
 		end = datetime_to_serial(now)
 		self._list_transactions(start, end)
@@ -608,11 +791,16 @@ class ReportManager:
 		e_dt = serial_to_datetime(end_serial)
 		days = (e_dt - s_dt).days + 1
 
+		# 目標外の日の印と移動平均 (numpy がある場合のみ)
+		rolling = self._rolling_nutrition(start_serial, end_serial) if np is not None else None
+		marks = ['K', 'P', 'F', 'C', 'S']
+
 		print(f"\n=== {title} ===")
 		cols = [
 			("日付", 10, 'left'), ("Kcal", 8, 'right'), ("Prot", 6, 'right'),
 			("Fat", 6, 'right'), ("Carb", 6, 'right'), ("Salt", 6, 'right')
 		]
+		if rolling: cols.append(("目標外", 10, 'left'))
 		self._print_header(cols)
 
 		total_k, total_p, total_f, total_c, total_s = 0, 0, 0, 0, 0
@@ -624,14 +812,19 @@ class ReportManager:
 			row = data.get(curr_serial, {'kcal':0, 'prot':0, 'fat':0, 'carb':0, 'salt':0})
 
 			d_str = curr_dt.strftime("%m/%d")
-			self._print_row([
+			cells = [
 				(d_str, 10, 'left'),
 				(f"{int(row['kcal'])}", 8, 'right'),
 				(f"{row['prot']:.1f}", 6, 'right'),
 				(f"{row['fat']:.1f}", 6, 'right'),
 				(f"{row['carb']:.1f}", 6, 'right'),
 				(f"{row['salt']:.1f}", 6, 'right')
-			])
+			]
+			if rolling:
+				idx = curr_serial - rolling['start']
+				flags = rolling['off'][idx] if 0 <= idx < len(rolling['off']) else []
+				cells.append((",".join(mk for mk, f in zip(marks, flags) if f), 10, 'left'))
+			self._print_row(cells)
 
 			total_k += row['kcal']
 			total_p += row['prot']
@@ -659,6 +852,138 @@ class ReportManager:
 				(f"{total_s/days:.1f}", 6, 'right')
 			])
 
+		if rolling: self._print_goal_summary(rolling)
+
+	# --- 栄養目標・移動平均 ---
+	# 既定の目標: (1日の目標値, MAX: 超えたら目標外 / MIN: 下回ったら目標外)
+	NUTRITION_GOAL_DEFAULTS = {
+		'energy_kcal': (2000.0, 'MAX'), 'protein_g': (65.0, 'MIN'), 'fat_g': (60.0, 'MAX'),
+		'carb_g': (300.0, 'MAX'), 'salt_equiv_g': (7.5, 'MAX'),
+	}
+	ROLLING_WINDOWS = (7, 28)
+
+	def load_nutrition_goals(self):
+		"""{栄養素カラム: (目標値, 'MAX'|'MIN')}。未登録の栄養素は既定値"""
+		goals = dict(self.NUTRITION_GOAL_DEFAULTS)
+		cur = self.db.cursor
+		cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'm_nutrition_goals'")
+		if cur.fetchone():
+			cur.execute("SELECT field, target, kind FROM m_nutrition_goals")
+			goals.update({r['field']: (r['target'], r['kind']) for r in cur.fetchall()})
+		return goals
+
+	def save_nutrition_goals(self, goals):
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_nutrition_goals (
+				field TEXT PRIMARY KEY,              -- 栄養素カラム名 (energy_kcal 等)
+				target REAL NOT NULL,                -- 1日の目標値
+				kind TEXT CHECK(kind IN ('MAX', 'MIN')) NOT NULL
+			)
+		""")
+		cur.executemany("INSERT OR REPLACE INTO m_nutrition_goals (field, target, kind) VALUES (?, ?, ?)",
+			[(f, t, k) for f, (t, k) in goals.items()])
+		self.db.conn.commit()
+
+	def _rolling_nutrition(self, start_serial, end_serial):
+		"""
+		日別系列から移動平均と目標外の日を求める。
+		窓の分だけ前から1回で取得し、累積和の差で全ての窓を O(日数) で計算する。
+		移動平均は記録のある日だけで割る (記録のない日は0kcalではなく未記録として扱う)。
+		戻り値: {'start', 'values'(日数x栄養素), 'logged', 'roll': {窓: 日数x栄養素}, 'off'(目標外), 'goals'}
+		"""
+		start, end = int(start_serial), int(end_serial)
+		first = start - max(self.ROLLING_WINDOWS) + 1
+		data = self._fetch_daily_nutrition(first, end)
+		n = end - first + 1
+		values = np.zeros((n, len(NUTRIENT_FIELDS)))
+		logged = np.zeros(n)
+		for day, row in data.items():
+			values[day - first] = [row[f] for f in NUTRIENT_FIELDS]
+			logged[day - first] = 1
+
+		sums = np.vstack([np.zeros(len(NUTRIENT_FIELDS)), np.cumsum(values, axis=0)])
+		counts = np.concatenate([[0], np.cumsum(logged)])
+		hi = np.arange(1, n + 1)
+		roll = {}
+		with np.errstate(invalid='ignore', divide='ignore'):
+			for w in self.ROLLING_WINDOWS:
+				lo = np.maximum(hi - w, 0)
+				roll[w] = (sums[hi] - sums[lo]) / (counts[hi] - counts[lo])[:, None]
+
+		goals = self.load_nutrition_goals()
+		target = np.array([goals[f][0] for f in NUTRIENT_FIELDS])
+		is_min = np.array([goals[f][1] == 'MIN' for f in NUTRIENT_FIELDS])
+		off = np.where(is_min, values < target, values > target) & (logged[:, None] > 0)
+
+		k = start - first
+		return {'start': start, 'values': values[k:], 'logged': logged[k:], 'roll': {w: r[k:] for w, r in roll.items()},
+			'off': off[k:], 'goals': goals}
+
+	def _print_goal_summary(self, rolling):
+		"""期間の目標比較 (移動平均は期間最終日の値)"""
+		goals, logged = rolling['goals'], rolling['logged']
+		n_logged = int(logged.sum())
+		period_avg = rolling['values'].sum(axis=0) / max(n_logged, 1)
+		w1, w2 = self.ROLLING_WINDOWS
+		print(f"\n=== 栄養目標との比較 (記録のある日: {n_logged}日) ===")
+		self._print_header([("栄養素", 18, 'left'), ("目標", 10, 'right'), ("期間平均", 8, 'right'),
+			(f"{w1}日平均", 8, 'right'), (f"{w2}日平均", 8, 'right'), ("目標外日数", 10, 'right')])
+		for i, f in enumerate(NUTRIENT_FIELDS):
+			target, kind = goals[f]
+			fmt = lambda v: "-" if v != v else (f"{int(v)}" if f == 'energy_kcal' else f"{v:.1f}")
+			self._print_row([(NUTRIENT_LABELS[f], 18, 'left'), (f"{target:g}{'以下' if kind == 'MAX' else '以上'}", 10, 'right'),
+				(fmt(period_avg[i]), 8, 'right'), (fmt(rolling['roll'][w1][-1, i]), 8, 'right'),
+				(fmt(rolling['roll'][w2][-1, i]), 8, 'right'), (f"{int(rolling['off'][:, i].sum())}", 10, 'right')])
+
+	def show_nutrition_goals(self):
+		if not require_numpy("栄養目標・移動平均"): return
+		print("\n=== 栄養目標・移動平均 ===")
+		print(" 1. 目標の設定")
+		print(" 2. 期間の推移 (月末時点の移動平均と目標外日数)")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel == '1':
+			goals = self.load_nutrition_goals()
+			for f in NUTRIENT_FIELDS:
+				target, kind = goals[f]
+				val = get_input(f"1日の目標 {NUTRIENT_LABELS[f]} [def:{target:g}]", required=False, cast_func=float)
+				k_in = get_input(f"  目標外とするのは (1:超えた日, 2:下回った日) [def:{'1' if kind == 'MAX' else '2'}]", required=False)
+				goals[f] = (target if val is None else val, {'1': 'MAX', '2': 'MIN'}.get(k_in, kind))
+			self.save_nutrition_goals(goals)
+			print("目標を保存しました")
+			return
+		if sel != '2': return
+
+		now = datetime.datetime.now()
+		ym_from = get_input(f"開始年月 YYYYMM [def:{now.year - 1}{now.month:02d}]", required=False) or f"{now.year - 1}{now.month:02d}"
+		ym_to = get_input(f"終了年月 YYYYMM [def:{now.strftime('%Y%m')}]", required=False) or now.strftime('%Y%m')
+		s, _ = get_month_range(ym_from)
+		_, e = get_month_range(ym_to)
+		if s and e: e = min(e, datetime_to_serial(now))
+		if not s or not e or s > e:
+			print("日付エラー")
+			return
+		rolling = self._rolling_nutrition(s, e)
+		start = rolling['start']
+		w2 = self.ROLLING_WINDOWS[-1]
+		fmt = lambda v, d=1: "-" if v != v else f"{v:.{d}f}"
+
+		print(f"\n=== 月末時点の{w2}日移動平均と目標外日数 ===")
+		self._print_header([("年月", 8, 'left'), ("Kcal", 6, 'right'), ("Prot", 6, 'right'), ("Fat", 6, 'right'),
+			("Carb", 6, 'right'), ("Salt", 5, 'right'), ("記録日", 6, 'right'), ("目標外 K/P/F/C/S", 18, 'left')])
+		dt = serial_to_datetime(s)
+		y, m = dt.year, dt.month
+		while True:
+			ms, me = get_month_range(f"{y}{m:02d}")
+			if ms > e: break
+			a, b = int(ms) - start, min(int(me), int(e)) - start + 1
+			avg = rolling['roll'][w2][b - 1]
+			self._print_row([(f"{y}/{m:02d}", 8, 'left'), (fmt(avg[0], 0), 6, 'right'), (fmt(avg[1]), 6, 'right'),
+				(fmt(avg[2]), 6, 'right'), (fmt(avg[3]), 6, 'right'), (fmt(avg[4]), 5, 'right'),
+				(f"{int(rolling['logged'][a:b].sum())}", 6, 'right'), ("/".join(str(int(c)) for c in rolling['off'][a:b].sum(axis=0)), 18, 'left')])
+			y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+		self._print_goal_summary(rolling)
+
 	def show_recent_month_nutrition(self):
 		end_dt = datetime.datetime.now()
 		start_dt = end_dt - timedelta(days=29)
@@ -724,6 +1049,10 @@ class TransactionManager:
 	def __init__(self, db: Database, master_mgr: MasterManager):
 		self.db = db
 		self.master_mgr = master_mgr
+		self.cube = SpendingCube(db)
+		self.prices = PriceIndex(db)
+		self.budget = BudgetTracker(db)
+		self.suggest = ReceiptSuggestIndex(db)
 
 	def create_transaction(self):
 		print("\n=== 新規取引入力 ===")
@@ -830,94 +1159,110 @@ class TransactionManager:
 		# --- B. 明細入力セクション ---
 		item_total = 0
 		details = []
+		budget_month = format_serial(tx_date_serial, '%Y%m')
+		budget_pending = {}  # (category_id, food_type) -> この取引での入力額
 		print("\n--- 明細入力 (Enterで終了) ---")
 		while True:
 			# 1. 商品名入力 (自由記述)
 			item_name_receipt = get_input("商品名 (レシート通り)", required=False)
 			if not item_name_receipt: break
 
-			# 2. カテゴリ選択
-			cur.execute("SELECT id, name FROM m_categories WHERE type='EXPENSE'")
-			gen_cats = cur.fetchall()
-			print(f"\n[カテゴリ選択: {item_name_receipt}]")
-			print("  u: 普遍的食品,")
-			print("  m: 計測食品,")
-			print("  p: 加工食品,")
-			print("  o: 外食")
-			print("  a: 残高調整,")
-			print("  x: その他(NONE)")
-			for c in gen_cats:
-				print(f"  {c['id']}: {c['name']}")
-
-			cat_sel = get_input("選択", cast_func=str).lower()
-
-			# 判定用フラグ
-			f_type_map = {'u':'UNIVERSAL', 'm':'MEASURED', 'p':'PROCESSED', 'o':'OUT_EAT'}
-			final_food_type = f_type_map.get(cat_sel)
-			final_category_id = int(cat_sel) if cat_sel.isdigit() else None
-			final_food_id = None
-
-			# 3. 食品カテゴリの場合のみ、食品マスタ(食品名)との紐付けループ
-			if final_food_type:
-				search_query = item_name_receipt
-				while True:
-					# 指定された種別のテーブルのみを検索
-					candidates = self.master_mgr.find_food_master_fuzzy_strict(search_query, final_food_type)
-					exact_match = next((c for c in candidates if c['name'] == search_query), None)
-
-					print(f"\n食品マスタ候補 [{final_food_type}] ({search_query}):")
-					if candidates:
-						for i, c in enumerate(candidates):
-							mark = " [完全一致]" if c['name'] == search_query else ""
-							print(f"  {i+1}: {c['name']}{mark}")
-						if not exact_match: print("  n: この名前で新規マスタ登録")
-						print("  s: 別の名前で再検索")
-
-						ans = get_input("選択", cast_func=str).lower()
-						if ans.isdigit() and 1 <= int(ans) <= len(candidates):
-							final_food_id = candidates[int(ans)-1]['id']
-							break
-						elif ans == 'n' and not exact_match:
-							final_food_id = self.master_mgr.register_new_food_with_input(search_query, final_food_type)
-							break
-						elif ans == 's':
-							search_query = get_input("再検索名")
-							continue
-					else:
-						ans = get_input("候補なし。n: 新規登録, s: 再検索", cast_func=str).lower()
-						if ans == 'n':
-							final_food_id = self.master_mgr.register_new_food_with_input(search_query, final_food_type)
-							break
-						else:
-							search_query = get_input("再検索名")
-							continue
-
-			# 4. 金額・数量・税・期限の入力 (共通)
-			price = get_input("単価(税抜)", cast_func=int)
-			qty = get_input("数量", cast_func=float)
-
-			# 税率自動判定
-			if is_public == 1:
-				def_tax = 0.08 if final_food_type in ['UNIVERSAL','MEASURED','PROCESSED'] else 0.10
+			# 1.5 購入履歴からの補完 (候補を選ぶとカテゴリ・単価・税率・行き先の入力を省略)
+			sugg = self.suggest.choose(item_name_receipt, branch_id)
+			if sugg:
+				item_name_receipt = sugg['item_name_receipt']
+				final_food_type = sugg['food_type']
+				final_category_id = sugg['category_id']
+				final_food_id = sugg['food_id']
+				price = get_input(f"単価(税抜) [def:{sugg['price']:g}]", required=False, cast_func=float)
+				if price is None: price = sugg['price']
+				qty = get_input("数量 [def:1]", required=False, cast_func=float) or 1
+				tax_rate = sugg['tax'] if is_public == 1 else 0.0
+				discount, content_amt, origin = 0, sugg['content'], sugg['origin']
+				dest = sugg['dest'] or 'EAT_NOW'
 			else:
-				# 非公開取引（お小遣いやレシートなし）は税金計算から除外 ※自己責任
-				def_tax = 0.0
+				# 2. カテゴリ選択
+				cur.execute("SELECT id, name FROM m_categories WHERE type='EXPENSE'")
+				gen_cats = cur.fetchall()
+				print(f"\n[カテゴリ選択: {item_name_receipt}]")
+				print("  u: 普遍的食品,")
+				print("  m: 計測食品,")
+				print("  p: 加工食品,")
+				print("  o: 外食")
+				print("  a: 残高調整,")
+				print("  x: その他(NONE)")
+				for c in gen_cats:
+					print(f"  {c['id']}: {c['name']}")
+
+				cat_sel = get_input("選択", cast_func=str).lower()
+
+				# 判定用フラグ
+				f_type_map = {'u':'UNIVERSAL', 'm':'MEASURED', 'p':'PROCESSED', 'o':'OUT_EAT'}
+				final_food_type = f_type_map.get(cat_sel)
+				final_category_id = int(cat_sel) if cat_sel.isdigit() else None
+				final_food_id = None
+
+				# 3. 食品カテゴリの場合のみ、食品マスタ(食品名)との紐付けループ
+				if final_food_type:
+					search_query = item_name_receipt
+					while True:
+						# 指定された種別のテーブルのみを検索
+						candidates = self.master_mgr.find_food_master_fuzzy_strict(search_query, final_food_type)
+						exact_match = next((c for c in candidates if c['name'] == search_query), None)
+
+						print(f"\n食品マスタ候補 [{final_food_type}] ({search_query}):")
+						if candidates:
+							for i, c in enumerate(candidates):
+								mark = " [完全一致]" if c['name'] == search_query else ""
+								print(f"  {i+1}: {c['name']}{mark}")
+							if not exact_match: print("  n: この名前で新規マスタ登録")
+							print("  s: 別の名前で再検索")
+
+							ans = get_input("選択", cast_func=str).lower()
+							if ans.isdigit() and 1 <= int(ans) <= len(candidates):
+								final_food_id = candidates[int(ans)-1]['id']
+								break
+							elif ans == 'n' and not exact_match:
+								final_food_id = self.master_mgr.register_new_food_with_input(search_query, final_food_type)
+								break
+							elif ans == 's':
+								search_query = get_input("再検索名")
+								continue
+						else:
+							ans = get_input("候補なし。n: 新規登録, s: 再検索", cast_func=str).lower()
+							if ans == 'n':
+								final_food_id = self.master_mgr.register_new_food_with_input(search_query, final_food_type)
+								break
+							else:
+								search_query = get_input("再検索名")
+								continue
+
+				# 4. 金額・数量・税・期限の入力 (共通)
+				price = get_input("単価(税抜)", cast_func=int)
+				qty = get_input("数量", cast_func=float)
+
+				# 税率自動判定
+				if is_public == 1:
+					def_tax = 0.08 if final_food_type in ['UNIVERSAL','MEASURED','PROCESSED'] else 0.10
+				else:
+					# 非公開取引（お小遣いやレシートなし）は税金計算から除外 ※自己責任
+					def_tax = 0.0
 
-			tax_rate = get_input(f"税率 (def:{def_tax})", required=False, cast_func=float) or def_tax
+				tax_rate = get_input(f"税率 (def:{def_tax})", required=False, cast_func=float) or def_tax
 
-			# 詳細パラメータ (SQL定義のフル活用)
-			discount = get_input("割引額(円) [def:0]", required=False, cast_func=float) or 0
-			content_amt = get_input("内容量(g等) [def:空]", required=False, cast_func=float)
-			origin = get_input("産地 [def:空]", required=False)
+				# 詳細パラメータ (SQL定義のフル活用)
+				discount = get_input("割引額(円) [def:0]", required=False, cast_func=float) or 0
+				content_amt = get_input("内容量(g等) [def:空]", required=False, cast_func=float)
+				origin = get_input("産地 [def:空]", required=False)
 
-			# 在庫情報の処理
-			dest = "EAT_NOW"
-			if final_food_type == 'OUT_EAT':
-				print("  -> 外食のため、即食（栄養として計上）として処理します。")
-			elif final_food_type in ['UNIVERSAL', 'MEASURED', 'PROCESSED']:
-				print("行き先: 1.即食, 2.冷蔵庫, 3.冷凍庫, 4.常温保存, 5.譲渡")
-				d_idx = input("> ").strip()
-				dest = {'1':'EAT_NOW','2':'FRIDGE','3':'FREEZER','4':'PANTRY','5':'GIFT'}.get(d_idx, 'EAT_NOW')
+				# 在庫情報の処理
+				dest = "EAT_NOW"
+				if final_food_type == 'OUT_EAT':
+					print("  -> 外食のため、即食（栄養として計上）として処理します。")
+				elif final_food_type in ['UNIVERSAL', 'MEASURED', 'PROCESSED']:
+					print("行き先: 1.即食, 2.冷蔵庫, 3.冷凍庫, 4.常温保存, 5.譲渡")
+					d_idx = input("> ").strip()
+					dest = {'1':'EAT_NOW','2':'FRIDGE','3':'FREEZER','4':'PANTRY','5':'GIFT'}.get(d_idx, 'EAT_NOW')
 
 			# 期限設定のロジック
 			limit_date = None
@@ -952,6 +1297,12 @@ class TransactionManager:
 			if line_gross < 0: line_gross = 0
 			item_total += int(line_gross * (1 + tax_rate))
 
+			# 今月の残り予算 (この取引で入力済みの行も含める)
+			if final_food_type != 'ADJUSTMENT':
+				budget_key = (final_category_id or 0, final_food_type or 'NONE')
+				budget_pending[budget_key] = budget_pending.get(budget_key, 0) + int(line_gross * (1 + tax_rate))
+				self.budget.show_line_status(budget_month, *budget_key, budget_pending[budget_key])
+
 		# --- D. 保存処理 ---
 		cur.execute("INSERT INTO t_transactions (branch_id, transaction_at, total_amount_jpy, is_public) VALUES (?, ?, ?, ?)", (branch_id, tx_date_serial, item_total, is_public))
 		trans_id = cur.lastrowid
@@ -969,6 +1320,12 @@ class TransactionManager:
 					VALUES (?, ?, ?)
 				""", (cur.lastrowid, d['qty'], tx_date_serial))
 
+		# 集計テーブルへの差分反映 (取引と同じトランザクションでコミットされる)
+		self.cube.apply_transaction(trans_id)
+		self.prices.apply_transaction(trans_id)
+		self.budget.apply_transaction(trans_id)
+		self.suggest.add_transaction(trans_id)
+
 		# D. 決済処理
 		print(f"\n合計金額: {item_total}円")
 
@@ -1128,6 +1485,43 @@ class TransactionManager:
 			VALUES (?, ?, ?, 0)
 		""", (trans_id, wallet_id, db_amount))
 
+	def import_transactions(self, entries):
+		"""
+		外部データ(明細CSV等)からの一括登録。1件 = 1明細・1決済の単純な取引として保存する。
+		entries: [{'at', 'name', 'wallet_id', 'amount'(財布の増減: 支出は負), 'category_id', 'item_name'}]
+		create_transaction と同じく明細・取引の金額は絶対値で持ち、入金か支出かは決済の符号とカテゴリ(INCOME/EXPENSE)で表す。
+		明細と決済は executemany でまとめて挿入し、残高スナップショットは財布ごとに1回だけ更新する。
+		行トリガーによる整合性チェックが有効な場合は、登録の間だけ外して最後にまとめて検査する。
+		戻り値: 作成した取引IDのリスト
+		"""
+		with IntegrityChecker(self.db).deferred():
+			cur = self.db.cursor
+			trans_ids = []
+			for e in entries:
+				cur.execute("INSERT INTO t_transactions (transaction_name, transaction_at, total_amount_jpy, is_public) VALUES (?, ?, ?, 1)",
+					(e['name'], e['at'], abs(e['amount'])))
+				trans_ids.append(cur.lastrowid)
+			# 明細の税率は内訳が分からないため0%とし、税込額をそのまま単価にする
+			cur.executemany("""
+				INSERT INTO t_transaction_details (transaction_id, item_name_receipt, food_type, category_id, unit_price_ex_tax, quantity, tax_rate)
+				VALUES (?, ?, 'NONE', ?, ?, 1, 0)
+			""", [(tid, e.get('item_name') or e['name'], e.get('category_id'), abs(e['amount'])) for tid, e in zip(trans_ids, entries)])
+			cur.executemany("INSERT INTO t_payments (transaction_id, wallet_id, amount, remaining_amount) VALUES (?, ?, ?, 0)",
+				[(tid, e['wallet_id'], e['amount']) for tid, e in zip(trans_ids, entries)])
+
+			per_wallet = {}
+			for e in entries:
+				per_wallet[e['wallet_id']] = per_wallet.get(e['wallet_id'], 0) + e['amount']
+			for wallet_id, delta in per_wallet.items():
+				self.update_balance_snapshot(wallet_id, delta, None, None, None)
+
+			self.cube.apply_transactions(trans_ids)
+			self.prices.apply_transactions(trans_ids)
+			self.budget.apply_transactions(trans_ids)
+			self.suggest.add_transactions(trans_ids)
+			self.db.conn.commit()
+		return trans_ids
+
 	def consume_inventory(self):
 		print("\n=== 在庫消費入力 ===")
 		ReportManager(self.db).show_inventory()
@@ -1189,16 +1583,4199 @@ class TransactionManager:
 			print("キャンセルしました")
 
 # ==========================================
-# 5. Main Loop
+# 5. 食品類似検索 (味覚・栄養ベクトル)
 # ==========================================
-class LifeManagerApp:
-	def __init__(self):
-		self.db = Database()
-		self.master = MasterManager(self.db)
-		self.reporter = ReportManager(self.db)
-		self.trans = TransactionManager(self.db, self.master)
+class FoodSimilarityIndex:
+	"""
+	3つの食品マスタを「味覚10種 + 栄養素5種」のベクトルとして1つの行列にまとめ、
+	似た食品(taste)・代替食品(all)の k 近傍検索を行う。
+	行列は食品マスタのバージョン(t_table_versions)が変わった時だけ再構築する。
+	"""
+	def __init__(self, db: Database, store=None):
+		self.db = db
+		self.store = store or FoodMasterStore(db)
+		self._version = None
+		self.keys = []      # 行番号 -> (food_type, id)
+		self.names = []     # 行番号 -> 食品名
+		self.offsets = {}   # (food_type, id) -> 行番号
+		self._matrices = {} # 'taste' / 'all' -> 正規化済み行列
+		self._sq_norms = {} # ユークリッド距離用の行ごとの二乗ノルム
+
+	def _load(self):
+		"""食品マスタの列から、栄養素は100gあたりに揃えた生の特徴量行列を作る"""
+		store = self.store
+		n = len(store)
+		col = lambda arr: np.frombuffer(arr, dtype=np.float64, count=n)
+		weight = col(store.weight_g)
+		# 1単位(個・食)あたりの栄養素を100gあたりに換算（重量不明ならそのまま）
+		scale = np.where(weight > 0, 100.0 / np.where(weight > 0, weight, 1.0), 1.0)
+		raw = np.empty((n, len(TASTE_FIELDS) + len(NUTRIENT_FIELDS)))
+		for j, f in enumerate(TASTE_FIELDS):
+			raw[:, j] = col(store.tastes[f])
+		for j, f in enumerate(NUTRIENT_FIELDS):
+			raw[:, len(TASTE_FIELDS) + j] = col(store.nutrients[f]) * scale
+		keys = list(zip(store.food_types(), store.ids))
+		return keys, list(store.names_all), raw
+
+	def _normalize(self, raw):
+		"""欠損は列平均で補完し、列ごとに標準化(z-score)する"""
+		known = ~np.isnan(raw)
+		col_mean = np.where(known, raw, 0.0).sum(axis=0) / np.maximum(known.sum(axis=0), 1)
+		filled = np.where(known, raw, col_mean)
+		std = filled.std(axis=0)
+		std[std == 0] = 1.0
+		return (filled - filled.mean(axis=0)) / std
+
+	def refresh(self):
+		"""食品マスタに変更があれば行列を再構築する"""
+		self.store.refresh()
+		version = self.store.version
+		if version == self._version: return
+		keys, names, raw = self._load()
+		z = self._normalize(raw)
+		n_taste = len(TASTE_FIELDS)
+		for mode, mat in (('taste', z[:, :n_taste]), ('all', z)):
+			mat = np.ascontiguousarray(mat)
+			self._sq_norms[mode] = np.einsum('ij,ij->i', mat, mat)
+			norms = np.sqrt(self._sq_norms[mode])
+			norms[norms == 0] = 1.0
+			self._matrices[mode] = (mat, mat / norms[:, None])
+		self.keys, self.names = keys, names
+		self.offsets = {k: i for i, k in enumerate(keys)}
+		self._version = version
+
+	def nearest(self, food_type, food_id, k=5, metric='cosine', mode='taste'):
+		"""
+		指定食品に近い食品を k 件返す。
+		- metric: 'cosine'(類似度, 大きいほど近い) / 'euclidean'(距離, 小さいほど近い)
+		- mode: 'taste'(味覚のみ: 似た食品) / 'all'(味覚+栄養素: 代替食品)
+		"""
+		self.refresh()
+		if food_type == 'OUT_EAT': food_type = 'PROCESSED'
+		row = self.offsets.get((food_type, food_id))
+		if row is None: return []
+
+		mat, unit = self._matrices[mode]
+		if metric == 'euclidean':
+			sq = self._sq_norms[mode]
+			scores = -np.sqrt(np.maximum(sq + sq[row] - 2.0 * (mat @ mat[row]), 0.0))
+		else:
+			scores = unit @ unit[row]
+		scores[row] = -np.inf  # 自分自身は除外
+
+		k = min(k, len(scores) - 1)
+		if k <= 0: return []
+		top = np.argpartition(-scores, k - 1)[:k]
+		top = top[np.argsort(-scores[top])]
+		return [{'type': self.keys[i][0], 'id': self.keys[i][1], 'name': self.names[i],
+			'score': float(-scores[i]) if metric == 'euclidean' else float(scores[i])} for i in top]
+
+	def show_similar_foods(self, master_mgr: MasterManager):
+		if not require_numpy("類似食品検索"): return
+		print("\n=== 似た食品・代替食品の検索 ===")
+		name = get_input("基準にする食品名")
+		candidates = master_mgr.find_food_master_fuzzy(name)
+		if not candidates:
+			print("食品マスタに見つかりません。")
+			return
+		for i, c in enumerate(candidates):
+			print(f"  {i+1}: {c['name']} [{c['type']}]")
+		sel = get_input("選択", cast_func=int)
+		if not 1 <= sel <= len(candidates): return
+		base = candidates[sel-1]
+
+		mode = 'all' if get_input("検索種類 (1:似た味の食品, 2:代替食品(味+栄養)) [def:1]", required=False) == '2' else 'taste'
+		metric = 'euclidean' if get_input("距離 (1:コサイン, 2:ユークリッド) [def:1]", required=False) == '2' else 'cosine'
+		k = get_input("件数 [def:5]", required=False, cast_func=int) or 5
+
+		results = self.nearest(base['type'], base['id'], k, metric, mode)
+		if not results:
+			print("該当なし")
+			return
+		print(f"\n>>> 「{base['name']}」に近い食品")
+		rep = ReportManager(self.db)
+		cols = [("食品名", 32, 'left'), ("種別", 10, 'left'), ("類似度" if metric == 'cosine' else "距離", 8, 'right')]
+		rep._print_header(cols)
+		for r in results:
+			rep._print_row([(r['name'], 32, 'left'), (r['type'], 10, 'left'), (f"{r['score']:.3f}", 8, 'right')])
 
-	def run(self):
+# ==========================================
+# 6. 献立計画 (期限優先の在庫消費計画)
+# ==========================================
+class MealPlanner:
+	"""
+	現在の在庫ロット(t_inventory)と1日の栄養目標から、今後N日間の消費量を提案する。
+	期限の早いロットから目標を満たすように割り当てる貪欲法を、累積和でロットをまとめて取る形で行列演算にしている。
+	期限内に食べきれない分と、栄養データが無く割り当てられないロットは予測廃棄(LOSS候補)として報告する。
+	提案は「予定」として t_meal_plans に保存し、その日が来たら1日ずつ順に consume_inventory と同じ形式
+	(食事ログ + SELF の消費明細 + 在庫の減算) で記録する。
+	"""
+	DEFAULT_TARGETS = {'energy_kcal': 2000.0, 'protein_g': 65.0, 'fat_g': 60.0, 'carb_g': 300.0, 'salt_equiv_g': 7.5}
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.db.cursor.execute("""
+			CREATE TABLE IF NOT EXISTS t_meal_plans (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				plan_date INTEGER NOT NULL,          -- 予定日 (日単位のシリアル値)
+				inventory_id INTEGER NOT NULL,
+				detail_id INTEGER NOT NULL,
+				amount REAL NOT NULL,                -- 予定の消費量
+				created_at REAL
+			)
+		""")
+		self.db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_meal_plans_date ON t_meal_plans(plan_date)")
+		self.db.conn.commit()
+
+	def _load_lots(self):
+		"""残量のある在庫ロットと、数量1あたりの栄養素行列を取得"""
+		per_qty_sql = ", ".join(f"{nutrient_per_qty_sql(f, 'td.food_type')} AS {f}" for f in NUTRIENT_FIELDS)
+		sql = f"""
+		SELECT
+			inv.id as inv_id,
+			inv.detail_id,
+			td.item_name_receipt,
+			inv.current_quantity,
+			COALESCE(td.limit_date, t.transaction_at + fu.shelf_life_days_guideline) as expiry_at,
+			{per_qty_sql}
+		FROM t_inventory inv
+		JOIN t_transaction_details td ON inv.detail_id = td.id
+		JOIN t_transactions t ON td.transaction_id = t.id
+		LEFT JOIN m_foods_measured fm ON td.food_id = fm.id AND td.food_type = 'MEASURED'
+		LEFT JOIN m_foods_universal fu ON td.food_id = fu.id AND td.food_type = 'UNIVERSAL'
+		LEFT JOIN m_foods_processed fp ON td.food_id = fp.id AND td.food_type IN ('PROCESSED', 'OUT_EAT')
+		WHERE inv.current_quantity > 0
+		"""
+		cur = self.db.cursor
+		cur.execute(sql)
+		rows = cur.fetchall()
+		return {
+			'inv_id': [r['inv_id'] for r in rows],
+			'detail_id': [r['detail_id'] for r in rows],
+			'name': [r['item_name_receipt'] for r in rows],
+			'qty': np.array([r['current_quantity'] for r in rows], dtype=float),
+			'expiry': np.array([r['expiry_at'] if r['expiry_at'] is not None else np.inf for r in rows], dtype=float),
+			'per_qty': np.array([[r[f] for f in NUTRIENT_FIELDS] for r in rows], dtype=float).reshape(len(rows), len(NUTRIENT_FIELDS)),
+		}
+
+	@staticmethod
+	def _fill(avail, per, room):
+		"""
+		並び順のロットを、栄養素ごとの残り枠 room を超えない範囲で割り当てる。
+		先頭から累積和で丸ごと取れるロットをまとめて取り、枠に当たったロットは枠まで取って、
+		その栄養素を含むロットを除いて続ける (繰り返しは栄養素の数+1回まで)。
+		戻り値: (ロットごとの量, 残りの枠)
+		"""
+		take = np.zeros(len(avail))
+		room = np.maximum(room, 0.0)
+		alive = avail > 0
+		while alive.any():
+			pos = np.flatnonzero(alive)
+			cum = np.cumsum(avail[pos, None] * per[pos], axis=0)
+			over = (cum > room + 1e-9).any(axis=1)
+			if not over.any():
+				take[pos] = avail[pos]
+				room = room - cum[-1]
+				break
+			j = int(np.argmax(over))
+			take[pos[:j]] = avail[pos[:j]]
+			if j: room = room - cum[j - 1]
+			p = per[pos[j]]
+			ratio = np.full(len(p), np.inf)
+			ratio[p > 0] = np.maximum(room[p > 0], 0.0) / p[p > 0]
+			bound = int(np.argmin(ratio))
+			amt = np.floor(min(avail[pos[j]], ratio[bound]) * 100) / 100
+			take[pos[j]] = amt
+			room = room - p * amt
+			alive[pos[:j + 1]] = False
+			alive &= per[:, bound] <= 0
+		return take, room
+
+	def plan(self, days, targets=None, start_serial=None, slack=0.1):
+		"""
+		N日分の消費計画を作る。
+		- targets: {栄養素カラム: 1日の目標値}。energy_kcal を満たすまで割り当て、
+		  他の栄養素は目標 x (1 + slack) を超えない範囲に抑える。
+		- その日が期限のロットは、廃棄を減らすため先に上限(目標 x (1 + slack))まで割り当てる。
+		- 日ごとの割り当ては前の日の割り当てを食べた前提で決まる。
+		戻り値: {'lots', 'start', 'days': [[(ロット番号, 量), ...], ...], 'intake': 日別栄養素, 'loss': [(ロット番号, 量)]}
+		"""
+		if days < 1: raise ValueError("計画日数は1以上を指定してください")
+		targets = {**self.DEFAULT_TARGETS, **(targets or {})}
+		goal = np.array([targets[f] for f in NUTRIENT_FIELDS], dtype=float)
+		limit = goal * (1.0 + slack)
+		kcal = NUTRIENT_FIELDS.index('energy_kcal')
+
+		lots = self._load_lots()
+		start = int(start_serial if start_serial is not None else datetime_to_serial(datetime.datetime.now()))
+		remaining = lots['qty'].copy()
+		per_qty = lots['per_qty']
+		expiry = lots['expiry']
+		has_nutrition = per_qty[:, kcal] > 0
+
+		# 期限の早い順（期限なしは最後）。期限切れのロットは計画対象外
+		order = np.argsort(expiry, kind='stable')
+		order = order[expiry[order] >= start]
+		# 栄養データがない食品は目標に数えられないので割り当てない (期限内に残れば予測廃棄)
+		candidates = order[has_nutrition[order]]
+
+		plan_days = []
+		intake = np.zeros((days, len(NUTRIENT_FIELDS)))
+		for d in range(days):
+			day_start = start + d
+			usable = candidates[(expiry[candidates] >= day_start) & (remaining[candidates] > 0)]
+			today = usable[expiry[usable] < day_start + 1]
+			later = usable[expiry[usable] >= day_start + 1]
+			# 当日が期限のロットは上限まで、それ以外はエネルギー目標の残りまで
+			take_today, room = self._fill(remaining[today], per_qty[today], limit)
+			room[kcal] = min(room[kcal], goal[kcal] - (limit[kcal] - room[kcal]))
+			take_later, _ = self._fill(remaining[later], per_qty[later], room)
+
+			idx = np.concatenate([today, later])
+			take = np.concatenate([take_today, take_later])
+			picked = take > 0
+			idx, take = idx[picked], take[picked]
+			remaining[idx] -= take
+			intake[d] = take @ per_qty[idx]
+			plan_days.append(list(zip(idx.tolist(), take.tolist())))
+
+		# 計画期間内に期限を迎えて残るものは予測廃棄
+		horizon_end = start + days
+		loss = [(i, remaining[i]) for i in order if expiry[i] < horizon_end and remaining[i] > 0]
+		return {'lots': lots, 'start': start, 'days': plan_days, 'intake': intake, 'loss': loss}
+
+	def save_plan(self, plan, day_count):
+		"""
+		計画の先頭から day_count 日分を予定として保存する (保存済みの予定は置き換える)。
+		各日の割り当ては前日までを食べた前提なので、途中の日だけを保存することはしない。
+		"""
+		lots = plan['lots']
+		now = datetime_to_serial(datetime.datetime.now())
+		rows = [(plan['start'] + d, lots['inv_id'][i], lots['detail_id'][i], float(amt), now)
+			for d, picks in enumerate(plan['days'][:day_count]) for i, amt in picks]
+		cur = self.db.cursor
+		cur.execute("DELETE FROM t_meal_plans")
+		cur.executemany("INSERT INTO t_meal_plans (plan_date, inventory_id, detail_id, amount, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+		self.db.conn.commit()
+		return len(rows)
+
+	def pending_days(self):
+		"""保存済みの予定 [(予定日, 件数)]"""
+		self.db.cursor.execute("SELECT plan_date, COUNT(*) as n FROM t_meal_plans GROUP BY plan_date ORDER BY plan_date")
+		return [(r['plan_date'], r['n']) for r in self.db.cursor.fetchall()]
+
+	def record_next_day(self, now_serial=None):
+		"""
+		予定の最も早い日を食べたものとして記録する (1トランザクション)。その日がまだ来ていなければ記録しない。
+		予定を立てた後に在庫が減っていれば、今の残量までにする。
+		戻り値: (予定日, 記録件数) / 記録できる日が無ければ None
+		"""
+		now_serial = now_serial if now_serial is not None else datetime_to_serial(datetime.datetime.now())
+		cur = self.db.cursor
+		cur.execute("SELECT MIN(plan_date) FROM t_meal_plans")
+		plan_date = cur.fetchone()[0]
+		if plan_date is None or plan_date > now_serial: return None
+		cur.execute("""
+			SELECT p.inventory_id, p.detail_id, MIN(p.amount, inv.current_quantity) as amount
+			FROM t_meal_plans p JOIN t_inventory inv ON inv.id = p.inventory_id
+			WHERE p.plan_date = ? AND inv.current_quantity > 0
+			ORDER BY p.id
+		""", (plan_date,))
+		picks = cur.fetchall()
+		eaten_at = min(plan_date + 0.5, now_serial)  # 当日の正午 (今日の分は現在時刻まで)
+		if picks:
+			cur.execute("INSERT INTO t_meal_logs (eaten_at, note) VALUES (?, '献立計画')", (eaten_at,))
+			mid = cur.lastrowid
+			cur.executemany(
+				"INSERT INTO t_meal_details (meal_name, meal_id, inventory_id, detail_id, amount_consumed, consume_type) VALUES ('献立計画', ?, ?, ?, ?, 'SELF')",
+				[(mid, r['inventory_id'], r['detail_id'], r['amount']) for r in picks])
+			cur.executemany(
+				"UPDATE t_inventory SET current_quantity = current_quantity - ?, updated_at = ? WHERE id = ?",
+				[(r['amount'], eaten_at, r['inventory_id']) for r in picks])
+		cur.execute("DELETE FROM t_meal_plans WHERE plan_date = ?", (plan_date,))
+		self.db.conn.commit()
+		return plan_date, len(picks)
+
+	def show_meal_plan(self):
+		print("\n=== 献立計画 (期限優先) ===")
+		pending = self.pending_days()
+		if pending:
+			print("保存済みの予定: " + ", ".join(f"{format_serial(d, '%m/%d')}({n}件)" for d, n in pending))
+		print(" 1. 計画を作る")
+		print(" 2. 予定の次の日を食べたものとして記録")
+		print(" 3. 保存済みの予定を破棄")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel == '1':
+			self._make_plan()
+		elif sel == '2':
+			done = self.record_next_day()
+			if done is None: print("記録できる予定はありません (予定日がまだ来ていません)。")
+			else: print(f"{format_serial(done[0], '%m/%d')} の予定から {done[1]}件の消費を記録しました")
+		elif sel == '3':
+			self.db.cursor.execute("DELETE FROM t_meal_plans")
+			self.db.conn.commit()
+			print("予定を破棄しました。")
+
+	def _make_plan(self):
+		if not require_numpy("献立計画"): return
+		days = get_input("計画日数 [def:3]", required=False, cast_func=int) or 3
+		if days < 1:
+			print("計画日数は1以上を指定してください。")
+			return
+		# 既定値は登録済みの栄養目標
+		targets = {f: g[0] for f, g in ReportManager(self.db).load_nutrition_goals().items()}
+		for f in NUTRIENT_FIELDS:
+			val = get_input(f"1日の目標 {NUTRIENT_LABELS[f]} [def:{targets[f]:g}]", required=False, cast_func=float)
+			if val is not None: targets[f] = val
+
+		plan = self.plan(days, targets)
+		lots = plan['lots']
+		if not lots['inv_id']:
+			print("現在、在庫はありません。")
+			return
+
+		rep = ReportManager(self.db)
+		for d, picks in enumerate(plan['days']):
+			intake = plan['intake'][d]
+			print(f"\n[{format_serial(plan['start'] + d, '%m/%d')}] {int(intake[0])}kcal P{intake[1]:.1f} F{intake[2]:.1f} C{intake[3]:.1f} 塩{intake[4]:.1f}")
+			if not picks:
+				print("  (割り当てなし)")
+				continue
+			rep._print_header([("在庫ID", 6, 'right'), ("商品名", 32, 'left'), ("消費量", 8, 'right'), ("期限", 6, 'left')])
+			for i, amt in picks:
+				exp = lots['expiry'][i]
+				rep._print_row([(str(lots['inv_id'][i]), 6, 'right'), (lots['name'][i], 32, 'left'), (f"{amt:g}", 8, 'right'),
+					(format_serial(exp, '%m/%d') if np.isfinite(exp) else "---", 6, 'left')])
+
+		if plan['loss']:
+			print("\n[予測廃棄] 計画期間内に食べきれない在庫 (栄養データの無いものを含む)")
+			for i, amt in plan['loss']:
+				print(f"  ID:{lots['inv_id'][i]} {lots['name'][i]} 残り{amt:g} (期限 {format_serial(lots['expiry'][i], '%m/%d')})")
+
+		sel = get_input(f"予定として保存する日数 (1-{days}: 初日からその日まで, Enterで保存しない)", required=False, cast_func=int)
+		if sel and 1 <= sel <= days:
+			n = self.save_plan(plan, sel)
+			print(f"{n}件の消費を予定として保存しました (食べた日に「予定の次の日を記録」で在庫に反映します)")
+
+# ==========================================
+# 7. 支出キューブ (月 x カテゴリ x ブランド x 公開区分)
+# ==========================================
+class SpendingCube:
+	"""
+	明細の税込金額を (年月, カテゴリ/food_type, ブランド, 公開区分) で事前集計したテーブル。
+	取引保存時に apply_transaction で差分更新し、rebuild で全件から1パスで作り直す。
+	ADJUSTMENT(残高調整)は赤字黒字の算出に使わないため集計対象外。
+	NULLは主キーで比較できないため、カテゴリ・ブランドなしは 0 で保持する。
+	"""
+	DIMENSIONS = {
+		'month': 'c.month',
+		'category': 'c.category_id, c.food_type',
+		'brand': 'c.brand_id',
+		'public': 'c.is_public',
+	}
+
+	def __init__(self, db: Database):
+		self.db = db
+		self._ensure_table()
+
+	def _ensure_table(self):
+		cur = self.db.cursor
+		cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_spending_cube'")
+		if cur.fetchone(): return
+		cur.execute("""
+			CREATE TABLE t_spending_cube (
+				month TEXT NOT NULL,                  -- YYYYMM
+				category_id INTEGER NOT NULL,         -- 0=カテゴリなし(食品など)
+				food_type TEXT NOT NULL,
+				brand_id INTEGER NOT NULL,            -- 0=店舗なし
+				is_public INTEGER NOT NULL,
+				amount_jpy INTEGER NOT NULL DEFAULT 0, -- 税込金額の合計
+				line_count INTEGER NOT NULL DEFAULT 0,
+				PRIMARY KEY (month, category_id, food_type, brand_id, is_public)
+			) WITHOUT ROWID
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_spending_cube_brand ON t_spending_cube(brand_id, month)")
+		self.rebuild()
+
+	def _select_sql(self, where, src=None):
+		src = src or {'t_transactions': 't_transactions', 't_transaction_details': 't_transaction_details'}
+		return f"""
+			SELECT
+				{serial_month_sql('t.transaction_at')} as month,
+				COALESCE(td.category_id, 0) as category_id,
+				COALESCE(td.food_type, 'NONE') as food_type,
+				COALESCE(sb.brand_id, 0) as brand_id,
+				COALESCE(t.is_public, 1) as is_public,
+				SUM({LINE_GROSS_SQL}) as amount_jpy,
+				COUNT(*) as line_count
+			FROM {src['t_transaction_details']} td
+			JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+			LEFT JOIN m_store_branches sb ON t.branch_id = sb.id
+			WHERE COALESCE(td.food_type, 'NONE') != 'ADJUSTMENT' AND {where}
+			GROUP BY 1, 2, 3, 4, 5
+		"""
+
+	def rebuild(self):
+		"""全明細(アーカイブ済みの年を含む)から1パスで再集計する"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details'])
+		cur = self.db.cursor
+		cur.execute("DELETE FROM t_spending_cube")
+		cur.execute(f"INSERT INTO t_spending_cube {self._select_sql('1', src)}")
+		self.db.conn.commit()
+
+	def apply_transaction(self, trans_id, sign=1):
+		"""
+		1取引分の明細をキューブに加算(sign=1)または減算(sign=-1)する。
+		コミットは呼び出し側の取引保存と同じトランザクションで行う。
+		"""
+		self.apply_transactions([trans_id], sign)
+
+	def apply_transactions(self, trans_ids, sign=1):
+		"""複数取引分の明細を1文でまとめて加算・減算する (一括登録用)"""
+		self.db.cursor.execute(f"""
+			INSERT INTO t_spending_cube (month, category_id, food_type, brand_id, is_public, amount_jpy, line_count)
+			SELECT month, category_id, food_type, brand_id, is_public, ? * amount_jpy, ? * line_count
+			FROM ({self._select_sql(TRANSACTION_IDS_SQL)}) WHERE true
+			ON CONFLICT (month, category_id, food_type, brand_id, is_public) DO UPDATE SET
+				amount_jpy = amount_jpy + excluded.amount_jpy,
+				line_count = line_count + excluded.line_count
+		""", (sign, sign, json.dumps(list(trans_ids))))
+
+	def query(self, group_by, month_from=None, month_to=None, filters=None):
+		"""
+		キューブをスライスして集計する。
+		- group_by: DIMENSIONS のキーのリスト (例: ['month', 'category'])
+		- filters: {'category_id':.., 'food_type':.., 'brand_id':.., 'is_public':..} で絞り込み（ドリルダウン）
+		amount_jpy は全明細の合計。行ごとに INCOME カテゴリ(給与・還元など)の分を income_jpy、
+		それ以外(支出)を spend_jpy に分けて返す。
+		"""
+		cols = ", ".join(self.DIMENSIONS[g] for g in group_by)
+		labels = ""
+		if 'category' in group_by: labels += "cat.name as category_name, cat.type as category_type, "
+		if 'brand' in group_by: labels += "b.name as brand_name, "
+		where, params = ["1"], []
+		if month_from: where.append("c.month >= ?"); params.append(month_from)
+		if month_to: where.append("c.month <= ?"); params.append(month_to)
+		for col, val in (filters or {}).items():
+			where.append(f"c.{col} = ?"); params.append(val)
+		sql = f"""
+			SELECT {cols}, {labels}
+				SUM(c.amount_jpy) as amount_jpy, SUM(c.line_count) as line_count,
+				SUM(CASE WHEN cat.type = 'INCOME' THEN 0 ELSE c.amount_jpy END) as spend_jpy,
+				SUM(CASE WHEN cat.type = 'INCOME' THEN c.amount_jpy ELSE 0 END) as income_jpy
+			FROM t_spending_cube c
+			LEFT JOIN m_categories cat ON c.category_id = cat.id
+			LEFT JOIN m_brands b ON c.brand_id = b.id
+			WHERE {" AND ".join(where)}
+			GROUP BY {cols}
+			HAVING SUM(c.line_count) != 0
+			ORDER BY {cols}
+		"""
+		cur = self.db.cursor
+		cur.execute(sql, params)
+		return cur.fetchall()
+
+	@staticmethod
+	def category_label(row):
+		if row['category_id']: return row['category_name'] or f"カテゴリ{row['category_id']}"
+		return FOOD_TYPE_LABELS.get(row['food_type'], row['food_type'])
+
+	def show_spending_report(self):
+		print("\n=== 支出集計 ===")
+		month_from = get_input("開始年月(YYYYMM) [def:全期間]", required=False)
+		month_to = get_input("終了年月(YYYYMM) [def:全期間]", required=False)
+		print("集計軸: 1.月, 2.カテゴリ, 3.ブランド, 4.公開区分 (複数はカンマ区切り 例: 1,2)")
+		axis_map = {'1': 'month', '2': 'category', '3': 'brand', '4': 'public'}
+		axes_in = get_input("集計軸 [def:1,2]", required=False) or "1,2"
+		group_by = [axis_map[a.strip()] for a in axes_in.split(",") if a.strip() in axis_map] or ['month', 'category']
+
+		filters = {}
+		brand = get_input("ブランドIDで絞り込み (Enterでなし)", required=False, cast_func=int)
+		if brand is not None: filters['brand_id'] = brand
+
+		rows = self.query(group_by, month_from, month_to, filters)
+		if not rows:
+			print("該当なし")
+			return
+
+		headers = {'month': ("年月", 7, 'left'), 'category': ("カテゴリ", 20, 'left'),
+			'brand': ("ブランド", 20, 'left'), 'public': ("公開", 4, 'center')}
+		rep = ReportManager(self.db)
+		rep._print_header([headers[g] for g in group_by] + [("件数", 6, 'right'), ("支出", 12, 'right'), ("収入", 12, 'right')])
+		total, income = 0, 0
+		for r in rows:
+			cells = []
+			for g in group_by:
+				if g == 'month': val = r['month']
+				elif g == 'category': val = self.category_label(r)
+				elif g == 'brand': val = r['brand_name'] or "---"
+				else: val = "公" if r['is_public'] else "私"
+				cells.append((val,) + headers[g][1:])
+			rep._print_row(cells + [(str(r['line_count']), 6, 'right'), (f"{int(r['spend_jpy']):,}", 12, 'right'),
+				(f"{int(r['income_jpy']):,}" if r['income_jpy'] else "---", 12, 'right')])
+			total += r['spend_jpy']
+			income += r['income_jpy']
+		print(f"\n 支出合計: {int(total):,} 円")
+		if income: print(f" 収入合計: {int(income):,} 円")
+
+# ==========================================
+# 8. 購入履歴の全文検索 (FTS5 trigram)
+# ==========================================
+class ReceiptSearch:
+	"""
+	明細の商品名・産地と、取引名・店舗名(ブランド+支店)を FTS5 の trigram トークナイザで索引する。
+	日本語は単語区切りがないため trigram を使う。rowid = t_transaction_details.id で、
+	明細・取引・店舗・ブランドの変更はトリガーで同期する。
+	年別アーカイブへ移した明細も索引に残し (archive_year が移した後に入れ直す)、検索結果は sources() で引く。
+	trigram は3文字未満の語を MATCH できないため、短い語は同じ索引への LIKE で絞り込む。
+	"""
+	PAGE_SIZE = 20
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.available = self._ensure_index()
+
+	@staticmethod
+	def _rows_sql(where, src=None):
+		src = src or {'t_transactions': 't_transactions', 't_transaction_details': 't_transaction_details'}
+		return f"""
+			INSERT INTO fts_receipt_items (rowid, item_name, origin_area, transaction_name, store_name)
+			SELECT td.id, td.item_name_receipt, td.origin_area, t.transaction_name,
+				TRIM(COALESCE(b.name, '') || ' ' || COALESCE(sb.branch_name, ''))
+			FROM {src['t_transaction_details']} td
+			LEFT JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+			LEFT JOIN m_store_branches sb ON t.branch_id = sb.id
+			LEFT JOIN m_brands b ON sb.brand_id = b.id
+			WHERE {where};
+		"""
+
+	def _ensure_index(self):
+		cur = self.db.cursor
+		cur.execute("SELECT 1 FROM sqlite_master WHERE name='fts_receipt_items'")
+		created = cur.fetchone() is None
+		try:
+			cur.execute("""
+				CREATE VIRTUAL TABLE IF NOT EXISTS fts_receipt_items
+				USING fts5(item_name, origin_area, transaction_name, store_name, tokenize='trigram')
+			""")
+		except sqlite3.OperationalError as e:
+			print(f"[Warning] 全文検索を利用できません (FTS5 trigram 非対応の SQLite): {e}")
+			return False
+
+		# (トリガー名, 対象, 該当明細を特定する条件)
+		resync = [
+			('trg_fts_tx_update', "UPDATE OF transaction_name, branch_id ON t_transactions", "td.transaction_id = NEW.id"),
+			('trg_fts_branch_update', "UPDATE OF branch_name, brand_id ON m_store_branches", "t.branch_id = NEW.id"),
+			('trg_fts_brand_update', "UPDATE OF name ON m_brands", "sb.brand_id = NEW.id"),
+		]
+		cur.execute(f"""
+			CREATE TRIGGER IF NOT EXISTS trg_fts_detail_insert AFTER INSERT ON t_transaction_details
+			BEGIN {self._rows_sql("td.id = NEW.id")} END
+		""")
+		cur.execute(f"""
+			CREATE TRIGGER IF NOT EXISTS trg_fts_detail_update
+			AFTER UPDATE OF item_name_receipt, origin_area, transaction_id ON t_transaction_details
+			BEGIN
+				DELETE FROM fts_receipt_items WHERE rowid = OLD.id;
+				{self._rows_sql("td.id = NEW.id")}
+			END
+		""")
+		cur.execute("""
+			CREATE TRIGGER IF NOT EXISTS trg_fts_detail_delete AFTER DELETE ON t_transaction_details
+			BEGIN DELETE FROM fts_receipt_items WHERE rowid = OLD.id; END
+		""")
+		for name, target, cond in resync:
+			cur.execute(f"""
+				CREATE TRIGGER IF NOT EXISTS {name} AFTER {target}
+				BEGIN
+					DELETE FROM fts_receipt_items WHERE rowid IN (
+						SELECT td.id FROM t_transaction_details td
+						LEFT JOIN t_transactions t ON td.transaction_id = t.id
+						LEFT JOIN m_store_branches sb ON t.branch_id = sb.id
+						WHERE {cond});
+					{self._rows_sql(cond)}
+				END
+			""")
+		if created: self.rebuild()
+		self.db.conn.commit()
+		return True
+
+	def rebuild(self):
+		"""索引を全明細(アーカイブ済みの年を含む)から作り直す"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details'])
+		cur = self.db.cursor
+		cur.execute("DELETE FROM fts_receipt_items")
+		cur.execute(self._rows_sql("1", src))
+		self.db.conn.commit()
+
+	def search(self, query, page=0, page_size=None):
+		"""
+		空白区切りの語を全て含む明細を返す（AND検索）。
+		3文字以上の語は MATCH で bm25 順位付け、3文字未満の語は LIKE で絞り込む。
+		戻り値: (行リスト, 総件数)
+		"""
+		page_size = page_size or self.PAGE_SIZE
+		terms = [t for t in query.split() if t]
+		if not terms: return [], 0
+		long_terms = [t for t in terms if len(t) >= 3]
+		short_terms = [t for t in terms if len(t) < 3]
+
+		where, params = [], []
+		if long_terms:
+			where.append("fts_receipt_items MATCH ?")
+			params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+		for t in short_terms:
+			pattern = "%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+			where.append("(" + " OR ".join(f"f.{c} LIKE ? ESCAPE '\\'" for c in ('item_name', 'origin_area', 'transaction_name', 'store_name')) + ")")
+			params += [pattern] * 4
+		where_sql = " AND ".join(where)
+		rank_sql = "bm25(fts_receipt_items)" if long_terms else "0"
+
+		cur = self.db.cursor
+		cur.execute(f"SELECT COUNT(*) FROM fts_receipt_items f WHERE {where_sql}", params)
+		total = cur.fetchone()[0]
+		# アーカイブ済みの明細はその年のファイルにあるので、台帳本体とアーカイブごとに引いて UNION ALL する
+		archives = ArchiveManager(self.db)
+		parts = [f"""
+			SELECT td.id as detail_id, t.id as trans_id, t.transaction_at, f.store_name,
+				td.item_name_receipt, td.unit_price_ex_tax, td.quantity, td.tax_rate, td.origin_area,
+				{LINE_GROSS_SQL} as gross, {rank_sql} as rank
+			FROM fts_receipt_items f
+			JOIN {schema}.t_transaction_details td ON td.id = f.rowid
+			LEFT JOIN {schema}.t_transactions t ON td.transaction_id = t.id
+			WHERE {where_sql}
+		""" for schema in ['main'] + [x for x in archives.schemas() if archives._columns(x, 't_transaction_details')]]
+		cur.execute(" UNION ALL ".join(parts) + " ORDER BY rank, transaction_at DESC LIMIT ? OFFSET ?",
+			params * len(parts) + [page_size, page * page_size])
+		return cur.fetchall(), total
+
+	def show_search(self):
+		if not self.available:
+			print("全文検索は利用できません。")
+			return
+		print("\n=== 購入履歴の検索 ===")
+		query = get_input("検索語 (空白区切りでAND)")
+		rep = ReportManager(self.db)
+		page = 0
+		while True:
+			rows, total = self.search(query, page)
+			if not rows:
+				print("該当なし")
+				return
+			pages = (total + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+			print(f"\n--- {total}件中 {page * self.PAGE_SIZE + 1}-{page * self.PAGE_SIZE + len(rows)}件 ({page + 1}/{pages}ページ) ---")
+			rep._print_header([("日付", 10, 'left'), ("店舗", 24, 'left'), ("商品名", 24, 'left'), ("単価", 8, 'right'), ("数量", 6, 'right'), ("税込", 8, 'right')])
+			for r in rows:
+				rep._print_row([
+					(format_serial(r['transaction_at'], "%Y/%m/%d"), 10, 'left'),
+					(r['store_name'] or "---", 24, 'left'),
+					(r['item_name_receipt'], 24, 'left'),
+					(f"{r['unit_price_ex_tax']:g}", 8, 'right'),
+					(f"{r['quantity']:g}", 6, 'right'),
+					(f"{r['gross']:,}", 8, 'right'),
+				])
+			nav = (get_input("n:次へ, p:前へ, Enter:戻る", required=False) or "").lower()
+			if nav == 'n' and page + 1 < pages: page += 1
+			elif nav == 'p' and page > 0: page -= 1
+			elif nav not in ('n', 'p'): return
+
+# ==========================================
+# 9. 明細入力の補完 (購入履歴)
+# ==========================================
+class ReceiptSuggestIndex:
+	"""
+	正規化した商品名(レシート表記) -> 前回の カテゴリ/food_type/food_id・単価・税率・行き先 の索引。
+	店舗(branch_id)ごとの値があればそれを優先する。接頭辞検索はメモリ上のトライ木で行う。
+	初回の検索時に履歴から読み込み、以後は取引保存時に add_transaction で追加する。
+	"""
+	MAX_CANDIDATES = 5
+
+	def __init__(self, db: Database):
+		self.db = db
+		self._loaded = False
+		self._trie = {}      # 文字 -> 子ノード。'$' に [(最終明細ID, 正規化名)] (新しい順) を保持
+		self._entries = {}   # 正規化名 -> {None: 全店舗の最新, branch_id: 店舗別の最新}
+
+	@staticmethod
+	def normalize(name):
+		"""全角半角・大文字小文字・空白の違いを吸収する"""
+		return "".join(unicodedata.normalize('NFKC', name or "").lower().split())
+
+	def _select_sql(self, where):
+		# 商品名×店舗ごとの最新明細だけを取り出す
+		return f"""
+			SELECT td.id, td.item_name_receipt, t.branch_id, td.category_id, td.food_type, td.food_id,
+				td.unit_price_ex_tax, td.tax_rate, td.destination, td.content_amount_per_unit, td.origin_area
+			FROM t_transaction_details td
+			JOIN t_transactions t ON td.transaction_id = t.id
+			WHERE td.id IN (
+				SELECT MAX(td.id) FROM t_transaction_details td
+				JOIN t_transactions t ON td.transaction_id = t.id
+				WHERE td.item_name_receipt IS NOT NULL AND COALESCE(td.food_type, 'NONE') != 'ADJUSTMENT' AND {where}
+				GROUP BY td.item_name_receipt, t.branch_id
+			)
+			ORDER BY td.id
+		"""
+
+	def _add_row(self, r):
+		key = self.normalize(r['item_name_receipt'])
+		if not key: return
+		sugg = {
+			'detail_id': r['id'], 'item_name_receipt': r['item_name_receipt'],
+			'category_id': r['category_id'], 'food_type': r['food_type'], 'food_id': r['food_id'],
+			'price': r['unit_price_ex_tax'] or 0, 'tax': r['tax_rate'], 'dest': r['destination'],
+			'content': r['content_amount_per_unit'], 'origin': r['origin_area'],
+		}
+		slots = self._entries.setdefault(key, {})
+		for slot in (None, r['branch_id']):
+			if slot in slots and slots[slot]['detail_id'] > r['id']: continue
+			slots[slot] = sugg
+
+		# 経路上の各ノードに「その接頭辞で始まる最近の商品名」を上位数件だけ保持
+		node = self._trie
+		for ch in key:
+			node = node.setdefault(ch, {})
+			top = node.setdefault('$', [])
+			last_id = max([r['id']] + [t[0] for t in top if t[1] == key])
+			top[:] = [t for t in top if t[1] != key]
+			top.append((last_id, key))
+			top.sort(reverse=True)
+			del top[self.MAX_CANDIDATES:]
+
+	def _ensure_loaded(self):
+		if self._loaded: return
+		cur = self.db.cursor
+		cur.execute(self._select_sql("1"))
+		for r in cur.fetchall():
+			self._add_row(r)
+		self._loaded = True
+
+	def add_transaction(self, trans_id):
+		"""保存した取引の明細を索引に反映（未読込なら次回の読込時に含まれるので何もしない）"""
+		self.add_transactions([trans_id])
+
+	def add_transactions(self, trans_ids):
+		if not self._loaded: return
+		cur = self.db.cursor
+		cur.execute(self._select_sql(TRANSACTION_IDS_SQL), (json.dumps(list(trans_ids)),))
+		for r in cur.fetchall():
+			self._add_row(r)
+
+	def lookup(self, prefix, branch_id=None):
+		"""接頭辞に一致する商品の補完候補 (完全一致を先頭、以降は新しい順)"""
+		self._ensure_loaded()
+		key = self.normalize(prefix)
+		node = self._trie
+		for ch in key:
+			node = node.get(ch)
+			if node is None: return []
+		names = [name for _, name in node.get('$', []) if name != key]
+		if key in self._entries: names.insert(0, key)
+		result = []
+		for name in names:
+			slots = self._entries[name]
+			result.append(slots.get(branch_id) or slots[None])
+		return result
+
+	def choose(self, item_name, branch_id=None):
+		"""候補を表示して選ばせる。Enter で補完を使わない"""
+		candidates = self.lookup(item_name, branch_id)
+		if not candidates: return None
+		cur = self.db.cursor
+		cur.execute("SELECT id, name FROM m_categories")
+		cat_names = {r['id']: r['name'] for r in cur.fetchall()}
+		dest_map = {'EAT_NOW': '即食', 'FRIDGE': '冷蔵', 'FREEZER': '冷凍', 'PANTRY': '常温', 'GIFT': '譲渡'}
+		print("  [履歴からの候補]")
+		for i, c in enumerate(candidates):
+			kind = cat_names.get(c['category_id']) if c['category_id'] else FOOD_TYPE_LABELS.get(c['food_type'], "その他")
+			print(f"  {i+1}: {c['item_name_receipt']} ({kind}) {c['price']:g}円 税{c['tax'] * 100:g}% {dest_map.get(c['dest'], '')}")
+		sel = get_input("  候補番号 (Enterで手入力)", required=False)
+		if sel and sel.isdigit() and 1 <= int(sel) <= len(candidates):
+			return candidates[int(sel) - 1]
+		return None
+
+# ==========================================
+# 10. バックアップ・台帳間同期
+# ==========================================
+class LedgerSync:
+	"""
+	- バックアップ: SQLite のオンラインバックアップAPIで、数百ページずつ分割してコピーする。
+	- 変更フィード: 台帳テーブルの変更をトリガーで t_changelog に記録し、
+	  同期先ごと・テーブルごとの最終送信位置(t_sync_state)以降に変わった行だけを相手の台帳へ送る。
+	行は t_sync_ids の端末共通ID (作成した端末ID:その端末での行ID) で対応付け、受け取った側では
+	自分の行IDを振り直して外部キーも付け替える。両方の端末で別々に作った行が同じ行IDでも衝突しない。
+	同期できるのは同じ台帳から複製した台帳同士のみ (identity_root が一致すること)。
+	残高(t_wallet_balances)と在庫の残量(t_inventory.current_quantity)は送らず、受け取った決済・消費明細から作り直す。
+	受け取った変更は送信元の端末IDを origin として記録し、送り返さない。
+	変更ログと端末共通IDのトリガーは最初の同期先を作った時に張る。同期先の無い台帳には張らない (ログが溜まらない)。
+	"""
+	# 親テーブルから順に並べる (削除は逆順)
+	SYNC_TABLES = [
+		'm_currencies', 't_currency_rates', 'm_wallets',
+		'm_foods_universal', 'm_foods_measured', 'm_foods_processed',
+		'm_brands', 'm_store_branches', 'm_categories',
+		't_transactions', 't_transaction_details', 't_payments',
+		't_inventory', 't_meal_logs', 't_meal_details',
+	]
+	# スキーマに外部キーとして書かれていない参照 (food_id は food_type で参照先が変わるため別扱い)
+	EXTRA_REFERENCES = {'t_meal_details': {'inventory_id': 't_inventory'}}
+	BACKUP_PAGES = 256
+
+	def __init__(self, db: Database):
+		self.db = db
+		self._ensure_tables()
+
+	def _ensure_tables(self):
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_changelog (
+				seq INTEGER PRIMARY KEY AUTOINCREMENT,
+				table_name TEXT NOT NULL,
+				row_id INTEGER NOT NULL,
+				op TEXT CHECK(op IN ('I', 'U', 'D')) NOT NULL,
+				origin TEXT                          -- NULL=この端末での変更, それ以外=同期で受け取った送信元端末ID
+			)
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_changelog_table ON t_changelog(table_name, seq)")
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_sync_state (
+				peer_id TEXT NOT NULL,               -- 同期先の端末ID
+				table_name TEXT NOT NULL,
+				last_seq INTEGER NOT NULL,           -- 送信済みの t_changelog.seq
+				synced_at REAL,
+				PRIMARY KEY (peer_id, table_name)
+			)
+		""")
+		cur.execute("CREATE TABLE IF NOT EXISTS t_sync_meta (key TEXT PRIMARY KEY, value TEXT)")
+		cur.execute("INSERT OR IGNORE INTO t_sync_meta (key, value) VALUES ('device_id', ?)", (uuid.uuid4().hex,))
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_sync_ids (
+				table_name TEXT NOT NULL,
+				local_id INTEGER NOT NULL,           -- この台帳での行ID
+				gid TEXT NOT NULL,                   -- 端末共通ID (削除後も残して削除の送信に使う)
+				PRIMARY KEY (table_name, local_id),
+				UNIQUE (table_name, gid)
+			) WITHOUT ROWID
+		""")
+		# 残高スナップショットは同期しない (受け取った決済から作り直す)
+		for op in ('insert', 'update', 'delete'):
+			cur.execute(f"DROP TRIGGER IF EXISTS trg_log_t_wallet_balances_{op}")
+		if not self._has_peers(self.db): self._remove_feed(self.db)
+		self.db.conn.commit()
+
+	@staticmethod
+	def _has_peers(db):
+		db.cursor.execute("SELECT 1 FROM t_sync_state LIMIT 1")
+		return db.cursor.fetchone() is not None
+
+	def _install_feed(self, db):
+		"""変更ログと端末共通IDのトリガーを張り、まだIDの無い既存の行に端末共通IDを振る (張り済みなら何もしない)"""
+		cur = db.cursor
+		cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_gid_%'")
+		if cur.fetchone()[0] == len(self.SYNC_TABLES): return
+		device = self.device_id(db)
+		for table in self.SYNC_TABLES:
+			for op, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+				cur.execute(f"""
+					CREATE TRIGGER IF NOT EXISTS trg_log_{table}_{op.lower()}
+					AFTER {op} ON {table}
+					BEGIN
+						INSERT INTO t_changelog (table_name, row_id, op) VALUES ('{table}', {ref}.id, '{op[0]}');
+					END
+				""")
+			cur.execute(f"""
+				CREATE TRIGGER IF NOT EXISTS trg_gid_{table}
+				AFTER INSERT ON {table}
+				BEGIN
+					INSERT OR IGNORE INTO t_sync_ids (table_name, local_id, gid)
+					VALUES ('{table}', NEW.id, (SELECT value FROM t_sync_meta WHERE key = 'device_id') || ':' || NEW.id);
+				END
+			""")
+			cur.execute(f"INSERT OR IGNORE INTO t_sync_ids (table_name, local_id, gid) SELECT '{table}', id, ? || ':' || id FROM {table}", (device,))
+		# 複製した台帳はこの対応表と identity_root を引き継ぐ
+		cur.execute("INSERT OR IGNORE INTO t_sync_meta (key, value) VALUES ('identity_root', ?)", (uuid.uuid4().hex,))
+		db.conn.commit()
+
+	def _remove_feed(self, db):
+		"""同期先が無い間はトリガーを外し、送る相手の無い変更ログを消す (端末共通IDの対応表は残す)"""
+		cur = db.cursor
+		for table in self.SYNC_TABLES:
+			for op in ('insert', 'update', 'delete'):
+				cur.execute(f"DROP TRIGGER IF EXISTS trg_log_{table}_{op}")
+			cur.execute(f"DROP TRIGGER IF EXISTS trg_gid_{table}")
+		cur.execute("DELETE FROM t_changelog")
+
+	@staticmethod
+	def device_id(db):
+		db.cursor.execute("SELECT value FROM t_sync_meta WHERE key = 'device_id'")
+		return db.cursor.fetchone()[0]
+
+	@staticmethod
+	def identity_root(db):
+		db.cursor.execute("SELECT value FROM t_sync_meta WHERE key = 'identity_root'")
+		row = db.cursor.fetchone()
+		return row[0] if row else None
+
+	@staticmethod
+	def _max_seq(db):
+		db.cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM t_changelog")
+		return db.cursor.fetchone()[0]
+
+	# --- バックアップ ---
+	def backup(self, dest_path, progress=None):
+		"""
+		オンラインバックアップ。BACKUP_PAGES ページごとにロックを手放すので、
+		コピー中もアプリ側の読み書きを止めない。
+		"""
+		dest = sqlite3.connect(dest_path)
+		try:
+			self.db.conn.backup(dest, pages=self.BACKUP_PAGES, progress=progress)
+		finally:
+			dest.close()
+
+	# --- 変更フィード ---
+	def _columns(self, db, table):
+		db.cursor.execute(f"PRAGMA table_info({table})")
+		return [r[1] for r in db.cursor.fetchall()]
+
+	def _references(self, db, table):
+		"""{列名: 参照先テーブル} (同期対象のテーブルへの参照のみ)"""
+		db.cursor.execute(f"PRAGMA foreign_key_list({table})")
+		refs = {r['from']: r['table'] for r in db.cursor.fetchall() if r['table'] in self.SYNC_TABLES}
+		refs.update(self.EXTRA_REFERENCES.get(table, {}))
+		return refs
+
+	@staticmethod
+	def _id_map(db, table, by_gid):
+		db.cursor.execute("SELECT local_id, gid FROM t_sync_ids WHERE table_name = ?", (table,))
+		return {r['gid']: r['local_id'] for r in db.cursor.fetchall()} if by_gid else {r['local_id']: r['gid'] for r in db.cursor.fetchall()}
+
+	def _recompute_snapshots(self, db, src, wallet_ids, inventory_ids):
+		"""
+		残高は財布ごとに決済の合計から作り直す (期限・用途付きは属性ごとに1行、起源は現役で最新の決済)。
+		在庫の残量は購入数量から消費明細の合計を引いて作り直す。
+		アーカイブへ移した決済・消費明細も数えるため、src には ArchiveManager.sources() の結果を渡す。
+		"""
+		cur = db.cursor
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		wallets = [(w,) for w in sorted(w for w in wallet_ids if w is not None)]
+		cur.executemany("DELETE FROM t_wallet_balances WHERE wallet_id = ?", wallets)
+		cur.executemany(f"""
+			INSERT INTO t_wallet_balances (wallet_id, origin_payment_id, current_amount, updated_at)
+			SELECT ?1, NULL, COALESCE(SUM(p.amount), 0), ?2 FROM {src['t_payments']} p
+			WHERE p.wallet_id = ?1 AND p.expiry_at IS NULL AND p.usage_restriction IS NULL
+		""", [(w, now_serial) for w, in wallets])
+		cur.executemany(f"""
+			INSERT INTO t_wallet_balances (wallet_id, origin_payment_id, current_amount, updated_at)
+			SELECT ?1, (
+				SELECT MAX(lp.id) FROM main.t_payments lp
+				WHERE lp.wallet_id = ?1 AND lp.expiry_at IS p.expiry_at AND lp.usage_restriction IS p.usage_restriction
+			), SUM(p.amount), ?2 FROM {src['t_payments']} p
+			WHERE p.wallet_id = ?1 AND (p.expiry_at IS NOT NULL OR p.usage_restriction IS NOT NULL)
+			GROUP BY p.expiry_at, p.usage_restriction HAVING SUM(p.amount) != 0
+		""", [(w, now_serial) for w, in wallets])
+		cur.executemany(f"""
+			UPDATE t_inventory SET current_quantity = MAX(
+				(SELECT td.quantity FROM {src['t_transaction_details']} td WHERE td.id = t_inventory.detail_id)
+				- COALESCE((SELECT SUM(md.amount_consumed) FROM {src['t_meal_details']} md WHERE md.inventory_id = t_inventory.id), 0), 0)
+			WHERE id = ?
+		""", [(i,) for i in sorted(i for i in inventory_ids if i is not None)])
+
+	def _ship(self, src: Database, dst: Database):
+		"""src で変更された行を dst へ反映し、src 側の送信位置を進める。戻り値: {テーブル: 件数}"""
+		if self.identity_root(src) is None or self.identity_root(src) != self.identity_root(dst):
+			raise ValueError("同じ台帳から複製した台帳ではないため同期できません。この台帳から新しく複製し直してください。")
+		src_id, dst_id = self.device_id(src), self.device_id(dst)
+		src.cursor.execute("SELECT table_name, last_seq FROM t_sync_state WHERE peer_id = ?", (dst_id,))
+		marks = {r['table_name']: r['last_seq'] for r in src.cursor.fetchall()}
+		head = self._max_seq(src)
+		dst_before = self._max_seq(dst)
+
+		upserts, deletes = [], []
+		for table in self.SYNC_TABLES:
+			if table in marks:
+				# 前回以降の変更。同じ行の複数回の変更は最後の操作だけを見る
+				src.cursor.execute("""
+					SELECT row_id, op, MAX(seq) FROM t_changelog
+					WHERE table_name = ? AND seq > ? AND seq <= ? AND origin IS NOT ?
+					GROUP BY row_id
+				""", (table, marks[table], head, dst_id))
+				changed = src.cursor.fetchall()
+				upserts.append((table, [r['row_id'] for r in changed if r['op'] != 'D']))
+				deletes.append((table, [r['row_id'] for r in changed if r['op'] == 'D']))
+			else:
+				# 初回は全行を送る
+				upserts.append((table, None))
+				deletes.append((table, []))
+
+		src_gids, dst_ids = {}, {}
+		def src_gid(table, local_id):
+			if table not in src_gids: src_gids[table] = self._id_map(src, table, by_gid=False)
+			return src_gids[table].get(local_id)
+		def dst_local(table, gid):
+			if table not in dst_ids: dst_ids[table] = self._id_map(dst, table, by_gid=True)
+			return dst_ids[table].get(gid)
+
+		# アーカイブの ATTACH はトランザクション外で行う必要があるため、書き込み前に参照先を用意する
+		archived = ArchiveManager(dst).sources(['t_payments', 't_transaction_details', 't_meal_details'])
+		counts, wallets, lots = {}, set(), set()
+		dcur = dst.cursor
+		dcur.execute("PRAGMA defer_foreign_keys = ON")
+		try:
+			for table, ids in upserts:
+				if ids == []: continue
+				refs = self._references(dst, table)
+				dst_cols = set(self._columns(dst, table))
+				cols = [c for c in self._columns(src, table) if c in dst_cols and c != 'id']
+				if ids is None:
+					src.cursor.execute(f"SELECT id, {', '.join(cols)} FROM {table}")
+				else:
+					src.cursor.execute(f"SELECT id, {', '.join(cols)} FROM {table} WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))
+				inserts, updates, self_refs = [], [], []
+				for r in src.cursor.fetchall():
+					gid = src_gid(table, r['id'])
+					values = []
+					for c in cols:
+						v, ref = r[c], refs.get(c)
+						if table == 't_transaction_details' and c == 'food_id': ref = IntegrityChecker.FOOD_TABLES.get(r['food_type'])
+						if ref and v is not None:
+							ref_gid = src_gid(ref, v)
+							v = dst_local(ref, ref_gid)
+							if v is None and ref == table:
+								self_refs.append((c, ref_gid, gid))  # 同じテーブル内の参照は行を入れた後で付け替える
+							elif v is None:
+								raise ValueError(f"{table}.{c}: 参照先 {ref}#{r[c]} が相手の台帳にありません")
+						values.append(v)
+					local = dst_local(table, gid)
+					if local is None: inserts.append((gid, values))
+					else: updates.append(values + [local])
+
+				if updates:
+					if table == 't_payments':
+						dcur.execute("SELECT wallet_id FROM t_payments WHERE id IN (SELECT value FROM json_each(?))", (json.dumps([u[-1] for u in updates]),))
+						wallets.update(row[0] for row in dcur.fetchall())
+					dcur.executemany(f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?", updates)
+				if inserts:
+					# 新しい行IDは挿入順に振られるので、挿入後に読み出して端末共通IDと対応付ける
+					dcur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+					before_id = dcur.fetchone()[0]
+					dcur.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", [v for _, v in inserts])
+					dcur.execute(f"SELECT id FROM {table} WHERE id > ? ORDER BY id", (before_id,))
+					new_ids = [row[0] for row in dcur.fetchall()]
+					dcur.executemany("UPDATE t_sync_ids SET gid = ? WHERE table_name = ? AND local_id = ?",
+						[(gid, table, local) for (gid, _), local in zip(inserts, new_ids)])
+					dst_ids[table].update({gid: local for (gid, _), local in zip(inserts, new_ids)})
+				for c, ref_gid, gid in self_refs:
+					target = dst_local(table, ref_gid)
+					if target is None: raise ValueError(f"{table}.{c}: 参照先が相手の台帳にありません")
+					dcur.execute(f"UPDATE {table} SET {c} = ? WHERE id = ?", (target, dst_local(table, gid)))
+
+				rows = [values for _, values in inserts] + [u[:-1] for u in updates]
+				if table == 't_payments': wallets.update(v[cols.index('wallet_id')] for v in rows)
+				if table == 't_inventory': lots.update([dst_local(table, gid) for gid, _ in inserts] + [u[-1] for u in updates])
+				if table == 't_meal_details': lots.update(v[cols.index('inventory_id')] for v in rows)
+				counts[table] = len(rows)
+
+			for table, ids in reversed(deletes):
+				local_ids = [dst_local(table, src_gid(table, i)) for i in ids]
+				local_ids = [(i,) for i in local_ids if i is not None]
+				if not local_ids: continue
+				if table in ('t_payments', 't_meal_details'):
+					col = 'wallet_id' if table == 't_payments' else 'inventory_id'
+					dcur.execute(f"SELECT {col} FROM {table} WHERE id IN (SELECT value FROM json_each(?))", (json.dumps([i for i, in local_ids]),))
+					(wallets if table == 't_payments' else lots).update(row[0] for row in dcur.fetchall())
+				dcur.executemany(f"DELETE FROM {table} WHERE id = ?", local_ids)
+				counts[table] = counts.get(table, 0) + len(local_ids)
+
+			self._recompute_snapshots(dst, archived, wallets, lots)
+			# 受け取った変更は送信元を記録し、次回 dst -> src へ送り返さない
+			dcur.execute("UPDATE t_changelog SET origin = ? WHERE seq > ?", (src_id, dst_before))
+			dst.conn.commit()
+		except Exception:
+			dst.conn.rollback()
+			raise
+		SpendingCube(dst).rebuild()  # 派生テーブルは1パスで再集計
+		PriceIndex(dst).rebuild()
+		BudgetTracker(dst).rebuild()
+
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		src.cursor.executemany("""
+			INSERT INTO t_sync_state (peer_id, table_name, last_seq, synced_at) VALUES (?, ?, ?, ?)
+			ON CONFLICT(peer_id, table_name) DO UPDATE SET last_seq = excluded.last_seq, synced_at = excluded.synced_at
+		""", [(dst_id, t, head, now_serial) for t in self.SYNC_TABLES])
+		self._prune(src)
+		src.conn.commit()
+		return counts
+
+	def _prune(self, db):
+		"""全ての同期先へ送信済みの変更ログを削除する"""
+		db.cursor.execute("""
+			DELETE FROM t_changelog WHERE seq <= (
+				SELECT MIN(last_seq) FROM t_sync_state
+			)
+		""")
+
+	def _open_peer(self, path):
+		"""相手の台帳を開く。存在しなければこの台帳のバックアップから新しい端末として作る"""
+		self._install_feed(self.db)
+		if os.path.exists(path):
+			peer = Database(path)
+			LedgerSync(peer)
+			return peer, False
+		self.backup(path)
+		peer = Database(path)
+		LedgerSync(peer)
+		# 複製した台帳は別端末として扱う（送信位置は複製時点まで送信済み）
+		peer.cursor.execute("UPDATE t_sync_meta SET value = ? WHERE key = 'device_id'", (uuid.uuid4().hex,))
+		peer.cursor.execute("DELETE FROM t_sync_state")
+		peer.cursor.execute("DELETE FROM t_changelog")
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		sql = "INSERT OR REPLACE INTO t_sync_state (peer_id, table_name, last_seq, synced_at) VALUES (?, ?, ?, ?)"
+		peer.cursor.executemany(sql, [(self.device_id(self.db), t, 0, now_serial) for t in self.SYNC_TABLES])
+		peer.conn.commit()
+		self._install_feed(peer)
+		head = self._max_seq(self.db)
+		self.db.cursor.executemany(sql, [(self.device_id(peer), t, head, now_serial) for t in self.SYNC_TABLES])
+		self.db.conn.commit()
+		return peer, True
+
+	def push(self, path):
+		"""この台帳の変更を相手の台帳へ送る。相手を新規作成した場合は None"""
+		peer, created = self._open_peer(path)
+		try:
+			return None if created else self._ship(self.db, peer)
+		finally:
+			peer.close()
+
+	def pull(self, path):
+		"""相手の台帳の変更をこの台帳へ取り込む。相手を新規作成した場合は None"""
+		peer, created = self._open_peer(path)
+		try:
+			return None if created else self._ship(peer, self.db)
+		finally:
+			peer.close()
+
+	def show_sync_menu(self):
+		print("\n=== バックアップ・同期 ===")
+		print(" 1. オンラインバックアップ")
+		print(" 2. 他の台帳へ変更を送る")
+		print(" 3. 他の台帳から変更を取り込む")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel == '1':
+			default = f"VitalLedger_backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.sqlite3"
+			path = get_input(f"保存先 [def:{default}]", required=False) or default
+			self.backup(path, progress=lambda status, remaining, total: print(f"\r  {total - remaining}/{total} ページ", end=""))
+			print(f"\nバックアップ完了: {path}")
+		elif sel in ('2', '3'):
+			path = get_input("相手の台帳ファイル")
+			if os.path.abspath(path) == os.path.abspath(self.db.path):
+				print("同じ台帳ファイルは指定できません。")
+				return
+			try:
+				counts = self.push(path) if sel == '2' else self.pull(path)
+			except ValueError as e:
+				print(f"[Error] {e}")
+				return
+			if counts is None:
+				print(f"新しい台帳を作成しました: {path}")
+				return
+			if not counts: print("変更はありません。")
+			for table, n in counts.items():
+				print(f"  {table}: {n}件")
+			print("同期完了")
+
+# ==========================================
+# 11. 年別アーカイブ (ATTACHによる透過参照)
+# ==========================================
+class ArchiveManager:
+	"""
+	締めた年の取引・明細・決済・食事を年ごとのアーカイブファイル(VitalLedger_archive_YYYY.sqlite3)へ移し、
+	日常の処理が触る現役テーブルを小さく保つ。
+	複数年にまたがるレポートは sources() で必要な年のアーカイブを ATTACH し、現役テーブルと UNION ALL した表を参照する。
+	次のいずれかに当たる取引は「締まっていない」ため現役に残す:
+	  - 残量のある在庫ロット、または翌年以降の食事から参照される明細を持つ
+	  - 残高スナップショットの起源になっている、または残額のある期限・用途付きの決済を持つ
+	"""
+	ARCHIVE_TABLES = ['t_transactions', 't_transaction_details', 't_payments', 't_inventory', 't_meal_logs', 't_meal_details']
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.db.cursor.execute("""
+			CREATE TABLE IF NOT EXISTS t_archives (
+				year INTEGER PRIMARY KEY,
+				path TEXT NOT NULL,                  -- アーカイブファイル (台帳と同じフォルダからの相対パス)
+				archived_at REAL,
+				transaction_count INTEGER DEFAULT 0
+			)
+		""")
+
+	def _archive_path(self, file_name):
+		return os.path.join(os.path.dirname(os.path.abspath(self.db.path)), file_name)
+
+	def _attach(self, year, file_name):
+		"""年のアーカイブを arc_YYYY として ATTACH (済みなら何もしない)"""
+		schema = f"arc_{year}"
+		cur = self.db.cursor
+		cur.execute("PRAGMA database_list")
+		if schema not in [r['name'] for r in cur.fetchall()]:
+			cur.execute(f"ATTACH DATABASE ? AS {schema}", (self._archive_path(file_name),))
+		return schema
+
+	def _columns(self, schema, table):
+		self.db.cursor.execute(f"PRAGMA {schema}.table_info({table})")
+		return [r[1] for r in self.db.cursor.fetchall()]
+
+	def schemas(self, start_serial=None, end_serial=None):
+		"""期間内のアーカイブを ATTACH してスキーマ名のリストを返す。期間省略時は全てのアーカイブ"""
+		cur = self.db.cursor
+		sql, params = "SELECT year, path FROM t_archives", []
+		if start_serial is not None and end_serial is not None:
+			sql += " WHERE year BETWEEN ? AND ?"
+			params = [serial_to_datetime(start_serial).year, serial_to_datetime(end_serial).year]
+		cur.execute(sql + " ORDER BY year", params)
+		return [self._attach(r['year'], r['path']) for r in cur.fetchall()]
+
+	def sources(self, tables, start_serial=None, end_serial=None):
+		"""
+		{テーブル名: FROM句に書く参照先} を返す。期間内にアーカイブ済みの年が無ければテーブル名そのまま。
+		期間省略時は全てのアーカイブを対象にする。
+		"""
+		schemas = self.schemas(start_serial, end_serial)
+		if not schemas: return {t: t for t in tables}
+
+		result = {}
+		for table in tables:
+			cols = self._columns('main', table)
+			parts = [f"SELECT {', '.join(cols)} FROM main.{table}"]
+			for schema in schemas:
+				have = set(self._columns(schema, table))
+				if not have: continue
+				parts.append(f"SELECT {', '.join(c if c in have else f'NULL AS {c}' for c in cols)} FROM {schema}.{table}")
+			result[table] = "(" + " UNION ALL ".join(parts) + ")"
+		return result
+
+	def archive_year(self, year):
+		"""1年分を移動する。戻り値: 移動した取引数"""
+		start = datetime_to_serial(datetime.datetime(year, 1, 1))
+		next_start = datetime_to_serial(datetime.datetime(year + 1, 1, 1))
+		file_name = f"VitalLedger_archive_{year}.sqlite3"
+		conn, cur = self.db.conn, self.db.cursor
+		conn.commit()  # ATTACH はトランザクション外で行う必要がある
+		schema = self._attach(year, file_name)
+
+		# 移動対象の特定 (一時テーブル)
+		cur.execute("DROP TABLE IF EXISTS temp.arc_tx")
+		cur.execute("""
+			CREATE TEMP TABLE arc_tx AS
+			SELECT t.id FROM t_transactions t
+			WHERE t.transaction_at >= :s AND t.transaction_at < :e
+			AND NOT EXISTS (
+				SELECT 1 FROM t_transaction_details td JOIN t_inventory inv ON inv.detail_id = td.id
+				WHERE td.transaction_id = t.id AND inv.current_quantity > 0)
+			AND NOT EXISTS (
+				SELECT 1 FROM t_transaction_details td
+				JOIN t_meal_details md ON md.detail_id = td.id
+				JOIN t_meal_logs ml ON md.meal_id = ml.id
+				WHERE td.transaction_id = t.id AND ml.eaten_at >= :e)
+			AND NOT EXISTS (
+				SELECT 1 FROM t_payments p
+				WHERE p.transaction_id = t.id AND (
+					p.id IN (SELECT origin_payment_id FROM t_wallet_balances WHERE origin_payment_id IS NOT NULL)
+					OR (p.remaining_amount != 0 AND (p.expiry_at IS NOT NULL OR p.usage_restriction IS NOT NULL))))
+		""", {'s': start, 'e': next_start})
+		cur.execute("DROP TABLE IF EXISTS temp.arc_meals")
+		cur.execute("CREATE TEMP TABLE arc_meals AS SELECT id FROM t_meal_logs WHERE eaten_at >= ? AND eaten_at < ?", (start, next_start))
+
+		# 各テーブルの移動条件 (親 -> 子の順)
+		conds = {
+			't_transactions': "id IN (SELECT id FROM temp.arc_tx)",
+			't_transaction_details': "transaction_id IN (SELECT id FROM temp.arc_tx)",
+			't_payments': "transaction_id IN (SELECT id FROM temp.arc_tx)",
+			't_inventory': "detail_id IN (SELECT id FROM t_transaction_details WHERE transaction_id IN (SELECT id FROM temp.arc_tx))",
+			't_meal_logs': "id IN (SELECT id FROM temp.arc_meals)",
+			't_meal_details': "meal_id IN (SELECT id FROM temp.arc_meals)",
+		}
+		cur.execute("SELECT COUNT(*) FROM temp.arc_tx")
+		moved = cur.fetchone()[0]
+		cur.execute("SELECT COUNT(*) FROM temp.arc_meals")
+		if moved == 0 and cur.fetchone()[0] == 0:
+			cur.execute(f"DETACH DATABASE {schema}")
+			return 0
+
+		log_before = None
+		cur.execute("SELECT 1 FROM sqlite_master WHERE name = 't_changelog'")
+		if cur.fetchone():
+			cur.execute("SELECT COALESCE(MAX(seq), 0) FROM t_changelog")
+			log_before = cur.fetchone()[0]
+
+		try:
+			for table in self.ARCHIVE_TABLES:
+				# アーカイブ側は制約なしの同じ列構成 (参照先のマスタは台帳本体にあるため外部キーは張らない)
+				cur.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} AS SELECT * FROM main.{table} WHERE 0")
+				cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.idx_{table}_id ON {table}(id)")
+				cols = [c for c in self._columns('main', table) if c in set(self._columns(schema, table))]
+				col_sql = ", ".join(cols)
+				cur.execute(f"INSERT OR REPLACE INTO {schema}.{table} ({col_sql}) SELECT {col_sql} FROM main.{table} WHERE {conds[table]}")
+			for table in reversed(self.ARCHIVE_TABLES):
+				cur.execute(f"DELETE FROM main.{table} WHERE {conds[table]}")
+			# 明細の削除トリガーが全文検索の索引から外した行を、アーカイブ側から入れ直す
+			cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'fts_receipt_items'")
+			if cur.fetchone():
+				arc = {t: f"{schema}.{t}" for t in ('t_transactions', 't_transaction_details')}
+				cur.execute(ReceiptSearch._rows_sql("td.transaction_id IN (SELECT id FROM temp.arc_tx)", arc))
+
+			# アーカイブは保存場所の移動であり、台帳の変更ではないので同期フィードには載せない
+			if log_before is not None:
+				cur.execute("DELETE FROM t_changelog WHERE seq > ?", (log_before,))
+			cur.execute("""
+				INSERT INTO t_archives (year, path, archived_at, transaction_count) VALUES (?, ?, ?, ?)
+				ON CONFLICT(year) DO UPDATE SET archived_at = excluded.archived_at,
+					transaction_count = transaction_count + excluded.transaction_count
+			""", (year, file_name, datetime_to_serial(datetime.datetime.now()), moved))
+			conn.commit()
+		except Exception:
+			conn.rollback()
+			raise
+		finally:
+			cur.execute(f"DETACH DATABASE {schema}")
+		return moved
+
+	def show_archive_menu(self):
+		print("\n=== 年別アーカイブ ===")
+		cur = self.db.cursor
+		cur.execute("SELECT year, path, transaction_count FROM t_archives ORDER BY year")
+		for r in cur.fetchall():
+			print(f"  {r['year']}年: {r['transaction_count']}件 ({r['path']})")
+		last_closed = datetime.datetime.now().year - 1
+		year_to = get_input(f"何年までをアーカイブしますか (最大{last_closed}, Enterで戻る)", required=False, cast_func=int)
+		if year_to is None: return
+		if year_to > last_closed:
+			print("今年以降はアーカイブできません。")
+			return
+		cur.execute("SELECT MIN(transaction_at) FROM t_transactions")
+		first = cur.fetchone()[0]
+		if first is None:
+			print("取引がありません。")
+			return
+		for year in range(serial_to_datetime(first).year, year_to + 1):
+			moved = self.archive_year(year)
+			if moved: print(f"  {year}年: {moved}件の取引を移動しました")
+		cur.execute("VACUUM")
+		print("アーカイブ完了")
+
+# ==========================================
+# 12. ダッシュボード (並列集計)
+# ==========================================
+class Dashboard:
+	"""
+	資産・在庫レポートの拡張版。互いに独立した集計クエリをスレッドプールで同時に実行し、
+	全て揃ってからまとめて表示する。各クエリは自分専用の参照専用接続を使う
+	(sqlite3 はクエリ実行中に GIL を解放するため、待ち時間は最も遅いクエリ程度になる)。
+	"""
+	EXPIRY_WARN_DAYS = 30
+	NUTRITION_DAYS = 7
+
+	def __init__(self, db: Database):
+		self.db = db
+
+	# --- 各集計 (引数は専用の ReadOnlyDatabase) ---
+	@staticmethod
+	def _q_wallets(ro):
+		return ReportManager(ro)._fetch_wallets()
+
+	@staticmethod
+	def _q_inventory(ro):
+		return ReportManager(ro)._fetch_inventory()
+
+	@staticmethod
+	def _q_net_worth(ro):
+		"""財布ごとの残高合計と、最新レートでの円換算"""
+		ro.cursor.execute("""
+			SELECT w.id, w.name, c.display_unit, SUM(wb.current_amount) as amount,
+				COALESCE((SELECT r.rate_to_jpy FROM t_currency_rates r
+					WHERE r.currency_id = w.currency_id AND r.change_type = 'VALUE_ADJUST'
+					ORDER BY r.effective_at DESC LIMIT 1), 1.0) as rate
+			FROM m_wallets w
+			JOIN m_currencies c ON w.currency_id = c.id
+			JOIN t_wallet_balances wb ON wb.wallet_id = w.id
+			WHERE w.is_active = 1
+			GROUP BY w.id ORDER BY w.id
+		""")
+		return ro.cursor.fetchall()
+
+	@staticmethod
+	def _q_expiring(ro, now_serial, days):
+		"""期限が近い期間限定のお金・ポイント"""
+		ro.cursor.execute("""
+			SELECT w.name, c.display_unit, wb.current_amount, p.expiry_at, p.usage_restriction
+			FROM t_wallet_balances wb
+			JOIN t_payments p ON wb.origin_payment_id = p.id
+			JOIN m_wallets w ON wb.wallet_id = w.id
+			JOIN m_currencies c ON w.currency_id = c.id
+			WHERE wb.current_amount > 0 AND p.expiry_at BETWEEN ? AND ?
+			ORDER BY p.expiry_at
+		""", (now_serial, now_serial + days))
+		return ro.cursor.fetchall()
+
+	@staticmethod
+	def _q_nutrition(ro, start_serial, end_serial):
+		return ReportManager(ro)._fetch_daily_nutrition(start_serial, end_serial)
+
+	def _run(self, func, *args):
+		ro = ReadOnlyDatabase(self.db.path)
+		try:
+			return func(ro, *args)
+		finally:
+			ro.close()
+
+	def collect(self):
+		"""全ての集計を並列に実行して {名前: 結果} を返す"""
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		today = int(now_serial)
+		jobs = {
+			'wallets': (self._q_wallets,),
+			'inventory': (self._q_inventory,),
+			'net_worth': (self._q_net_worth,),
+			'expiring': (self._q_expiring, now_serial, self.EXPIRY_WARN_DAYS),
+			'nutrition': (self._q_nutrition, today - self.NUTRITION_DAYS + 1, today),
+		}
+		with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+			futures = {name: pool.submit(self._run, *job) for name, job in jobs.items()}
+			return {name: f.result() for name, f in futures.items()}
+
+	def show_dashboard(self):
+		self.db.conn.commit()  # 別接続から最新の状態が見えるように
+		started = time.perf_counter()
+		res = self.collect()
+		elapsed = (time.perf_counter() - started) * 1000
+
+		rep = ReportManager(self.db)
+		print("\n=== 純資産 ===")
+		rep._print_header([("財布名", 32, 'left'), ("残高", 14, 'right'), ("円換算", 12, 'right')])
+		net = 0
+		for r in res['net_worth']:
+			jpy = r['amount'] * r['rate']
+			net += jpy
+			rep._print_row([(r['name'], 32, 'left'), (f"{int(r['amount']):,}{r['display_unit']}", 14, 'right'), (f"{int(jpy):,}", 12, 'right')])
+		print(f" 合計: {int(net):,} 円")
+
+		rep.show_wallets(res['wallets'])
+
+		print(f"\n=== {self.EXPIRY_WARN_DAYS}日以内に期限切れのお金・ポイント ===")
+		if not res['expiring']: print("なし")
+		for r in res['expiring']:
+			restr = f" [{r['usage_restriction']}]" if r['usage_restriction'] else ""
+			print(f"  {format_serial(r['expiry_at'], '%m/%d')} {r['name']}: {int(r['current_amount']):,}{r['display_unit']}{restr}")
+
+		rep.show_inventory(res['inventory'])
+
+		days = self.NUTRITION_DAYS
+		totals = {k: sum(row[k] for row in res['nutrition'].values()) for k in ('kcal', 'prot', 'fat', 'carb', 'salt')}
+		print(f"\n=== 直近{days}日の栄養素（1日平均） ===")
+		print(f"  {int(totals['kcal'] / days)}kcal P{totals['prot'] / days:.1f} F{totals['fat'] / days:.1f} C{totals['carb'] / days:.1f} 塩{totals['salt'] / days:.1f}")
+		print(f"\n(集計 {elapsed:.0f} ms)")
+
+# ==========================================
+# 13. 食費・廃棄コスト分析 (先入先出の原価配賦)
+# ==========================================
+class ConsumptionCostEngine:
+	"""
+	消費1件ごとに購入原価を配賦した t_consumption_costs を1パスで作る。
+	- 在庫消費(t_meal_details): 明細の税込金額 / 数量 を単価とし、同じ明細(ロット)の消費を日時順に
+	  積み上げて購入数量までを原価計上する（先入先出。数量を超えた入力分は0円）。
+	- 即食・外食(destination = 'EAT_NOW'): 明細の税込金額がそのまま原価。
+	元データのバージョンが変わった時だけ作り直すので、レポート表示は集計テーブルを読むだけで済む。
+	"""
+	SOURCE_TABLES = ['t_transactions', 't_transaction_details', 't_meal_logs', 't_meal_details',
+		'm_foods_universal', 'm_foods_measured', 'm_foods_processed']
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.db.cursor.execute("""
+			CREATE TABLE IF NOT EXISTS t_consumption_costs (
+				source TEXT NOT NULL,                -- MEAL: 在庫消費, PURCHASE: 即食・外食
+				source_id INTEGER NOT NULL,          -- t_meal_details.id / t_transaction_details.id
+				meal_key TEXT NOT NULL,              -- 1食の単位 (M+食事ID / T+取引ID)
+				month TEXT NOT NULL,                 -- YYYYMM
+				consumed_at REAL NOT NULL,
+				detail_id INTEGER NOT NULL,
+				food_type TEXT,
+				food_id INTEGER,
+				food_name TEXT,
+				consume_type TEXT NOT NULL,          -- SELF / GIFT / LOSS
+				amount REAL NOT NULL,
+				cost_jpy REAL NOT NULL,
+				energy_kcal REAL NOT NULL,
+				protein_g REAL NOT NULL,
+				PRIMARY KEY (source, source_id)
+			)
+		""")
+		self.db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_consumption_costs_month ON t_consumption_costs(month, consume_type)")
+
+	def refresh(self):
+		"""元データに変更があれば作り直す"""
+		if self.db.derived_is_fresh('t_consumption_costs', self.SOURCE_TABLES): return
+		self.rebuild()
+
+	def rebuild(self):
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details', 't_meal_logs', 't_meal_details'])
+		kcal = nutrient_per_qty_sql('energy_kcal', 'td.food_type')
+		prot = nutrient_per_qty_sql('protein_g', 'td.food_type')
+		food_joins = """
+			LEFT JOIN m_foods_measured fm ON td.food_id = fm.id AND td.food_type = 'MEASURED'
+			LEFT JOIN m_foods_universal fu ON td.food_id = fu.id AND td.food_type = 'UNIVERSAL'
+			LEFT JOIN m_foods_processed fp ON td.food_id = fp.id AND td.food_type IN ('PROCESSED', 'OUT_EAT')
+		"""
+		food_name = "COALESCE(fu.name, fm.name, fp.name, td.item_name_receipt)"
+		cur = self.db.cursor
+		cur.execute("DELETE FROM t_consumption_costs")
+		cur.execute(f"""
+			INSERT INTO t_consumption_costs
+			WITH meals AS (
+				SELECT md.id, md.meal_id, md.detail_id, md.amount_consumed, md.consume_type, ml.eaten_at,
+					SUM(md.amount_consumed) OVER (PARTITION BY md.detail_id ORDER BY ml.eaten_at, md.id) as cum
+				FROM {src['t_meal_details']} md
+				JOIN {src['t_meal_logs']} ml ON md.meal_id = ml.id
+			)
+			SELECT 'MEAL', m.id, 'M' || m.meal_id, {serial_month_sql('m.eaten_at')}, m.eaten_at,
+				td.id, td.food_type, td.food_id, {food_name}, COALESCE(m.consume_type, 'SELF'), m.amount_consumed,
+				CASE WHEN td.quantity > 0
+					THEN (MIN(m.cum, td.quantity) - MIN(m.cum - m.amount_consumed, td.quantity)) * {LINE_GROSS_SQL} / td.quantity
+					ELSE 0 END,
+				m.amount_consumed * {kcal}, m.amount_consumed * {prot}
+			FROM meals m
+			JOIN {src['t_transaction_details']} td ON m.detail_id = td.id
+			{food_joins}
+
+			UNION ALL
+
+			SELECT 'PURCHASE', td.id, 'T' || t.id, {serial_month_sql('t.transaction_at')}, t.transaction_at,
+				td.id, td.food_type, td.food_id, {food_name}, 'SELF', td.quantity,
+				{LINE_GROSS_SQL}, td.quantity * {kcal}, td.quantity * {prot}
+			FROM {src['t_transaction_details']} td
+			JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+			{food_joins}
+			WHERE td.destination = 'EAT_NOW' AND td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED', 'OUT_EAT')
+		""")
+		self.db.mark_derived('t_consumption_costs', self.SOURCE_TABLES)
+		self.db.conn.commit()
+
+	def monthly(self, month_from=None, month_to=None):
+		"""月別: 食べた原価・廃棄・譲渡、食事回数、1食・1000kcal・たんぱく質1gあたりの原価"""
+		self.refresh()
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT month,
+				SUM(CASE WHEN consume_type = 'SELF' THEN cost_jpy ELSE 0 END) as eaten_jpy,
+				SUM(CASE WHEN consume_type = 'LOSS' THEN cost_jpy ELSE 0 END) as waste_jpy,
+				SUM(CASE WHEN consume_type = 'GIFT' THEN cost_jpy ELSE 0 END) as gift_jpy,
+				COUNT(DISTINCT CASE WHEN consume_type = 'SELF' THEN meal_key END) as meals,
+				SUM(CASE WHEN consume_type = 'SELF' THEN energy_kcal ELSE 0 END) as kcal,
+				SUM(CASE WHEN consume_type = 'SELF' THEN protein_g ELSE 0 END) as protein
+			FROM t_consumption_costs
+			WHERE month BETWEEN COALESCE(?, '000000') AND COALESCE(?, '999999')
+			GROUP BY month ORDER BY month
+		""", (month_from, month_to))
+		return cur.fetchall()
+
+	def by_food(self, month_from=None, month_to=None, order='waste_jpy', limit=20):
+		"""食品別の原価・廃棄 (order: 'waste_jpy' / 'eaten_jpy')"""
+		self.refresh()
+		order = order if order in ('waste_jpy', 'eaten_jpy') else 'waste_jpy'
+		cur = self.db.cursor
+		cur.execute(f"""
+			SELECT food_type, food_id, MIN(food_name) as food_name,
+				SUM(CASE WHEN consume_type = 'SELF' THEN cost_jpy ELSE 0 END) as eaten_jpy,
+				SUM(CASE WHEN consume_type = 'LOSS' THEN cost_jpy ELSE 0 END) as waste_jpy,
+				SUM(CASE WHEN consume_type = 'LOSS' THEN amount ELSE 0 END) as waste_amount,
+				SUM(CASE WHEN consume_type = 'SELF' THEN energy_kcal ELSE 0 END) as kcal,
+				SUM(CASE WHEN consume_type = 'SELF' THEN protein_g ELSE 0 END) as protein
+			FROM t_consumption_costs
+			WHERE month BETWEEN COALESCE(?, '000000') AND COALESCE(?, '999999')
+			GROUP BY food_type, COALESCE(food_id, food_name)
+			ORDER BY {order} DESC
+			LIMIT ?
+		""", (month_from, month_to, limit))
+		return cur.fetchall()
+
+	def show_cost_report(self):
+		print("\n=== 食費・廃棄コスト分析 ===")
+		month_from = get_input("開始年月(YYYYMM) [def:全期間]", required=False)
+		month_to = get_input("終了年月(YYYYMM) [def:全期間]", required=False)
+		rep = ReportManager(self.db)
+
+		rows = self.monthly(month_from, month_to)
+		if not rows:
+			print("該当なし")
+			return
+		print("\n[月別]")
+		rep._print_header([("年月", 7, 'left'), ("食べた", 9, 'right'), ("廃棄", 8, 'right'), ("譲渡", 8, 'right'),
+			("食数", 5, 'right'), ("円/食", 7, 'right'), ("円/千kcal", 9, 'right'), ("円/Pg", 6, 'right')])
+		for r in rows:
+			per_meal = r['eaten_jpy'] / r['meals'] if r['meals'] else 0
+			per_kcal = r['eaten_jpy'] / r['kcal'] * 1000 if r['kcal'] else 0
+			per_prot = r['eaten_jpy'] / r['protein'] if r['protein'] else 0
+			rep._print_row([(r['month'], 7, 'left'), (f"{int(r['eaten_jpy']):,}", 9, 'right'), (f"{int(r['waste_jpy']):,}", 8, 'right'),
+				(f"{int(r['gift_jpy']):,}", 8, 'right'), (str(r['meals']), 5, 'right'), (f"{per_meal:.0f}", 7, 'right'),
+				(f"{per_kcal:.0f}", 9, 'right'), (f"{per_prot:.1f}", 6, 'right')])
+
+		order = 'eaten_jpy' if get_input("食品別の並び (1:廃棄額, 2:食べた額) [def:1]", required=False) == '2' else 'waste_jpy'
+		print("\n[食品別]")
+		rep._print_header([("食品", 24, 'left'), ("食べた", 9, 'right'), ("廃棄", 8, 'right'), ("廃棄量", 7, 'right'), ("円/千kcal", 9, 'right')])
+		for r in self.by_food(month_from, month_to, order):
+			per_kcal = r['eaten_jpy'] / r['kcal'] * 1000 if r['kcal'] else 0
+			rep._print_row([(r['food_name'] or "---", 24, 'left'), (f"{int(r['eaten_jpy']):,}", 9, 'right'), (f"{int(r['waste_jpy']):,}", 8, 'right'),
+				(f"{r['waste_amount']:g}", 7, 'right'), (f"{per_kcal:.0f}", 9, 'right')])
+
+# ==========================================
+# 14. 食品マスタの列指向キャッシュ
+# ==========================================
+class FoodRecord:
+	"""FoodMasterStore の1行分のビュー (値はストアの列から都度読む)"""
+	__slots__ = ('store', 'offset')
+
+	def __init__(self, store, offset):
+		self.store = store
+		self.offset = offset
+
+	@property
+	def food_type(self): return self.store.TYPES[self.store.type_codes[self.offset]]
+	@property
+	def id(self): return self.store.ids[self.offset]
+	@property
+	def name(self): return self.store.names_all[self.offset]
+	@property
+	def weight_g(self): return self.store.weight_g[self.offset]
+	@property
+	def shelf_life_days(self): return self.store.shelf_life_days[self.offset]
+
+	def nutrient(self, field):
+		return self.store.nutrients[field][self.offset]
+
+	def taste(self, field):
+		return self.store.tastes[field][self.offset]
+
+class FoodMasterStore:
+	"""
+	3つの食品マスタを1度だけ読み込み、型付き配列(array)の列として保持する。
+	(food_type, id) -> 行番号 の辞書で引き、行は __slots__ の FoodRecord で参照する。
+	NULL は NaN で持つ。マスタのバージョン(t_table_versions)が変わった時だけ読み直す。
+	あいまい検索・類似検索などで同じ1つのコピーを共有する。
+	"""
+	TYPES = ('UNIVERSAL', 'MEASURED', 'PROCESSED')
+	MASTERS = [
+		('m_foods_universal', 'standard_weight_g', 'shelf_life_days_guideline'),
+		('m_foods_measured', '100.0', 'NULL'),            # 100g基準、目安期限なし
+		('m_foods_processed', 'weight_per_serving_g', 'NULL'),
+	]
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.version = None
+		self._clear()
+
+	def _clear(self):
+		self.ids = array('q')
+		self.type_codes = array('b')
+		self.names_all = []
+		self.weight_g = array('d')          # 1単位の重量 (Measuredは100)
+		self.shelf_life_days = array('d')
+		self.nutrients = {f: array('d') for f in NUTRIENT_FIELDS}
+		self.tastes = {f: array('d') for f in TASTE_FIELDS}
+		self.offsets = {}
+		self._ranges = {}                   # food_type -> (開始行, 終了行)
+
+	def __len__(self):
+		return len(self.ids)
+
+	MASTERS_TABLES = [m[0] for m in MASTERS]
+
+	def refresh(self):
+		"""マスタに変更があれば読み直す。読み直した場合 True"""
+		version = self.db.table_version(*self.MASTERS_TABLES)
+		if version == self.version: return False
+		self._load()
+		self.version = version
+		return True
+
+	def _load(self):
+		self._clear()
+		nan = float('nan')
+		val = lambda v: nan if v is None else float(v)
+		cur = self.db.cursor
+		fields = ", ".join(NUTRIENT_FIELDS + TASTE_FIELDS)
+		for code, (table, weight_col, shelf_col) in enumerate(self.MASTERS):
+			start = len(self.ids)
+			cur.execute(f"SELECT id, name, {weight_col} AS weight_g, {shelf_col} AS shelf_life, {fields} FROM {table} ORDER BY id")
+			for r in cur.fetchall():
+				self.offsets[(self.TYPES[code], r['id'])] = len(self.ids)
+				self.ids.append(r['id'])
+				self.type_codes.append(code)
+				self.names_all.append(r['name'])
+				self.weight_g.append(val(r['weight_g']))
+				self.shelf_life_days.append(val(r['shelf_life']))
+				for f in NUTRIENT_FIELDS: self.nutrients[f].append(val(r[f]))
+				for f in TASTE_FIELDS: self.tastes[f].append(val(r[f]))
+			self._ranges[self.TYPES[code]] = (start, len(self.ids))
+
+	def get(self, food_type, food_id):
+		"""(food_type, id) の FoodRecord。外食は加工食品マスタを引く"""
+		self.refresh()
+		if food_type == 'OUT_EAT': food_type = 'PROCESSED'
+		offset = self.offsets.get((food_type, food_id))
+		return None if offset is None else FoodRecord(self, offset)
+
+	def names(self, food_type):
+		"""指定種別の (idのリスト, 名前のリスト)"""
+		if food_type == 'OUT_EAT': food_type = 'PROCESSED'
+		start, end = self._ranges.get(food_type, (0, 0))
+		return self.ids[start:end].tolist(), self.names_all[start:end]
+
+	def food_types(self):
+		return [self.TYPES[c] for c in self.type_codes]
+
+# ==========================================
+# 15. レシピ (複数食材の一括消費)
+# ==========================================
+class RecipeManager:
+	"""
+	食材(食品マスタID + 量)の組み合わせをレシピとして保存し、1人前の栄養素をレシピ側にキャッシュする。
+	調理時は食材ごとに期限の早い在庫ロットから自動で引き当て、t_meal_details と t_inventory への
+	書き込みを executemany で1トランザクションにまとめる。
+	量の単位は在庫と同じ (Universal: 個数, Measured: g, Processed: 食)。
+	"""
+	def __init__(self, db: Database, master_mgr: MasterManager):
+		self.db = db
+		self.master_mgr = master_mgr
+		cur = self.db.cursor
+		nutrient_cols = ", ".join(f"{f} REAL DEFAULT 0" for f in NUTRIENT_FIELDS)
+		cur.execute(f"""
+			CREATE TABLE IF NOT EXISTS m_recipes (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				name TEXT NOT NULL UNIQUE,
+				servings REAL NOT NULL DEFAULT 1,    -- 食材の量が何人前か
+				note TEXT,
+				-- 1人前あたりの栄養素 (食材・食品マスタの変更時に再計算)
+				{nutrient_cols}
+			)
+		""")
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_recipe_ingredients (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				recipe_id INTEGER NOT NULL,
+				food_type TEXT CHECK(food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED')) NOT NULL,
+				food_id INTEGER NOT NULL,
+				amount REAL NOT NULL,
+				FOREIGN KEY (recipe_id) REFERENCES m_recipes(id)
+			)
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_recipe_ingredients ON m_recipe_ingredients(recipe_id)")
+		self.db.conn.commit()
+
+	def _update_nutrition(self, recipe_ids=None):
+		"""1人前の栄養素を食品マスタのキャッシュから計算して保存 (None なら全レシピ)"""
+		store = self.master_mgr.store
+		store.refresh()
+		cur = self.db.cursor
+		if recipe_ids is None:
+			cur.execute("SELECT id FROM m_recipes")
+			recipe_ids = [r['id'] for r in cur.fetchall()]
+		updates = []
+		for rid in recipe_ids:
+			cur.execute("SELECT r.servings, i.food_type, i.food_id, i.amount FROM m_recipes r JOIN m_recipe_ingredients i ON i.recipe_id = r.id WHERE r.id = ?", (rid,))
+			totals = dict.fromkeys(NUTRIENT_FIELDS, 0.0)
+			servings = 1
+			for r in cur.fetchall():
+				servings = r['servings'] or 1
+				rec = store.get(r['food_type'], r['food_id'])
+				if rec is None: continue
+				per = 0.01 if r['food_type'] == 'MEASURED' else 1.0  # Measuredは100gあたり
+				for f in NUTRIENT_FIELDS:
+					v = rec.nutrient(f)
+					if v == v: totals[f] += r['amount'] * v * per  # NaN(未登録)は0扱い
+			updates.append(tuple(totals[f] / servings for f in NUTRIENT_FIELDS) + (rid,))
+		cur.executemany(f"UPDATE m_recipes SET {', '.join(f'{f} = ?' for f in NUTRIENT_FIELDS)} WHERE id = ?", updates)
+		self.db.mark_derived('m_recipes', FoodMasterStore.MASTERS_TABLES)
+		self.db.conn.commit()
+
+	def save_recipe(self, name, servings, ingredients, note=None):
+		"""ingredients: [(food_type, food_id, amount), ...]。同名があれば置き換える"""
+		cur = self.db.cursor
+		cur.execute("SELECT id FROM m_recipes WHERE name = ?", (name,))
+		row = cur.fetchone()
+		if row:
+			rid = row['id']
+			cur.execute("UPDATE m_recipes SET servings = ?, note = ? WHERE id = ?", (servings, note, rid))
+			cur.execute("DELETE FROM m_recipe_ingredients WHERE recipe_id = ?", (rid,))
+		else:
+			cur.execute("INSERT INTO m_recipes (name, servings, note) VALUES (?, ?, ?)", (name, servings, note))
+			rid = cur.lastrowid
+		cur.executemany("INSERT INTO m_recipe_ingredients (recipe_id, food_type, food_id, amount) VALUES (?, ?, ?, ?)",
+			[(rid, 'PROCESSED' if t == 'OUT_EAT' else t, fid, amt) for t, fid, amt in ingredients])
+		self._update_nutrition([rid])
+		return rid
+
+	def list_recipes(self):
+		"""1人前の栄養素付きの一覧 (食品マスタが変わっていれば再計算してから返す)"""
+		if not self.db.derived_is_fresh('m_recipes', FoodMasterStore.MASTERS_TABLES):
+			self._update_nutrition()
+		cur = self.db.cursor
+		cur.execute("SELECT * FROM m_recipes ORDER BY name")
+		return cur.fetchall()
+
+	def allocate(self, recipe_id, servings):
+		"""
+		食材ごとに期限の早い順で在庫ロットを引き当てる。
+		戻り値: (引当 [(inventory_id, detail_id, 量)], 不足 [(食材名, 不足量)])
+		"""
+		cur = self.db.cursor
+		cur.execute("SELECT servings FROM m_recipes WHERE id = ?", (recipe_id,))
+		scale = servings / (cur.fetchone()['servings'] or 1)
+		cur.execute("""
+			SELECT i.food_type, i.food_id, SUM(i.amount) as amount
+			FROM m_recipe_ingredients i WHERE i.recipe_id = ?
+			GROUP BY i.food_type, i.food_id
+		""", (recipe_id,))
+		needs = {(r['food_type'], r['food_id']): r['amount'] * scale for r in cur.fetchall()}
+
+		# 全食材の候補ロットを1回のクエリで取得
+		cur.execute("""
+			SELECT inv.id as inv_id, inv.detail_id, inv.current_quantity, td.food_type, td.food_id
+			FROM t_inventory inv
+			JOIN t_transaction_details td ON inv.detail_id = td.id
+			JOIN t_transactions t ON td.transaction_id = t.id
+			JOIN m_recipe_ingredients i ON i.recipe_id = ? AND i.food_id = td.food_id AND i.food_type = td.food_type
+			LEFT JOIN m_foods_universal u ON td.food_id = u.id AND td.food_type = 'UNIVERSAL'
+			WHERE inv.current_quantity > 0
+			GROUP BY inv.id
+			ORDER BY COALESCE(td.limit_date, t.transaction_at + COALESCE(u.shelf_life_days_guideline, 9999)) ASC, inv.id
+		""", (recipe_id,))
+		picks = []
+		for r in cur.fetchall():
+			key = (r['food_type'], r['food_id'])
+			need = needs.get(key, 0)
+			if need <= 1e-9: continue
+			use = min(need, r['current_quantity'])
+			picks.append((r['inv_id'], r['detail_id'], use))
+			needs[key] = need - use
+
+		store = self.master_mgr.store
+		short = []
+		for (f_type, f_id), rest in needs.items():
+			if rest > 1e-9:
+				rec = store.get(f_type, f_id)
+				short.append((rec.name if rec else f"{f_type}:{f_id}", rest))
+		return picks, short
+
+	def cook(self, recipe_id, servings, eaten_at=None, consume_type='SELF'):
+		"""レシピを調理して在庫を消費する。食材が足りなければ何もせず不足一覧を返す"""
+		picks, short = self.allocate(recipe_id, servings)
+		if short or not picks: return None, short
+		cur = self.db.cursor
+		cur.execute("SELECT name FROM m_recipes WHERE id = ?", (recipe_id,))
+		name = cur.fetchone()['name']
+		eaten_at = eaten_at or datetime_to_serial(datetime.datetime.now())
+		cur.execute("INSERT INTO t_meal_logs (eaten_at, note) VALUES (?, ?)", (eaten_at, name))
+		mid = cur.lastrowid
+		cur.executemany("INSERT INTO t_meal_details (meal_name, meal_id, inventory_id, detail_id, amount_consumed, consume_type) VALUES (?, ?, ?, ?, ?, ?)",
+			[(name, mid, inv_id, detail_id, use, consume_type) for inv_id, detail_id, use in picks])
+		cur.executemany("UPDATE t_inventory SET current_quantity = current_quantity - ?, updated_at = ? WHERE id = ?",
+			[(use, eaten_at, inv_id) for inv_id, _, use in picks])
+		self.db.conn.commit()
+		return mid, []
+
+	# --- 画面 ---
+	def _input_recipe(self):
+		name = get_input("レシピ名")
+		servings = get_input("何人前の分量ですか [def:1]", required=False, cast_func=float) or 1
+		ingredients = []
+		print("--- 食材入力 (Enterで終了) ---")
+		while True:
+			q = get_input("食材名", required=False)
+			if not q: break
+			candidates = self.master_mgr.find_food_master_fuzzy(q)
+			if not candidates:
+				print("食品マスタに見つかりません。")
+				continue
+			for i, c in enumerate(candidates):
+				print(f"  {i+1}: {c['name']} [{c['type']}]")
+			sel = get_input("選択", cast_func=int)
+			if not 1 <= sel <= len(candidates): continue
+			c = candidates[sel - 1]
+			unit = "g" if c['type'] == 'MEASURED' else ("食" if c['type'] == 'PROCESSED' else "個")
+			amt = get_input(f"量 [{unit}]", cast_func=float)
+			ingredients.append((c['type'], c['id'], amt))
+		if not ingredients:
+			print("食材がないため登録しません。")
+			return
+		self.save_recipe(name, servings, ingredients)
+		print(f"レシピ「{name}」を保存しました")
+
+	def show_recipe_menu(self):
+		print("\n=== レシピ ===")
+		print(" 1. 登録・更新")
+		print(" 2. 一覧 (1人前の栄養素)")
+		print(" 3. 調理 (在庫から一括消費)")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel == '1':
+			self._input_recipe()
+			return
+		if sel not in ('2', '3'): return
+
+		recipes = self.list_recipes()
+		if not recipes:
+			print("レシピがありません。")
+			return
+		rep = ReportManager(self.db)
+		rep._print_header([("No", 4, 'left'), ("レシピ名", 24, 'left'), ("Kcal", 6, 'right'), ("Prot", 6, 'right'), ("Fat", 6, 'right'), ("Carb", 6, 'right'), ("Salt", 5, 'right')])
+		for i, r in enumerate(recipes):
+			rep._print_row([(str(i+1), 4, 'left'), (r['name'], 24, 'left'), (f"{int(r['energy_kcal'])}", 6, 'right'), (f"{r['protein_g']:.1f}", 6, 'right'),
+				(f"{r['fat_g']:.1f}", 6, 'right'), (f"{r['carb_g']:.1f}", 6, 'right'), (f"{r['salt_equiv_g']:.1f}", 5, 'right')])
+		if sel == '2': return
+
+		no = get_input("調理するレシピNo", cast_func=int)
+		if not 1 <= no <= len(recipes): return
+		recipe = recipes[no - 1]
+		servings = get_input(f"人前 [def:{recipe['servings']:g}]", required=False, cast_func=float) or recipe['servings']
+		ctype_in = get_input("タイプ (1:食べる, 2:廃棄, 3:譲渡) [def:1]", required=False)
+		c_type = {'1':'SELF', '2':'LOSS', '3':'GIFT'}.get(ctype_in, 'SELF')
+		mid, short = self.cook(recipe['id'], servings, consume_type=c_type)
+		if short:
+			print("在庫が不足しているため調理できません:")
+			for food_name, rest in short:
+				print(f"  {food_name}: あと {rest:g}")
+		elif mid:
+			print(f"「{recipe['name']}」を消費しました")
+
+# ==========================================
+# 16. 消費ペース予測・買い物リスト
+# ==========================================
+class ConsumptionForecast:
+	"""
+	食品マスタごとの1日あたり消費量を、日別の消費量系列の指数平滑で推定して t_consumption_rates に保持する。
+	- 確定した日(昨日まで)のみを対象に、前回からの差分日だけを全食品まとめてベクトル演算で加算する。
+	  level(D) = level(D0) * (1-α)^(D-D0) + Σ α * (1-α)^(D-d) * x(d)
+	- 処理済みの日付に後から記録された消費や、消費記録の削除を検知した場合は全体を作り直す。
+	- 廃棄(LOSS)は需要ではないので消費ペースに含めない。
+	推定したペースで在庫ロットを期限の早い順に使い切る想定で、ロットごとの使い切り日・期限切れを予測する。
+	"""
+	ALPHA = 0.1           # 平滑化係数 (半減期 約6.6日)
+	USAGE_TYPES = ('SELF', 'GIFT')
+	MIN_RATE = 0.01       # これ未満/日 のペースは使っていないものとみなす
+	HORIZON_DAYS = 7      # この日数以内に在庫が尽きる食品を買い物リストに載せる
+	COVER_DAYS = 14       # 買い物リストの提案量 (何日分)
+
+	def __init__(self, db: Database, store=None):
+		self.db = db
+		self.store = store or FoodMasterStore(db)
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_consumption_rates (
+				food_type TEXT NOT NULL,
+				food_id INTEGER NOT NULL,
+				level REAL NOT NULL,                 -- 指数平滑した1日あたり消費量 (初期バイアス補正前)
+				first_day INTEGER NOT NULL,          -- 最初に消費した日 (バイアス補正用)
+				PRIMARY KEY (food_type, food_id)
+			) WITHOUT ROWID
+		""")
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_forecast_state (
+				id INTEGER PRIMARY KEY CHECK(id = 1),
+				last_day INTEGER NOT NULL,           -- どの日まで平滑化に反映済みか
+				watermark_id INTEGER NOT NULL,       -- 前回更新時点の t_meal_details.id の最大値
+				detail_count INTEGER NOT NULL        -- 前回更新時点の id <= watermark_id の件数 (削除検知用)
+			)
+		""")
+		self.db.conn.commit()
+
+	def _usage_sql(self, src):
+		return f"""
+			SELECT td.food_type, td.food_id, CAST(ml.eaten_at AS INTEGER) as day, SUM(md.amount_consumed) as qty
+			FROM {src['t_meal_details']} md
+			JOIN {src['t_meal_logs']} ml ON md.meal_id = ml.id
+			JOIN {src['t_transaction_details']} td ON md.detail_id = td.id
+			WHERE td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED') AND td.food_id IS NOT NULL
+			  AND COALESCE(md.consume_type, 'SELF') IN ({', '.join(f"'{t}'" for t in self.USAGE_TYPES)})
+			  AND ml.eaten_at >= ? AND ml.eaten_at < ?
+			GROUP BY td.food_type, td.food_id, day
+		"""
+
+	def _apply(self, rows, from_day, to_day, full):
+		"""(from_day, to_day] の日別消費量を平滑化済みの値に加算して保存"""
+		cur = self.db.cursor
+		decay = 1.0 - self.ALPHA
+		if full:
+			cur.execute("DELETE FROM t_consumption_rates")
+			keys, level, first = [], np.zeros(0), np.zeros(0, dtype=np.int64)
+		else:
+			cur.execute("SELECT food_type, food_id, level, first_day FROM t_consumption_rates")
+			existing = cur.fetchall()
+			keys = [(r['food_type'], r['food_id']) for r in existing]
+			level = np.array([r['level'] for r in existing], dtype=float) * decay ** (to_day - from_day)
+			first = np.array([r['first_day'] for r in existing], dtype=np.int64)
+
+		index = {k: i for i, k in enumerate(keys)}
+		new_keys = list(dict.fromkeys((r['food_type'], r['food_id']) for r in rows if (r['food_type'], r['food_id']) not in index))
+		for k in new_keys: index[k] = len(index)
+		keys += new_keys
+		level = np.concatenate([level, np.zeros(len(new_keys))])
+		first = np.concatenate([first, np.full(len(new_keys), to_day + 1, dtype=np.int64)])
+
+		if rows:
+			idx = np.array([index[(r['food_type'], r['food_id'])] for r in rows], dtype=np.int64)
+			days = np.array([r['day'] for r in rows], dtype=np.int64)
+			qty = np.array([r['qty'] for r in rows], dtype=float)
+			np.add.at(level, idx, self.ALPHA * qty * decay ** (to_day - days))
+			np.minimum.at(first, idx, days)
+
+		cur.executemany("INSERT OR REPLACE INTO t_consumption_rates (food_type, food_id, level, first_day) VALUES (?, ?, ?, ?)",
+			[(k[0], k[1], float(level[i]), int(first[i])) for i, k in enumerate(keys)])
+
+	def refresh(self, today=None, full=False):
+		"""昨日までの消費を反映する (差分のみ)。作り直した場合は True"""
+		today = int(today if today is not None else datetime_to_serial(datetime.datetime.now()))
+		to_day = today - 1
+		cur = self.db.cursor
+		cur.execute("SELECT last_day, watermark_id, detail_count FROM t_forecast_state WHERE id = 1")
+		state = cur.fetchone()
+		cur.execute("SELECT COALESCE(MAX(id), 0) FROM t_meal_details")
+		watermark = cur.fetchone()[0]
+
+		if state and not full:
+			# 削除・処理済みの日付への後付けがあれば全体を作り直す
+			cur.execute("SELECT COUNT(*) FROM t_meal_details WHERE id <= ?", (state['watermark_id'],))
+			deleted = cur.fetchone()[0] != state['detail_count']
+			cur.execute("""
+				SELECT 1 FROM t_meal_details md JOIN t_meal_logs ml ON md.meal_id = ml.id
+				WHERE md.id > ? AND ml.eaten_at < ? LIMIT 1
+			""", (state['watermark_id'], state['last_day'] + 1))
+			full = deleted or cur.fetchone() is not None
+			if not full and state['last_day'] >= to_day and state['watermark_id'] == watermark: return False
+
+		if state and not full:
+			from_day = state['last_day']
+			cur.execute(self._usage_sql({t: t for t in ('t_meal_logs', 't_meal_details', 't_transaction_details')}), (from_day + 1, to_day + 1))
+		else:
+			full = True
+			src = ArchiveManager(self.db).sources(['t_meal_logs', 't_meal_details', 't_transaction_details'])
+			cur.execute(self._usage_sql(src), (0, to_day + 1))
+		rows = cur.fetchall()
+		if full:
+			from_day = min((r['day'] for r in rows), default=to_day) - 1
+		self._apply(rows, from_day, max(to_day, from_day), full)
+
+		cur.execute("SELECT COUNT(*) FROM t_meal_details WHERE id <= ?", (watermark,))
+		count = cur.fetchone()[0]
+		cur.execute("INSERT OR REPLACE INTO t_forecast_state (id, last_day, watermark_id, detail_count) VALUES (1, ?, ?, ?)",
+			(max(to_day, from_day), watermark, count))
+		self.db.conn.commit()
+		return full
+
+	def rates(self):
+		"""{(food_type, food_id): 1日あたり消費量}。最初の消費からの日数で初期バイアスを補正する"""
+		cur = self.db.cursor
+		cur.execute("SELECT last_day FROM t_forecast_state WHERE id = 1")
+		row = cur.fetchone()
+		if row is None: return {}
+		cur.execute("SELECT food_type, food_id, level, first_day FROM t_consumption_rates")
+		rows = cur.fetchall()
+		if not rows: return {}
+		level = np.array([r['level'] for r in rows], dtype=float)
+		span = row['last_day'] - np.array([r['first_day'] for r in rows], dtype=float) + 1
+		rate = level / np.maximum(1.0 - (1.0 - self.ALPHA) ** np.maximum(span, 1), 1e-12)
+		return {(r['food_type'], r['food_id']): float(rate[i]) for i, r in enumerate(rows)}
+
+	def forecast(self, today=None):
+		"""
+		ロットごとの使い切り予測と買い物リストを返す。
+		戻り値: {'lots': [{inv_id, name, food, qty, expiry_at, end_at, status, waste}], 'restock': [{food, name, rate, stock, end_at, suggest}]}
+		status: RUNOUT(期限内に使い切る) / EXPIRE(使い切る前に期限切れ) / EXPIRED(既に期限切れ) / IDLE(消費ペースなし)
+		"""
+		now = datetime_to_serial(datetime.datetime.now()) if today is None else today
+		today = int(now)
+		self.refresh(today)
+		self.store.refresh()
+		rates = self.rates()
+
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT inv.id as inv_id, td.food_type, td.food_id, td.item_name_receipt, inv.current_quantity,
+				COALESCE(td.limit_date, t.transaction_at + fu.shelf_life_days_guideline) as expiry_at
+			FROM t_inventory inv
+			JOIN t_transaction_details td ON inv.detail_id = td.id
+			JOIN t_transactions t ON td.transaction_id = t.id
+			LEFT JOIN m_foods_universal fu ON td.food_id = fu.id AND td.food_type = 'UNIVERSAL'
+			WHERE inv.current_quantity > 0 AND td.food_id IS NOT NULL
+			  AND td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED')
+			ORDER BY td.food_type, td.food_id, COALESCE(expiry_at, 1e9), inv.id
+		""")
+		by_food = {}
+		for r in cur.fetchall():
+			by_food.setdefault((r['food_type'], r['food_id']), []).append(r)
+
+		lots, restock = [], []
+		for key in set(by_food) | {k for k, v in rates.items() if v >= self.MIN_RATE}:
+			rate = rates.get(key, 0.0)
+			rec = self.store.get(*key)
+			name = rec.name if rec else f"{key[0]}:{key[1]}"
+			# 期限の早いロットから順にペース通り消費すると仮定して、各ロットの終わる日を進める
+			t, stock = now, 0.0
+			for r in by_food.get(key, []):
+				qty, expiry = r['current_quantity'], r['expiry_at']
+				if expiry is not None and expiry < now:
+					status, end, waste = 'EXPIRED', expiry, qty
+				elif rate < self.MIN_RATE:
+					status, end, waste = 'IDLE', None, 0.0
+				else:
+					runout = t + qty / rate
+					if expiry is not None and expiry < runout:
+						status, end, waste = 'EXPIRE', expiry, qty - rate * (expiry - t)
+					else:
+						status, end, waste = 'RUNOUT', runout, 0.0
+					t = end
+					stock += qty - waste
+				lots.append({'inv_id': r['inv_id'], 'name': r['item_name_receipt'] or name, 'food': key, 'qty': qty,
+					'expiry_at': expiry, 'end_at': end, 'status': status, 'waste': waste})
+			if rate >= self.MIN_RATE and t < now + self.HORIZON_DAYS:
+				restock.append({'food': key, 'name': name, 'rate': rate, 'stock': stock, 'end_at': t,
+					'suggest': max(rate * self.COVER_DAYS - max(stock - rate * (self.HORIZON_DAYS), 0.0), 0.0)})
+
+		lots.sort(key=lambda x: (x['end_at'] is None, x['end_at'] or 0))
+		restock.sort(key=lambda x: x['end_at'])
+		return {'lots': lots, 'restock': restock}
+
+	def show_forecast(self):
+		if not require_numpy("消費ペース予測"): return
+		if (get_input("消費ペースを全期間から作り直しますか？ (y/N)", required=False) or '').lower() == 'y':
+			self.refresh(full=True)
+		res = self.forecast()
+		rep = ReportManager(self.db)
+		units = {'UNIVERSAL': '個', 'MEASURED': 'g', 'PROCESSED': '食'}
+
+		print(f"\n=== 買い物リスト ({self.HORIZON_DAYS}日以内に無くなる食品 / {self.COVER_DAYS}日分を提案) ===")
+		if not res['restock']: print("なし")
+		else:
+			rep._print_header([("食品", 24, 'left'), ("ペース/日", 10, 'right'), ("残量", 10, 'right'), ("無くなる日", 10, 'left'), ("提案量", 10, 'right')])
+			for r in res['restock']:
+				u = units[r['food'][0]]
+				rep._print_row([(r['name'], 24, 'left'), (f"{r['rate']:.2f}{u}", 10, 'right'), (f"{r['stock']:g}{u}", 10, 'right'),
+					(format_serial(r['end_at'], '%m/%d'), 10, 'left'), (f"{r['suggest']:.1f}{u}", 10, 'right')])
+
+		print("\n=== 在庫ロットの使い切り予測 ===")
+		if not res['lots']: print("なし")
+		else:
+			labels = {'RUNOUT': '使い切り', 'EXPIRE': '期限切れ予測', 'EXPIRED': '期限切れ', 'IDLE': '消費なし'}
+			rep._print_header([("品名", 24, 'left'), ("残量", 8, 'right'), ("期限", 6, 'left'), ("終了日", 6, 'left'), ("予測", 12, 'left'), ("廃棄見込", 8, 'right')])
+			for r in res['lots']:
+				rep._print_row([(r['name'], 24, 'left'), (f"{r['qty']:g}", 8, 'right'),
+					(format_serial(r['expiry_at'], '%m/%d') if r['expiry_at'] is not None else "-", 6, 'left'),
+					(format_serial(r['end_at'], '%m/%d') if r['end_at'] is not None else "-", 6, 'left'),
+					(labels[r['status']], 12, 'left'), (f"{r['waste']:.1f}" if r['waste'] > 0 else "", 8, 'right')])
+
+# ==========================================
+# 17. 銀行・カード明細との照合
+# ==========================================
+class StatementReconciler:
+	"""
+	銀行・カードの明細CSVを BANK / CREDIT 財布の t_payments と照合する。
+	台帳側は取引ごとに財布の増減を合算し、明細行と「金額が一致し、日付の差が許容日数以内」で対応付ける。
+	金額でハッシュ分けしたバケット内を日付順に並べ、2本のポインタで貪欲に突き合わせる (O(n log n))。
+	確定した対応は t_reconciled に記録し、同じ明細を再度読み込んでも同じ取引に対応付ける。
+	"""
+	WALLET_GROUPS = ('BANK', 'CREDIT')
+	DEFAULT_TOLERANCE_DAYS = 3
+
+	# 見出しの候補 (部分一致)
+	DATE_HEADERS = ('日付', '取引日', '利用日', '年月日', 'date')
+	AMOUNT_HEADERS = ('金額', 'amount')
+	OUT_HEADERS = ('出金', '引出', '支払', 'withdrawal', 'debit')
+	IN_HEADERS = ('入金', '預入', '受取', 'deposit', 'credit')
+	DESC_HEADERS = ('摘要', '内容', '店名', 'description', 'memo')
+
+	def __init__(self, db: Database, trans_mgr: TransactionManager):
+		self.db = db
+		self.trans_mgr = trans_mgr
+		self.db.cursor.execute("""
+			CREATE TABLE IF NOT EXISTS t_reconciled (
+				wallet_id INTEGER NOT NULL,
+				transaction_id INTEGER NOT NULL,
+				line_key TEXT NOT NULL,              -- 明細行の識別子 (日付|金額|摘要|同一行の通番)
+				reconciled_at REAL NOT NULL,
+				PRIMARY KEY (wallet_id, transaction_id)
+			)
+		""")
+		self.db.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_reconciled_line ON t_reconciled(wallet_id, line_key)")
+		self.db.conn.commit()
+
+	# --- 明細の読み込み ---
+	@staticmethod
+	def _parse_amount(text):
+		text = unicodedata.normalize('NFKC', text or '')
+		for ch in (',', '円', '¥', '\\', ' '):
+			text = text.replace(ch, '')
+		if not text or text == '-': return 0
+		return int(round(float(text)))
+
+	@staticmethod
+	def _parse_date(text):
+		"""YYYY/MM/DD, YYYY-MM-DD, YYYY年M月D日, YYYYMMDD をシリアル値(日)に"""
+		text = unicodedata.normalize('NFKC', text or '').strip().split(' ')[0]
+		for ch in ('-', '.', '年', '月'):
+			text = text.replace(ch, '/')
+		text = text.replace('日', '')
+		parts = text.split('/') if '/' in text else ([text[:4], text[4:6], text[6:8]] if len(text) == 8 else [])
+		if len(parts) != 3 or not all(p.isdigit() for p in parts): return None
+		return int(datetime_to_serial(datetime.datetime(int(parts[0]), int(parts[1]), int(parts[2]))))
+
+	def _find_column(self, header, candidates, exclude=()):
+		for i, h in enumerate(header):
+			h = unicodedata.normalize('NFKC', h).lower()
+			if any(c in h for c in candidates) and not any(c in h for c in exclude):
+				return i
+		return None
+
+	def load_statement(self, path, usage_positive=False):
+		"""
+		明細CSVを読み込む (UTF-8 / Shift_JIS)。先頭の説明行は飛ばして見出し行を探す。
+		usage_positive: カード明細のように利用額が正で書かれている場合 True (財布の増減に符号を反転する)
+		戻り値: [{'day', 'amount'(財布の増減), 'desc', 'key'}]
+		"""
+		for enc in ('utf-8-sig', 'cp932'):
+			try:
+				with open(path, newline='', encoding=enc) as f:
+					rows = list(csv.reader(f))
+				break
+			except UnicodeDecodeError:
+				continue
+		else:
+			raise ValueError("文字コードを判別できません")
+
+		for h_idx, header in enumerate(rows[:10]):
+			c_date = self._find_column(header, self.DATE_HEADERS)
+			c_out = self._find_column(header, self.OUT_HEADERS)
+			c_in = self._find_column(header, self.IN_HEADERS)
+			c_amt = self._find_column(header, self.AMOUNT_HEADERS, exclude=self.OUT_HEADERS + self.IN_HEADERS)
+			if c_date is not None and (c_amt is not None or c_out is not None or c_in is not None): break
+		else:
+			raise ValueError("日付・金額の見出し行が見つかりません")
+		c_desc = self._find_column(header, self.DESC_HEADERS)
+
+		lines, seen = [], {}
+		for row in rows[h_idx + 1:]:
+			if len(row) <= c_date: continue
+			day = self._parse_date(row[c_date])
+			if day is None: continue  # 合計行など
+			cell = lambda c: row[c] if c is not None and c < len(row) else ''
+			if c_out is not None or c_in is not None:
+				amount = self._parse_amount(cell(c_in)) - self._parse_amount(cell(c_out))
+			else:
+				amount = self._parse_amount(cell(c_amt))
+				if usage_positive: amount = -amount
+			if amount == 0: continue
+			desc = cell(c_desc).strip()
+			base = f"{day}|{amount}|{desc}"
+			seen[base] = seen.get(base, 0) + 1
+			lines.append({'day': day, 'amount': amount, 'desc': desc, 'key': f"{base}|{seen[base]}"})
+		return lines
+
+	# --- 照合 ---
+	def _ledger(self, wallet_id, start_day, end_day):
+		"""期間内の取引ごとの財布の増減 (他の明細行で照合済みのものを含む)"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_payments'], start_day, end_day + 1)
+		cur = self.db.cursor
+		cur.execute(f"""
+			SELECT p.transaction_id, SUM(p.amount) as amount, t.transaction_at, t.transaction_name, r.line_key
+			FROM {src['t_payments']} p
+			JOIN {src['t_transactions']} t ON p.transaction_id = t.id
+			LEFT JOIN t_reconciled r ON r.wallet_id = p.wallet_id AND r.transaction_id = p.transaction_id
+			WHERE p.wallet_id = ? AND t.transaction_at >= ? AND t.transaction_at < ?
+			GROUP BY p.transaction_id
+			HAVING SUM(p.amount) != 0
+		""", (wallet_id, start_day, end_day + 1))
+		return cur.fetchall()
+
+	def reconcile(self, wallet_id, lines, tolerance_days=None):
+		"""
+		戻り値: (matches [(明細行, 台帳行)], 明細にのみある行, 台帳にのみある行)
+		"""
+		tol = self.DEFAULT_TOLERANCE_DAYS if tolerance_days is None else tolerance_days
+		if not lines: return [], [], []
+		ledger = self._ledger(wallet_id, min(l['day'] for l in lines) - tol, max(l['day'] for l in lines) + tol)
+
+		# 前回確定した対応を優先し、他の明細で照合済みの取引は対象外にする
+		keys = {l['key']: l for l in lines}
+		matches, free = [], []
+		for r in ledger:
+			if r['line_key'] is None: free.append(r)
+			elif r['line_key'] in keys: matches.append((keys.pop(r['line_key']), r))
+
+		buckets = {}
+		for l in keys.values():
+			buckets.setdefault(l['amount'], ([], []))[0].append(l)
+		for r in free:
+			buckets.setdefault(r['amount'], ([], []))[1].append(r)
+
+		only_statement, only_ledger = [], []
+		for st, led in buckets.values():
+			st.sort(key=lambda l: l['day'])
+			led.sort(key=lambda r: r['transaction_at'])
+			j = 0
+			for l in st:
+				# 日付が窓より前の台帳行はもう対応しない
+				while j < len(led) and int(led[j]['transaction_at']) < l['day'] - tol:
+					only_ledger.append(led[j])
+					j += 1
+				if j < len(led) and int(led[j]['transaction_at']) <= l['day'] + tol:
+					matches.append((l, led[j]))
+					j += 1
+				else:
+					only_statement.append(l)
+			only_ledger.extend(led[j:])
+
+		only_statement.sort(key=lambda l: l['day'])
+		only_ledger.sort(key=lambda r: r['transaction_at'])
+		return matches, only_statement, only_ledger
+
+	def confirm(self, wallet_id, matches):
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		self.db.cursor.executemany("INSERT OR REPLACE INTO t_reconciled (wallet_id, transaction_id, line_key, reconciled_at) VALUES (?, ?, ?, ?)",
+			[(wallet_id, r['transaction_id'], l['key'], now_serial) for l, r in matches])
+		self.db.conn.commit()
+
+	def create_missing(self, wallet_id, lines, category_id=None, income_category_id=None):
+		"""明細にのみある行を取引として一括登録し、照合済みにする (入金の行は income_category_id を付ける)"""
+		entries = [{'at': l['day'] + 0.5, 'name': l['desc'] or "明細取込", 'item_name': l['desc'], 'wallet_id': wallet_id,
+			'amount': l['amount'], 'category_id': income_category_id if l['amount'] > 0 else category_id} for l in lines]
+		trans_ids = self.trans_mgr.import_transactions(entries)
+		self.confirm(wallet_id, [(l, {'transaction_id': tid}) for l, tid in zip(lines, trans_ids)])
+		return trans_ids
+
+	def show_reconcile_menu(self):
+		print("\n=== 銀行・カード明細の照合 ===")
+		cur = self.db.cursor
+		cur.execute(f"""
+			SELECT w.id, w.name, w.wallet_group FROM m_wallets w
+			WHERE w.wallet_group IN ({', '.join(f"'{g}'" for g in self.WALLET_GROUPS)}) AND COALESCE(w.is_active, 1) = 1
+			ORDER BY w.id
+		""")
+		wallets = cur.fetchall()
+		if not wallets:
+			print("銀行・クレジットの財布がありません。")
+			return
+		for i, w in enumerate(wallets):
+			print(f"  {i+1}: {w['name']} ({w['wallet_group']})")
+		sel = get_input("財布 (Enterで戻る)", required=False, cast_func=int)
+		if not sel or not 1 <= sel <= len(wallets): return
+		wallet = wallets[sel - 1]
+
+		path = get_input("明細CSVのパス")
+		usage_positive = (get_input("利用額が正の値で書かれた明細ですか？ [def:CREDITならy] (y/n)", required=False)
+			or ('y' if wallet['wallet_group'] == 'CREDIT' else 'n')).lower() == 'y'
+		tol = get_input(f"日付の許容差(日) [def:{self.DEFAULT_TOLERANCE_DAYS}]", required=False, cast_func=int)
+		try:
+			lines = self.load_statement(path, usage_positive)
+		except (OSError, ValueError) as e:
+			print(f"読み込みに失敗しました: {e}")
+			return
+
+		matches, only_st, only_led = self.reconcile(wallet['id'], lines, tol)
+		print(f"\n明細 {len(lines)} 行 / 一致 {len(matches)} 件")
+		print("\n--- 明細にのみある行 (台帳に未登録) ---")
+		if not only_st: print("なし")
+		for l in only_st:
+			print(f"  {format_serial(l['day'], '%Y/%m/%d')} {l['amount']:>10,} {l['desc']}")
+		print("\n--- 台帳にのみある取引 (明細に無い) ---")
+		if not only_led: print("なし")
+		for r in only_led:
+			print(f"  {format_serial(r['transaction_at'], '%Y/%m/%d')} {int(r['amount']):>10,} [ID:{r['transaction_id']}] {r['transaction_name'] or ''}")
+
+		if matches and (get_input("一致した対応を照合済みとして記録しますか？ (y/n)", required=False) or '').lower() == 'y':
+			self.confirm(wallet['id'], matches)
+			print("記録しました")
+		if only_st and (get_input("明細にのみある行を取引として一括登録しますか？ (y/n)", required=False) or '').lower() == 'y':
+			cur.execute("SELECT id, name, type FROM m_categories ORDER BY id")
+			for c in cur.fetchall():
+				print(f"  {c['id']}: {c['name']} ({c['type']})")
+			cat_id = get_input("支出のカテゴリID (Enterで未分類)", required=False, cast_func=int)
+			income_cat_id = None
+			if any(l['amount'] > 0 for l in only_st):
+				income_cat_id = get_input("入金のカテゴリID (Enterで未分類)", required=False, cast_func=int)
+			trans_ids = self.create_missing(wallet['id'], only_st, cat_id, income_cat_id)
+			print(f"{len(trans_ids)} 件の取引を登録しました")
+
+# ==========================================
+# 18. 月次明細ファイルの一括出力 (プロセス並列)
+# ==========================================
+_statement_db = None  # ワーカープロセスごとの参照専用接続
+
+def _statement_worker_init(db_path):
+	global _statement_db
+	_statement_db = ReadOnlyDatabase(db_path)
+
+def _statement_worker(ym, out_dir, formats):
+	return MonthlyStatementExporter.render_month(_statement_db, ym, out_dir, formats)
+
+class MonthlyStatementExporter:
+	"""
+	指定期間の各月について「取引一覧・日別栄養素・財布の入出金」を text / CSV / HTML ファイルに書き出す。
+	月ごとに独立しているため ProcessPoolExecutor で並列に処理し、各ワーカーは参照専用の接続を1つ持つ。
+	出力: {out_dir}/{YYYYMM}.txt, {YYYYMM}.html, {YYYYMM}_{transactions|nutrition|wallets}.csv
+	"""
+	FORMATS = ('txt', 'csv', 'html')
+
+	def __init__(self, db: Database):
+		self.db = db
+
+	@staticmethod
+	def _months(ym_from, ym_to):
+		y, m = int(ym_from[:4]), int(ym_from[4:])
+		months = []
+		while f"{y}{m:02d}" <= ym_to:
+			months.append(f"{y}{m:02d}")
+			y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+		return months
+
+	@staticmethod
+	def build_sections(db, ym):
+		"""1か月分の表を [(キー, 見出し, 列名, 行)] で返す"""
+		s, e = get_month_range(ym)
+		rep = ReportManager(db)
+		sections = []
+
+		rows, _ = rep._fetch_transactions(s, e)
+		sections.append(('transactions', "取引一覧", ["ID", "日時", "取引名", "ブランド", "金額"],
+			[[r['id'], format_serial(r['transaction_at']), r['transaction_name'] or "", r['brand'] or "", int(r['total'])]
+				for r in sorted(rows, key=lambda r: r['transaction_at'])]))
+
+		data = rep._fetch_daily_nutrition(s, e)
+		n_rows, totals = [], [0.0] * len(NUTRIENT_FIELDS)
+		for day in range(int(s), int(e) + 1):
+			row = data.get(day)
+			vals = [row[f] for f in NUTRIENT_FIELDS] if row else [0.0] * len(NUTRIENT_FIELDS)
+			totals = [t + v for t, v in zip(totals, vals)]
+			n_rows.append([format_serial(day, "%Y/%m/%d")] + [round(v, 1) for v in vals])
+		days = int(e) - int(s) + 1
+		n_rows.append(["合計"] + [round(t, 1) for t in totals])
+		n_rows.append(["1日平均"] + [round(t / days, 1) for t in totals])
+		sections.append(('nutrition', "日別栄養素", ["日付"] + [NUTRIENT_LABELS[f] for f in NUTRIENT_FIELDS], n_rows))
+
+		# 財布の入出金: 月初残高は月初より前の決済の累計
+		src = ArchiveManager(db).sources(['t_transactions', 't_payments'])
+		db.cursor.execute(f"""
+			SELECT w.name, c.display_unit,
+				SUM(CASE WHEN t.transaction_at < :s THEN p.amount ELSE 0 END) as opening,
+				SUM(CASE WHEN t.transaction_at BETWEEN :s AND :e AND p.amount > 0 THEN p.amount ELSE 0 END) as income,
+				SUM(CASE WHEN t.transaction_at BETWEEN :s AND :e AND p.amount < 0 THEN p.amount ELSE 0 END) as expense,
+				SUM(CASE WHEN t.transaction_at <= :e THEN p.amount ELSE 0 END) as closing
+			FROM {src['t_payments']} p
+			JOIN {src['t_transactions']} t ON p.transaction_id = t.id
+			JOIN m_wallets w ON p.wallet_id = w.id
+			JOIN m_currencies c ON w.currency_id = c.id
+			WHERE t.transaction_at <= :e
+			GROUP BY w.id ORDER BY w.id
+		""", {'s': s, 'e': e})
+		sections.append(('wallets', "財布の入出金", ["財布名", "単位", "月初残高", "入金", "出金", "月末残高"],
+			[[r['name'], r['display_unit'], int(r['opening']), int(r['income']), int(-r['expense']), int(r['closing'])]
+				for r in db.cursor.fetchall()]))
+		return sections
+
+	@staticmethod
+	def _write_txt(path, ym, sections):
+		with open(path, 'w', encoding='utf-8') as f:
+			f.write(f"{ym[:4]}年{ym[4:]}月 明細\n")
+			for _, title, header, rows in sections:
+				widths = [max([get_str_width(str(h))] + [get_str_width(str(r[i])) for r in rows]) for i, h in enumerate(header)]
+				f.write(f"\n=== {title} ===\n")
+				f.write(" | ".join(pad_str(str(h), w, 'left') for h, w in zip(header, widths)) + "\n")
+				f.write("-+-".join("-" * w for w in widths) + "\n")
+				for r in rows:
+					f.write(" | ".join(pad_str(str(v), w, 'right' if isinstance(v, (int, float)) else 'left') for v, w in zip(r, widths)) + "\n")
+
+	@staticmethod
+	def _write_html(path, ym, sections):
+		parts = [f"<!DOCTYPE html><html lang=\"ja\"><head><meta charset=\"utf-8\"><title>{ym} 明細</title>",
+			"<style>table{border-collapse:collapse}td,th{border:1px solid #999;padding:2px 6px}td.n{text-align:right}</style></head><body>",
+			f"<h1>{ym[:4]}年{ym[4:]}月 明細</h1>"]
+		for _, title, header, rows in sections:
+			parts.append(f"<h2>{html.escape(title)}</h2><table><tr>" + "".join(f"<th>{html.escape(str(h))}</th>" for h in header) + "</tr>")
+			for r in rows:
+				parts.append("<tr>" + "".join(f"<td class=\"n\">{v:,}</td>" if isinstance(v, (int, float)) else f"<td>{html.escape(str(v))}</td>" for v in r) + "</tr>")
+			parts.append("</table>")
+		parts.append("</body></html>")
+		with open(path, 'w', encoding='utf-8') as f:
+			f.write("\n".join(parts))
+
+	@classmethod
+	def render_month(cls, db, ym, out_dir, formats):
+		"""1か月分のファイルを書き出して、書いたファイル数を返す"""
+		sections = cls.build_sections(db, ym)
+		written = 0
+		if 'txt' in formats:
+			cls._write_txt(os.path.join(out_dir, f"{ym}.txt"), ym, sections)
+			written += 1
+		if 'csv' in formats:
+			for key, _, header, rows in sections:
+				with open(os.path.join(out_dir, f"{ym}_{key}.csv"), 'w', newline='', encoding='utf-8-sig') as f:
+					w = csv.writer(f)
+					w.writerow(header)
+					w.writerows(rows)
+				written += 1
+		if 'html' in formats:
+			cls._write_html(os.path.join(out_dir, f"{ym}.html"), ym, sections)
+			written += 1
+		return written
+
+	def export(self, ym_from, ym_to, out_dir, formats=FORMATS, workers=None):
+		"""期間の全ての月を並列に書き出す。戻り値: (月数, ファイル数)"""
+		months = self._months(ym_from, ym_to)
+		if not months: return 0, 0
+		os.makedirs(out_dir, exist_ok=True)
+		self.db.conn.commit()  # ワーカーの接続から最新の状態が見えるように
+		workers = workers or min(os.cpu_count() or 1, len(months))
+		if workers <= 1:
+			written = [self.render_month(self.db, ym, out_dir, formats) for ym in months]
+		else:
+			with ProcessPoolExecutor(max_workers=workers, initializer=_statement_worker_init, initargs=(self.db.path,)) as pool:
+				chunk = max(1, len(months) // (workers * 4))
+				written = list(pool.map(_statement_worker, months, [out_dir] * len(months), [formats] * len(months), chunksize=chunk))
+		return len(months), sum(written)
+
+	def show_export_menu(self):
+		print("\n=== 月次明細ファイルの一括出力 ===")
+		now = datetime.datetime.now()
+		ym_from = get_input("開始年月 YYYYMM")
+		ym_to = get_input(f"終了年月 YYYYMM [def:{now.strftime('%Y%m')}]", required=False) or now.strftime('%Y%m')
+		if get_month_range(ym_from)[0] is None or get_month_range(ym_to)[0] is None or ym_from > ym_to:
+			print("日付エラー")
+			return
+		out_dir = get_input("出力フォルダ [def:statements]", required=False) or "statements"
+		fmt_in = get_input("形式 (txt,csv,html をカンマ区切り) [def:すべて]", required=False)
+		formats = tuple(f.strip() for f in fmt_in.split(',') if f.strip() in self.FORMATS) if fmt_in else self.FORMATS
+		started = time.perf_counter()
+		n_months, n_files = self.export(ym_from, ym_to, out_dir, formats)
+		print(f"{n_months}か月分 / {n_files}ファイルを {out_dir} に出力しました ({time.perf_counter() - started:.1f}秒)")
+
+# ==========================================
+# 19. 通貨イベント (ポイント統合・デノミ) の一括適用
+# ==========================================
+class CurrencyEventProcessor:
+	"""
+	通貨マスタの変化を財布・残高・期限付きロットに反映する。
+	- MERGER: 終了した通貨(end_at)の残高を継承先(successor_id)の財布へ移し、元の財布を閉じる。
+	  数量は終了時点のレートで円価値が変わらないように換算する。
+	- DENOMINATION: t_currency_rates の QUANTITY_ADJUST で、直前のレート / 新レート 倍に数量を変える。
+	残高ロットごとに「旧ロットを閉じる決済」と「同じ期限・用途で新ロットを開く決済」を1つの調整取引に
+	executemany でまとめて書き込む。適用済みかどうかは調整明細の品名(イベントキー)で判定するため、
+	同期先やアーカイブを含めて何度実行しても二重には適用されない。
+	"""
+	EVENT_PREFIX = "通貨イベント "
+
+	def __init__(self, db: Database):
+		self.db = db
+
+	def _rate_at(self, currency_id, at, before=False):
+		"""at 時点(before: at より前)の円レート"""
+		self.db.cursor.execute(f"""
+			SELECT rate_to_jpy FROM t_currency_rates
+			WHERE currency_id = ? AND effective_at {'<' if before else '<='} ?
+			ORDER BY effective_at DESC, id DESC LIMIT 1
+		""", (currency_id, at))
+		row = self.db.cursor.fetchone()
+		return row[0] if row else 1.0
+
+	def pending_events(self, now_serial=None):
+		"""未適用のイベントを発生日時順に返す: [{'key', 'kind', 'currency_id', 'target_id', 'at', 'factor', 'label'}]"""
+		now_serial = now_serial if now_serial is not None else datetime_to_serial(datetime.datetime.now())
+		cur = self.db.cursor
+		events = []
+		cur.execute("""
+			SELECT c.id, c.code, c.name, c.end_at, s.id as target_id, s.code as target_code, s.name as target_name
+			FROM m_currencies c JOIN m_currencies s ON c.successor_id = s.id
+			WHERE c.end_at IS NOT NULL AND c.end_at <= ?
+		""", (now_serial,))
+		for r in cur.fetchall():
+			events.append({'key': f"MERGER:{r['code']}->{r['target_code']}@{r['end_at']:g}", 'kind': 'MERGER',
+				'currency_id': r['id'], 'target_id': r['target_id'], 'at': r['end_at'],
+				'factor': None, 'label': f"{r['name']} → {r['target_name']} 統合"})
+		cur.execute("""
+			SELECT r.id, r.currency_id, r.effective_at, c.code, c.name
+			FROM t_currency_rates r JOIN m_currencies c ON r.currency_id = c.id
+			WHERE r.change_type = 'QUANTITY_ADJUST' AND r.effective_at <= ?
+		""", (now_serial,))
+		for r in cur.fetchall():
+			events.append({'key': f"DENOMINATION:{r['code']}@{r['effective_at']:g}#{r['id']}", 'kind': 'DENOMINATION',
+				'currency_id': r['currency_id'], 'target_id': r['currency_id'], 'at': r['effective_at'],
+				'factor': None, 'label': f"{r['name']} デノミ"})
+		for e in events:
+			if e['kind'] == 'MERGER':
+				e['factor'] = self._rate_at(e['currency_id'], e['at']) / self._rate_at(e['target_id'], e['at'])
+			else:
+				e['factor'] = self._rate_at(e['currency_id'], e['at'], before=True) / self._rate_at(e['currency_id'], e['at'])
+
+		if not events: return []
+		src = ArchiveManager(self.db).sources(['t_transaction_details'])
+		marks = ",".join("?" * len(events))
+		cur.execute(f"""
+			SELECT item_name_receipt FROM {src['t_transaction_details']}
+			WHERE food_type = 'ADJUSTMENT' AND item_name_receipt IN ({marks})
+		""", [self.EVENT_PREFIX + e['key'] for e in events])
+		applied = {r[0] for r in cur.fetchall()}
+		return sorted((e for e in events if self.EVENT_PREFIX + e['key'] not in applied), key=lambda e: e['at'])
+
+	def _target_wallet(self, source_wallet, target_currency_id):
+		"""継承先通貨の有効な財布 (無ければ元の財布と同じ種類で作る)"""
+		cur = self.db.cursor
+		cur.execute("SELECT id FROM m_wallets WHERE currency_id = ? AND is_active = 1 ORDER BY id LIMIT 1", (target_currency_id,))
+		row = cur.fetchone()
+		if row: return row['id']
+		cur.execute("SELECT name FROM m_currencies WHERE id = ?", (target_currency_id,))
+		cur.execute("INSERT INTO m_wallets (name, currency_id, wallet_group, is_active) VALUES (?, ?, ?, 1)",
+			(cur.fetchone()['name'], target_currency_id, source_wallet['wallet_group']))
+		return cur.lastrowid
+
+	def apply(self, event):
+		"""1件のイベントを1トランザクションで適用する。戻り値: 換算したロット数"""
+		cur = self.db.cursor
+		at, factor = event['at'], event['factor']
+		cur.execute("""
+			SELECT wb.id as bal_id, wb.wallet_id, wb.current_amount, wb.origin_payment_id,
+				p.expiry_at, p.usage_restriction, w.wallet_group
+			FROM t_wallet_balances wb
+			JOIN m_wallets w ON wb.wallet_id = w.id
+			LEFT JOIN t_payments p ON wb.origin_payment_id = p.id
+			WHERE w.currency_id = ? AND wb.current_amount != 0
+			  AND (p.expiry_at IS NULL OR p.expiry_at >= ?)
+			ORDER BY wb.wallet_id, wb.id
+		""", (event['currency_id'], at))
+		lots = cur.fetchall()
+
+		# 調整取引 (明細の品名がイベントキー)
+		cur.execute("INSERT INTO t_transactions (transaction_name, transaction_at, total_amount_jpy, is_public) VALUES (?, ?, 0, 1)",
+			(event['label'], at))
+		trans_id = cur.lastrowid
+		cur.execute("""
+			INSERT INTO t_transaction_details (transaction_id, item_name_receipt, food_type, unit_price_ex_tax, quantity, tax_rate)
+			VALUES (?, ?, 'ADJUSTMENT', 0, 1, 0)
+		""", (trans_id, self.EVENT_PREFIX + event['key']))
+
+		targets = {}
+		if event['kind'] == 'MERGER':
+			for lot in lots:
+				if lot['wallet_id'] not in targets:
+					targets[lot['wallet_id']] = self._target_wallet(lot, event['target_id'])
+		target_of = lambda wallet_id: targets.get(wallet_id, wallet_id)
+
+		# 1. 旧ロットを閉じる: 残額をゼロにし、期限・用途付き決済の残額も締める
+		source_wallets = sorted({lot['wallet_id'] for lot in lots})
+		cur.executemany("UPDATE t_payments SET remaining_amount = 0 WHERE wallet_id = ? AND remaining_amount != 0 AND (expiry_at IS NULL OR expiry_at >= ?)",
+			[(w, at) for w in source_wallets])
+		cur.executemany("UPDATE t_wallet_balances SET current_amount = 0, updated_at = ? WHERE id = ?", [(at, lot['bal_id']) for lot in lots])
+
+		# 2. 閉じる決済と開く決済を一括挿入 (開く決済のIDは挿入順で対応付ける)
+		new_amounts = [int(round(lot['current_amount'] * factor)) for lot in lots]
+		limited = [lot['expiry_at'] is not None or lot['usage_restriction'] is not None for lot in lots]
+		cur.execute("SELECT COALESCE(MAX(id), 0) FROM t_payments")
+		before_id = cur.fetchone()[0]
+		cur.executemany("INSERT INTO t_payments (transaction_id, wallet_id, amount, remaining_amount, expiry_at, usage_restriction) VALUES (?, ?, ?, 0, ?, ?)",
+			[(trans_id, lot['wallet_id'], -lot['current_amount'], lot['expiry_at'], lot['usage_restriction']) for lot in lots])
+		cur.executemany("INSERT INTO t_payments (transaction_id, wallet_id, amount, remaining_amount, expiry_at, usage_restriction) VALUES (?, ?, ?, ?, ?, ?)",
+			[(trans_id, target_of(lot['wallet_id']), amt, amt if lim else 0, lot['expiry_at'], lot['usage_restriction'])
+				for lot, amt, lim in zip(lots, new_amounts, limited)])
+		cur.execute("SELECT id FROM t_payments WHERE transaction_id = ? AND id > ? ORDER BY id", (trans_id, before_id))
+		open_ids = [r['id'] for r in cur.fetchall()][len(lots):]
+
+		# 3. 新ロットの残高: 同じ属性の残高があれば加算、無ければ作る
+		dest_wallets = sorted({target_of(w) for w in source_wallets})
+		existing = {}
+		if dest_wallets:
+			cur.execute(f"""
+				SELECT wb.id, wb.wallet_id, p.expiry_at, p.usage_restriction, wb.origin_payment_id IS NULL as plain
+				FROM t_wallet_balances wb LEFT JOIN t_payments p ON wb.origin_payment_id = p.id
+				WHERE wb.wallet_id IN ({','.join('?' * len(dest_wallets))})
+			""", dest_wallets)
+			for r in cur.fetchall():
+				key = (r['wallet_id'], None, None) if r['plain'] else (r['wallet_id'], r['expiry_at'], r['usage_restriction'])
+				existing.setdefault(key, r['id'])
+		updates, inserts = {}, {}
+		for lot, amt, lim, pay_id in zip(lots, new_amounts, limited, open_ids):
+			key = (target_of(lot['wallet_id']), lot['expiry_at'], lot['usage_restriction']) if lim else (target_of(lot['wallet_id']), None, None)
+			origin = pay_id if lim else None
+			if key in existing:
+				prev = updates.get(existing[key], (0, None))
+				updates[existing[key]] = (prev[0] + amt, origin or prev[1])
+			else:
+				prev = inserts.get(key, (0, None))
+				inserts[key] = (prev[0] + amt, origin or prev[1])
+		cur.executemany("UPDATE t_wallet_balances SET current_amount = current_amount + ?, origin_payment_id = COALESCE(?, origin_payment_id), updated_at = ? WHERE id = ?",
+			[(amt, origin, at, bal_id) for bal_id, (amt, origin) in updates.items()])
+		cur.executemany("INSERT INTO t_wallet_balances (wallet_id, origin_payment_id, current_amount, updated_at) VALUES (?, ?, ?, ?)",
+			[(key[0], origin, amt, at) for key, (amt, origin) in inserts.items()])
+
+		if event['kind'] == 'MERGER':
+			cur.execute("UPDATE m_wallets SET is_active = 0, closed_at = ? WHERE currency_id = ? AND is_active = 1", (at, event['currency_id']))
+		self.db.conn.commit()
+		return len(lots)
+
+	def apply_pending(self):
+		"""未適用のイベントを順に全て適用する。戻り値: [(イベント, 換算ロット数)]"""
+		return [(e, self.apply(e)) for e in self.pending_events()]
+
+	def show_currency_events(self):
+		print("\n=== 通貨イベント (統合・デノミ) ===")
+		events = self.pending_events()
+		if not events:
+			print("未適用のイベントはありません。")
+			return
+		for e in events:
+			print(f"  {format_serial(e['at'], '%Y/%m/%d')} {e['label']} (数量 x{e['factor']:g})")
+		if (get_input("これらを適用しますか？ (y/n)", required=False) or '').lower() != 'y': return
+		for e, n in self.apply_pending():
+			print(f"  {e['label']}: {n} 件の残高を換算しました")
+
+# ==========================================
+# 20. 価格履歴 (商品 x 店舗 x 月)
+# ==========================================
+class PriceIndex:
+	"""
+	明細の税込単価を (商品, 年月, 店舗) ごとに集計した t_price_stats を保持する。
+	商品は食品マスタに紐付いていれば 'UNIVERSAL:3' のような food_type:food_id、
+	無ければ正規化したレシート品名 'NAME:しょうゆ' をキーにする。
+	グラム単価は内容量(content_amount_per_unit)があればそれで割り、Measured は数量がグラムなので単価そのもの。
+	取引保存時に apply_transaction で差分更新し、rebuild で全件から1パスで作り直す。
+	主キーが (商品, 年月, 店舗) なので、商品ごとの最安店舗・月別推移は主キーの範囲検索で答えられる。
+	"""
+	UNIT_PRICE_SQL = "(MAX(td.unit_price_ex_tax * td.quantity - COALESCE(td.discount_amount, 0), 0) * (1 + td.tax_rate) / td.quantity)"
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.db.conn.create_function('vl_normalize', 1, ReceiptSuggestIndex.normalize, deterministic=True)
+		cur = self.db.cursor
+		cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_price_stats'")
+		if cur.fetchone(): return
+		cur.execute("""
+			CREATE TABLE t_price_stats (
+				item_key TEXT NOT NULL,              -- food_type:food_id / NAME:正規化品名
+				month TEXT NOT NULL,                 -- YYYYMM
+				branch_id INTEGER NOT NULL,          -- 0=店舗なし
+				label TEXT,                          -- 最新のレシート品名
+				purchase_count INTEGER NOT NULL,
+				min_price REAL NOT NULL,             -- 税込単価 (割引後)
+				sum_price REAL NOT NULL,
+				last_price REAL NOT NULL,
+				last_at REAL NOT NULL,
+				gram_count INTEGER NOT NULL,         -- グラム単価が分かる購入数
+				sum_price_per_g REAL,
+				min_price_per_g REAL,
+				PRIMARY KEY (item_key, month, branch_id)
+			) WITHOUT ROWID
+		""")
+		self.rebuild()
+
+	def _select_sql(self, where, src=None):
+		src = src or {'t_transactions': 't_transactions', 't_transaction_details': 't_transaction_details'}
+		return f"""
+			SELECT item_key, month, branch_id,
+				MAX(CASE WHEN rn = 1 THEN label END) as label,
+				COUNT(*) as purchase_count, MIN(price) as min_price, SUM(price) as sum_price,
+				MAX(CASE WHEN rn = 1 THEN price END) as last_price, MAX(at) as last_at,
+				COUNT(price_per_g) as gram_count, SUM(price_per_g) as sum_price_per_g, MIN(price_per_g) as min_price_per_g
+			FROM (
+				SELECT *, ROW_NUMBER() OVER (PARTITION BY item_key, month, branch_id ORDER BY at DESC, id DESC) as rn
+				FROM (
+					SELECT td.id, t.transaction_at as at, td.item_name_receipt as label,
+						CASE WHEN td.food_id IS NOT NULL AND td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED', 'OUT_EAT')
+							THEN td.food_type || ':' || td.food_id
+							ELSE 'NAME:' || vl_normalize(td.item_name_receipt) END as item_key,
+						{serial_month_sql('t.transaction_at')} as month,
+						COALESCE(t.branch_id, 0) as branch_id,
+						{self.UNIT_PRICE_SQL} as price,
+						CASE WHEN td.content_amount_per_unit > 0 THEN {self.UNIT_PRICE_SQL} / td.content_amount_per_unit
+							WHEN td.food_type = 'MEASURED' THEN {self.UNIT_PRICE_SQL} END as price_per_g
+					FROM {src['t_transaction_details']} td
+					JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+					WHERE COALESCE(td.food_type, 'NONE') != 'ADJUSTMENT' AND td.quantity > 0 AND td.unit_price_ex_tax > 0
+					  AND (td.food_id IS NOT NULL OR COALESCE(td.item_name_receipt, '') != '') AND {where}
+				)
+			)
+			GROUP BY item_key, month, branch_id
+		"""
+
+	def rebuild(self):
+		"""全明細(アーカイブ済みの年を含む)から1パスで再集計する"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details'])
+		cur = self.db.cursor
+		cur.execute("DELETE FROM t_price_stats")
+		cur.execute(f"INSERT INTO t_price_stats {self._select_sql('1', src)}")
+		self.db.conn.commit()
+
+	def apply_transaction(self, trans_id):
+		"""1取引分の明細を加算する。コミットは呼び出し側の取引保存と同じトランザクションで行う"""
+		self.apply_transactions([trans_id])
+
+	def apply_transactions(self, trans_ids):
+		"""複数取引分の明細を1文でまとめて加算する (一括登録用)"""
+		self.db.cursor.execute(f"""
+			INSERT INTO t_price_stats
+			SELECT * FROM ({self._select_sql(TRANSACTION_IDS_SQL)}) WHERE true
+			ON CONFLICT (item_key, month, branch_id) DO UPDATE SET
+				label = CASE WHEN excluded.last_at >= last_at THEN excluded.label ELSE label END,
+				last_price = CASE WHEN excluded.last_at >= last_at THEN excluded.last_price ELSE last_price END,
+				last_at = MAX(last_at, excluded.last_at),
+				purchase_count = purchase_count + excluded.purchase_count,
+				min_price = MIN(min_price, excluded.min_price),
+				sum_price = sum_price + excluded.sum_price,
+				gram_count = gram_count + excluded.gram_count,
+				sum_price_per_g = CASE WHEN excluded.sum_price_per_g IS NULL THEN sum_price_per_g ELSE COALESCE(sum_price_per_g, 0) + excluded.sum_price_per_g END,
+				min_price_per_g = COALESCE(MIN(min_price_per_g, excluded.min_price_per_g), min_price_per_g, excluded.min_price_per_g)
+		""", (json.dumps(list(trans_ids)),))
+
+	def item_keys(self, name, food_matches=()):
+		"""品名から候補キーを返す: 食品マスタの一致 + 正規化品名の前方一致"""
+		keys = [f"{m['type']}:{m['id']}" for m in food_matches]
+		norm = ReceiptSuggestIndex.normalize(name)
+		self.db.cursor.execute("""
+			SELECT DISTINCT item_key FROM t_price_stats
+			WHERE item_key >= ? AND item_key < ? LIMIT 20
+		""", (f"NAME:{norm}", f"NAME:{norm}\uffff"))
+		keys += [r['item_key'] for r in self.db.cursor.fetchall()]
+		return list(dict.fromkeys(keys))
+
+	def cheapest(self, item_key, month_from):
+		"""month_from 以降の店舗別価格 (平均単価の安い順)"""
+		self.db.cursor.execute("""
+			SELECT ps.branch_id, b.name as brand, sb.branch_name,
+				SUM(ps.purchase_count) as n, MIN(ps.min_price) as min_price, SUM(ps.sum_price) / SUM(ps.purchase_count) as avg_price,
+				MAX(ps.last_at) as last_at, SUM(ps.sum_price_per_g) / NULLIF(SUM(ps.gram_count), 0) as avg_per_g
+			FROM t_price_stats ps
+			LEFT JOIN m_store_branches sb ON ps.branch_id = sb.id
+			LEFT JOIN m_brands b ON sb.brand_id = b.id
+			WHERE ps.item_key = ? AND ps.month >= ?
+			GROUP BY ps.branch_id
+			ORDER BY COALESCE(avg_per_g, avg_price)
+		""", (item_key, month_from))
+		return self.db.cursor.fetchall()
+
+	def trend(self, item_key, month_from=None, month_to=None):
+		"""月別の価格推移 (全店舗)"""
+		self.db.cursor.execute("""
+			SELECT month, SUM(purchase_count) as n, MIN(min_price) as min_price, SUM(sum_price) / SUM(purchase_count) as avg_price,
+				SUM(sum_price_per_g) / NULLIF(SUM(gram_count), 0) as avg_per_g, MIN(min_price_per_g) as min_per_g
+			FROM t_price_stats
+			WHERE item_key = ? AND month BETWEEN ? AND ?
+			GROUP BY month ORDER BY month
+		""", (item_key, month_from or '000000', month_to or '999999'))
+		return self.db.cursor.fetchall()
+
+	def label(self, item_key):
+		self.db.cursor.execute("SELECT label FROM t_price_stats WHERE item_key = ? ORDER BY last_at DESC LIMIT 1", (item_key,))
+		row = self.db.cursor.fetchone()
+		return row['label'] if row else item_key
+
+	def show_price_report(self, master_mgr):
+		print("\n=== 価格履歴 ===")
+		if (get_input("価格表を全明細から作り直しますか？ (y/N)", required=False) or '').lower() == 'y':
+			self.rebuild()
+		name = get_input("商品名 (Enterで戻る)", required=False)
+		if not name: return
+		keys = self.item_keys(name, master_mgr.find_food_master_fuzzy(name) or [])
+		keys = [k for k in keys if self.trend(k)]
+		if not keys:
+			print("購入履歴がありません。")
+			return
+		for i, k in enumerate(keys):
+			print(f"  {i+1}: {self.label(k)} [{k}]")
+		sel = get_input("選択 [def:1]", required=False, cast_func=int) or 1
+		if not 1 <= sel <= len(keys): return
+		key = keys[sel - 1]
+
+		now = datetime.datetime.now()
+		since = (now - timedelta(days=90)).strftime('%Y%m')
+		fmt_g = lambda v: f"{v:.2f}" if v is not None else "-"
+		fmt_p = lambda v: f"{v:,.0f}" if v >= 10 else f"{v:.2f}"  # グラム単位で買う商品は単価が小さい
+		rep = ReportManager(self.db)
+		print(f"\n--- 店舗別 ({since}以降、安い順) ---")
+		rep._print_header([("店舗", 28, 'left'), ("回数", 4, 'right'), ("最安", 8, 'right'), ("平均", 8, 'right'), ("円/g", 6, 'right'), ("最終購入", 10, 'left')])
+		for r in self.cheapest(key, since):
+			store = f"{r['brand'] or ''} {r['branch_name'] or ''}".strip() or "店舗なし"
+			rep._print_row([(store, 28, 'left'), (f"{r['n']}", 4, 'right'), (fmt_p(r['min_price']), 8, 'right'),
+				(fmt_p(r['avg_price']), 8, 'right'), (fmt_g(r['avg_per_g']), 6, 'right'), (format_serial(r['last_at'], '%Y/%m/%d'), 10, 'left')])
+
+		print("\n--- 月別推移 ---")
+		rep._print_header([("年月", 8, 'left'), ("回数", 4, 'right'), ("最安", 8, 'right'), ("平均", 8, 'right'), ("円/g", 6, 'right')])
+		for r in self.trend(key):
+			rep._print_row([(f"{r['month'][:4]}/{r['month'][4:]}", 8, 'left'), (f"{r['n']}", 4, 'right'), (fmt_p(r['min_price']), 8, 'right'),
+				(fmt_p(r['avg_price']), 8, 'right'), (fmt_g(r['avg_per_g']), 6, 'right')])
+
+# ==========================================
+# 21. カテゴリ別の月予算
+# ==========================================
+class BudgetTracker:
+	"""
+	(カテゴリ, food_type) ごとの月予算 m_budgets と、その月の使用額カウンタ t_budget_spent。
+	カウンタは取引保存と同じトランザクションで apply_transaction により加算するので、
+	明細入力中の「今月の残り予算」は主キー1行の読み出しで求められる。
+	ADJUSTMENT(残高調整)は支出ではないため対象外。カテゴリなし(食品など)は category_id = 0。
+	"""
+	WARN_RATIO = 0.8  # 予算の8割を超えたら警告
+
+	def __init__(self, db: Database):
+		self.db = db
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_budgets (
+				category_id INTEGER NOT NULL,        -- 0=カテゴリなし
+				food_type TEXT NOT NULL,
+				amount_jpy INTEGER NOT NULL,         -- 毎月の予算 (税込)
+				PRIMARY KEY (category_id, food_type)
+			) WITHOUT ROWID
+		""")
+		cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_budget_spent'")
+		if cur.fetchone(): return
+		cur.execute("""
+			CREATE TABLE t_budget_spent (
+				month TEXT NOT NULL,                 -- YYYYMM
+				category_id INTEGER NOT NULL,
+				food_type TEXT NOT NULL,
+				amount_jpy INTEGER NOT NULL DEFAULT 0,
+				PRIMARY KEY (month, category_id, food_type)
+			) WITHOUT ROWID
+		""")
+		self.rebuild()
+
+	def _select_sql(self, where, src=None):
+		src = src or {'t_transactions': 't_transactions', 't_transaction_details': 't_transaction_details'}
+		return f"""
+			SELECT {serial_month_sql('t.transaction_at')} as month, COALESCE(td.category_id, 0) as category_id,
+				COALESCE(td.food_type, 'NONE') as food_type, SUM({LINE_GROSS_SQL}) as amount_jpy
+			FROM {src['t_transaction_details']} td
+			JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+			WHERE COALESCE(td.food_type, 'NONE') != 'ADJUSTMENT' AND {where}
+			GROUP BY 1, 2, 3
+		"""
+
+	def rebuild(self):
+		"""全明細(アーカイブ済みの年を含む)から1パスで再集計する"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details'])
+		cur = self.db.cursor
+		cur.execute("DELETE FROM t_budget_spent")
+		cur.execute(f"INSERT INTO t_budget_spent {self._select_sql('1', src)}")
+		self.db.conn.commit()
+
+	def apply_transaction(self, trans_id, sign=1):
+		"""1取引分の明細を加算(sign=1)または減算(sign=-1)する。コミットは呼び出し側で行う"""
+		self.apply_transactions([trans_id], sign)
+
+	def apply_transactions(self, trans_ids, sign=1):
+		"""複数取引分の明細を1文でまとめて加算・減算する (一括登録用)"""
+		self.db.cursor.execute(f"""
+			INSERT INTO t_budget_spent (month, category_id, food_type, amount_jpy)
+			SELECT month, category_id, food_type, ? * amount_jpy FROM ({self._select_sql(TRANSACTION_IDS_SQL)}) WHERE true
+			ON CONFLICT (month, category_id, food_type) DO UPDATE SET amount_jpy = amount_jpy + excluded.amount_jpy
+		""", (sign, json.dumps(list(trans_ids))))
+
+	def status(self, month, category_id, food_type):
+		"""(予算, 使用額) を返す。予算が無ければ None"""
+		self.db.cursor.execute("""
+			SELECT b.amount_jpy as budget, COALESCE(s.amount_jpy, 0) as spent
+			FROM m_budgets b
+			LEFT JOIN t_budget_spent s ON s.month = ? AND s.category_id = b.category_id AND s.food_type = b.food_type
+			WHERE b.category_id = ? AND b.food_type = ?
+		""", (month, category_id or 0, food_type or 'NONE'))
+		row = self.db.cursor.fetchone()
+		return (row['budget'], row['spent']) if row else None
+
+	def show_line_status(self, month, category_id, food_type, pending):
+		"""明細1行の入力後に今月の残り予算を表示する (pending: この取引で入力済みの額)"""
+		st = self.status(month, category_id, food_type)
+		if st is None: return
+		budget, spent = st
+		used = spent + pending
+		rest = budget - used
+		label = f"{self.label(category_id, food_type)} の今月の残り予算: {rest:,}円 / {budget:,}円"
+		if rest < 0: print(f"  [予算超過] {label} ({-rest:,}円超過)")
+		elif used >= budget * self.WARN_RATIO: print(f"  [予算注意] {label}")
+		else: print(f"  {label}")
+
+	def label(self, category_id, food_type):
+		if category_id:
+			self.db.cursor.execute("SELECT name FROM m_categories WHERE id = ?", (category_id,))
+			row = self.db.cursor.fetchone()
+			return row['name'] if row else f"カテゴリ{category_id}"
+		return FOOD_TYPE_LABELS.get(food_type or 'NONE', food_type)
+
+	def month_report(self, month):
+		self.db.cursor.execute("""
+			SELECT b.category_id, b.food_type, b.amount_jpy as budget, COALESCE(s.amount_jpy, 0) as spent
+			FROM m_budgets b
+			LEFT JOIN t_budget_spent s ON s.month = ? AND s.category_id = b.category_id AND s.food_type = b.food_type
+			ORDER BY b.category_id, b.food_type
+		""", (month,))
+		return self.db.cursor.fetchall()
+
+	def show_budget_menu(self):
+		print("\n=== 予算 ===")
+		print(" 1. 今月の予算状況")
+		print(" 2. 予算の設定")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		cur = self.db.cursor
+		if sel == '2':
+			cur.execute("SELECT id, name FROM m_categories WHERE type = 'EXPENSE' ORDER BY id")
+			for c in cur.fetchall():
+				print(f"  {c['id']}: {c['name']}")
+			for k, ft in (('u', 'UNIVERSAL'), ('m', 'MEASURED'), ('p', 'PROCESSED'), ('o', 'OUT_EAT'), ('x', 'NONE')):
+				print(f"  {k}: {FOOD_TYPE_LABELS[ft]}")
+			key = (get_input("対象 (カテゴリID / u,m,p,o,x)") or '').lower()
+			ft_map = {'u': 'UNIVERSAL', 'm': 'MEASURED', 'p': 'PROCESSED', 'o': 'OUT_EAT', 'x': 'NONE'}
+			if key in ft_map: category_id, food_type = 0, ft_map[key]
+			elif key.isdigit(): category_id, food_type = int(key), 'NONE'
+			else: return
+			amount = get_input("毎月の予算(円, 0で削除)", cast_func=int)
+			if amount > 0:
+				cur.execute("INSERT OR REPLACE INTO m_budgets (category_id, food_type, amount_jpy) VALUES (?, ?, ?)", (category_id, food_type, amount))
+			else:
+				cur.execute("DELETE FROM m_budgets WHERE category_id = ? AND food_type = ?", (category_id, food_type))
+			self.db.conn.commit()
+			print("保存しました")
+			return
+		if sel != '1': return
+
+		month = get_input(f"年月 YYYYMM [def:{datetime.datetime.now().strftime('%Y%m')}]", required=False) or datetime.datetime.now().strftime('%Y%m')
+		rows = self.month_report(month)
+		if not rows:
+			print("予算が設定されていません。")
+			return
+		rep = ReportManager(self.db)
+		rep._print_header([("対象", 20, 'left'), ("予算", 10, 'right'), ("使用", 10, 'right'), ("残り", 10, 'right'), ("使用率", 22, 'left')])
+		for r in rows:
+			ratio = r['spent'] / r['budget'] if r['budget'] else 0
+			bar = "#" * min(int(ratio * 10), 10) + "." * max(10 - int(ratio * 10), 0)
+			rep._print_row([(self.label(r['category_id'], r['food_type']), 20, 'left'), (f"{r['budget']:,}", 10, 'right'),
+				(f"{r['spent']:,}", 10, 'right'), (f"{r['budget'] - r['spent']:,}", 10, 'right'),
+				(f"{bar} {ratio * 100:.0f}%{' 超過' if ratio > 1 else ''}", 22, 'left')])
+
+# ==========================================
+# 22. 未リンク明細の一括リンク
+# ==========================================
+_linker_candidates = None  # ワーカープロセスごとの食品マスタ名 [(正規化名, food_type, id, 表示名)]
+
+def _linker_worker_init(candidates):
+	global _linker_candidates
+	_linker_candidates = candidates
+
+def _linker_worker(queries):
+	return [BatchLinker.best_matches(name, allowed, _linker_candidates) for name, allowed in queries]
+
+class BatchLinker:
+	"""
+	food_id / category_id の無い明細を、品名ごとにまとめて食品マスタ・カテゴリへリンクする。
+	1. 学習: リンク済み明細の「正規化品名 -> (food_type, food_id, category_id)」の出現比率
+	2. 類似: 正規化品名と食品マスタ名の類似度 (difflib)。品名の種類が多い時はプロセス並列で計算する
+	確信度の高いものは executemany で一括適用し、残りは t_link_queue に入れて1品名ずつ確認する。
+	"""
+	AUTO_LEARNED = 0.9     # 同じ品名の過去のリンクがこの比率以上で一致していれば自動適用
+	AUTO_SIMILAR = 0.9     # 類似度がこれ以上で、
+	AUTO_MARGIN = 0.1      # 2位との差がこれ以上なら自動適用
+	CUTOFF = 0.4
+	PARALLEL_MIN = 200     # これ以上の品名数でプロセス並列にする
+
+	LINKED_SQL = f"""((td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED', 'OUT_EAT') AND td.food_id IS NOT NULL)
+		OR (COALESCE(td.food_type, 'NONE') = 'NONE' AND td.category_id IS NOT NULL))"""
+	UNLINKED_SQL = f"""((td.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED', 'OUT_EAT') AND td.food_id IS NULL)
+		OR (COALESCE(td.food_type, 'NONE') = 'NONE' AND td.category_id IS NULL))
+		AND COALESCE(td.item_name_receipt, '') != ''"""
+
+	def __init__(self, db: Database, master_mgr: MasterManager):
+		self.db = db
+		self.master_mgr = master_mgr
+		self.db.conn.create_function('vl_normalize', 1, ReceiptSuggestIndex.normalize, deterministic=True)
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_link_queue (
+				detail_id INTEGER PRIMARY KEY,
+				name_key TEXT NOT NULL,              -- 正規化品名
+				item_name TEXT,
+				line_food_type TEXT NOT NULL,        -- 明細側の food_type
+				food_type TEXT,                      -- 提案 (無ければ NULL)
+				food_id INTEGER,
+				category_id INTEGER,
+				score REAL,
+				source TEXT                          -- LEARNED / SIMILAR
+			)
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_link_queue_name ON t_link_queue(name_key, line_food_type)")
+		self.db.conn.commit()
+
+	@staticmethod
+	def best_matches(name, allowed, candidates, cutoff=CUTOFF):
+		"""類似度上位2件 [(類似度, food_type, id, 表示名)] (difflib.get_close_matches と同じ段階的な絞り込み)"""
+		sm = difflib.SequenceMatcher()
+		sm.set_seq2(name)
+		top = []
+		for cand, f_type, f_id, label in candidates:
+			if f_type not in allowed: continue
+			floor = top[-1][0] if len(top) == 2 else cutoff
+			sm.set_seq1(cand)
+			if sm.real_quick_ratio() >= floor and sm.quick_ratio() >= floor:
+				r = sm.ratio()
+				if r >= floor:
+					top = sorted(top + [(r, f_type, f_id, label)], key=lambda x: -x[0])[:2]
+		return top
+
+	def _learned(self):
+		"""{(正規化品名, food_type or None): [(件数, food_type, food_id, category_id)]}"""
+		self.db.cursor.execute(f"""
+			SELECT vl_normalize(td.item_name_receipt) as name_key, COALESCE(td.food_type, 'NONE') as food_type,
+				td.food_id, td.category_id, COUNT(*) as n
+			FROM t_transaction_details td
+			WHERE {self.LINKED_SQL} AND COALESCE(td.item_name_receipt, '') != ''
+			GROUP BY 1, 2, 3, 4
+		""")
+		learned = {}
+		for r in self.db.cursor.fetchall():
+			learned.setdefault(r['name_key'], []).append((r['n'], r['food_type'], r['food_id'], r['category_id']))
+		return learned
+
+	def score(self, workers=None):
+		"""
+		未リンク明細を品名ごとに採点する。
+		戻り値: (自動適用 [(food_type, food_id, category_id, detail_id)], 確認待ち [キュー行])
+		"""
+		cur = self.db.cursor
+		cur.execute(f"""
+			SELECT td.id, td.item_name_receipt, vl_normalize(td.item_name_receipt) as name_key, COALESCE(td.food_type, 'NONE') as food_type
+			FROM t_transaction_details td WHERE {self.UNLINKED_SQL}
+		""")
+		groups = {}
+		for r in cur.fetchall():
+			groups.setdefault((r['name_key'], r['food_type']), []).append((r['id'], r['item_name_receipt']))
+		if not groups: return [], []
+
+		learned = self._learned()
+		store = self.master_mgr.store
+		store.refresh()
+		candidates = []
+		for f_type in FoodMasterStore.TYPES:
+			ids, names = store.names(f_type)
+			candidates += [(ReceiptSuggestIndex.normalize(n), f_type, i, n) for i, n in zip(ids, names)]
+
+		# 学習で決まらない品名だけ類似度を計算する
+		decided, queries = {}, []
+		for key in groups:
+			name_key, line_type = key
+			options = [o for o in learned.get(name_key, []) if line_type == 'NONE' or o[1] == line_type]
+			if options:
+				total = sum(o[0] for o in options)
+				best = max(options)
+				decided[key] = (best[0] / total, 'LEARNED', best[1], best[2], best[3])
+				if best[0] / total >= self.AUTO_LEARNED: continue
+			allowed = ('PROCESSED',) if line_type == 'OUT_EAT' else ((line_type,) if line_type != 'NONE' else FoodMasterStore.TYPES)
+			queries.append((key, allowed))
+
+		workers = workers or min(os.cpu_count() or 1, 8)
+		q_args = [(k[0], allowed) for k, allowed in queries]
+		if workers > 1 and len(queries) >= self.PARALLEL_MIN:
+			chunk = max(1, len(q_args) // (workers * 4))
+			batches = [q_args[i:i + chunk] for i in range(0, len(q_args), chunk)]
+			with ProcessPoolExecutor(max_workers=workers, initializer=_linker_worker_init, initargs=(candidates,)) as pool:
+				results = [m for part in pool.map(_linker_worker, batches) for m in part]
+		else:
+			results = [self.best_matches(name, allowed, candidates) for name, allowed in q_args]
+
+		for (key, _), top in zip(queries, results):
+			if not top: continue
+			r, f_type, f_id, _label = top[0]
+			margin = r - (top[1][0] if len(top) > 1 else 0.0)
+			# 2位との差が小さい時は確信度を下げる
+			conf = r if margin >= self.AUTO_MARGIN else r * (1 - self.AUTO_MARGIN)
+			link_type = 'OUT_EAT' if key[1] == 'OUT_EAT' else f_type
+			if key not in decided or conf > decided[key][0]:
+				decided[key] = (conf, 'SIMILAR', link_type, f_id, None)
+
+		auto, queue = [], []
+		for key, lines in groups.items():
+			conf, source, f_type, f_id, cat_id = decided.get(key, (None, None, None, None, None))
+			threshold = self.AUTO_LEARNED if source == 'LEARNED' else self.AUTO_SIMILAR
+			if conf is not None and conf >= threshold:
+				auto += [(f_type, f_id, cat_id, detail_id) for detail_id, _ in lines]
+			else:
+				queue += [(detail_id, key[0], item_name, key[1], f_type, f_id, cat_id, conf, source) for detail_id, item_name in lines]
+		return auto, queue
+
+	def _apply(self, links):
+		"""[(food_type, food_id, category_id, detail_id)] を一括で書き込む"""
+		cur = self.db.cursor
+		cur.executemany("UPDATE t_transaction_details SET food_type = ?, food_id = ?, category_id = ? WHERE id = ?", links)
+		cur.executemany("DELETE FROM t_link_queue WHERE detail_id = ?", [(l[3],) for l in links])
+
+	def _refresh_derived(self):
+		"""food_type / カテゴリで集計している派生テーブルを作り直す"""
+		SpendingCube(self.db).rebuild()
+		PriceIndex(self.db).rebuild()
+		BudgetTracker(self.db).rebuild()
+		if np is not None: ConsumptionForecast(self.db, self.master_mgr.store).refresh(full=True)
+
+	def run(self, workers=None):
+		"""採点して自動適用し、残りを確認待ちキューに入れる。戻り値: (自動適用件数, 確認待ち件数)"""
+		auto, queue = self.score(workers)
+		cur = self.db.cursor
+		with IntegrityChecker(self.db).deferred():
+			cur.execute("DELETE FROM t_link_queue")
+			cur.executemany("""
+				INSERT INTO t_link_queue (detail_id, name_key, item_name, line_food_type, food_type, food_id, category_id, score, source)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""", queue)
+			self._apply(auto)
+			self.db.conn.commit()
+		if auto: self._refresh_derived()
+		return len(auto), len(queue)
+
+	def _suggestion_label(self, r):
+		if r['food_id'] is not None:
+			rec = self.master_mgr.store.get('PROCESSED' if r['food_type'] == 'OUT_EAT' else r['food_type'], r['food_id'])
+			return f"{rec.name if rec else r['food_id']} [{r['food_type']}]"
+		if r['category_id'] is not None:
+			return BudgetTracker(self.db).label(r['category_id'], 'NONE')
+		return None
+
+	def review(self):
+		"""確認待ちを品名ごとに1件ずつ確認する"""
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT name_key, line_food_type, MIN(item_name) as item_name, COUNT(*) as n,
+				food_type, food_id, category_id, MAX(score) as score, source
+			FROM t_link_queue GROUP BY name_key, line_food_type ORDER BY n DESC
+		""")
+		groups = cur.fetchall()
+		applied = 0
+		for g in groups:
+			print(f"\n「{g['item_name']}」 ({g['n']}行, {FOOD_TYPE_LABELS.get(g['line_food_type'], g['line_food_type'])})")
+			sugg = self._suggestion_label(g)
+			if sugg: print(f"  提案: {sugg} (確信度 {g['score']:.2f}, {'過去のリンク' if g['source'] == 'LEARNED' else '名前の類似'})")
+			sel = (get_input("Enter:提案を適用 / f:食品を検索 / c:カテゴリ / s:スキップ / q:終了", required=False) or '').lower()
+			if sel == 'q': break
+			if sel == 's' or (not sel and not sugg): continue
+			if not sel:
+				link = (g['food_type'] or 'NONE', g['food_id'], g['category_id'])
+			elif sel == 'f':
+				allowed = None if g['line_food_type'] in ('NONE', 'OUT_EAT') else g['line_food_type']
+				cands = self.master_mgr.find_food_master_fuzzy(get_input("検索する食品名") or "")
+				cands = [c for c in cands if allowed is None or c['type'] == allowed]
+				if g['line_food_type'] == 'OUT_EAT': cands = [c for c in cands if c['type'] == 'PROCESSED']
+				if not cands:
+					print("見つかりません。")
+					continue
+				for i, c in enumerate(cands):
+					print(f"  {i+1}: {c['name']} [{c['type']}]")
+				no = get_input("選択", cast_func=int)
+				if not 1 <= no <= len(cands): continue
+				c = cands[no - 1]
+				link = ('OUT_EAT' if g['line_food_type'] == 'OUT_EAT' else c['type'], c['id'], None)
+			elif sel == 'c':
+				if g['line_food_type'] != 'NONE':
+					print("食品の明細にはカテゴリを付けられません。")
+					continue
+				cur.execute("SELECT id, name FROM m_categories ORDER BY id")
+				for c in cur.fetchall():
+					print(f"  {c['id']}: {c['name']}")
+				link = ('NONE', None, get_input("カテゴリID", cast_func=int))
+			else:
+				continue
+			cur.execute("SELECT detail_id FROM t_link_queue WHERE name_key = ? AND line_food_type = ?", (g['name_key'], g['line_food_type']))
+			ids = [r['detail_id'] for r in cur.fetchall()]
+			self._apply([link + (i,) for i in ids])
+			self.db.conn.commit()
+			applied += len(ids)
+		if applied: self._refresh_derived()
+		return applied
+
+	def show_linker_menu(self):
+		print("\n=== 未リンク明細の一括リンク ===")
+		print(" 1. 採点して自動リンク (確信度の低いものは確認待ちへ)")
+		print(" 2. 確認待ちを確認")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel == '1':
+			started = time.perf_counter()
+			n_auto, n_queue = self.run()
+			print(f"自動リンク: {n_auto}行 / 確認待ち: {n_queue}行 ({time.perf_counter() - started:.1f}秒)")
+		elif sel == '2':
+			print(f"{self.review()}行をリンクしました")
+
+# ==========================================
+# 23. 整合性チェック
+# ==========================================
+class IntegrityChecker:
+	"""
+	スキーマの外部キーでは表せない規則 (food_id の参照先が food_type で変わる等) を、
+	規則ごとに1本の反結合クエリでデータベース全体に対して検査する。
+	- 差分モード: 規則ごとに前回検査した最大IDを覚えておき、それより新しい行と、
+	  前回以降に更新された行 (t_integrity_touched にトリガーで常に記録) だけを見る。
+	  参照先テーブル (deps, REFERENCES) の行が前回から変わっていれば、その規則だけ全件を見直す。
+	- 行トリガーモード: 同じ条件を BEFORE トリガーにして1行ずつ拒否する (既定は無効)。
+	  一括登録は deferred() の間トリガーを外し、終わったら差分モードでまとめて検査する。
+	アーカイブ済みの行は対象外 (アーカイブは取引単位で移すため、main 内で規則が閉じている)。
+	"""
+	FOOD_TABLES = {'UNIVERSAL': 'm_foods_universal', 'MEASURED': 'm_foods_measured', 'PROCESSED': 'm_foods_processed', 'OUT_EAT': 'm_foods_processed'}
+	STOCK_DESTINATIONS = ('FRIDGE', 'FREEZER', 'PANTRY')
+
+	# (規則名, 説明, 対象テーブル, 違反条件 ({a} は対象行), 参照先テーブル, トリガーを張る操作)
+	RULES = [
+		('detail_food_ref', "food_id の参照先の食品マスタが無い", 't_transaction_details',
+			"{a}.food_id IS NOT NULL AND (" + " OR ".join(
+				f"({{a}}.food_type = '{t}' AND NOT EXISTS (SELECT 1 FROM {m} m WHERE m.id = {{a}}.food_id))"
+				for t, m in FOOD_TABLES.items()) + ")",
+			('m_foods_universal', 'm_foods_measured', 'm_foods_processed'), 'INSERT OR UPDATE OF food_type, food_id'),
+		('detail_food_type', "食品以外の明細に food_id がある", 't_transaction_details',
+			"{a}.food_id IS NOT NULL AND COALESCE({a}.food_type, 'NONE') NOT IN ('UNIVERSAL', 'MEASURED', 'PROCESSED', 'OUT_EAT')",
+			(), 'INSERT OR UPDATE OF food_type, food_id'),
+		('detail_category_type', "category_id があるのに food_type が NONE でない", 't_transaction_details',
+			"{a}.category_id IS NOT NULL AND COALESCE({a}.food_type, 'NONE') != 'NONE'",
+			(), 'INSERT OR UPDATE OF food_type, category_id'),
+		('inventory_destination', "冷蔵・冷凍・常温保存の食品以外の在庫", 't_inventory',
+			f"""NOT EXISTS (SELECT 1 FROM t_transaction_details d WHERE d.id = {{a}}.detail_id
+				AND d.destination IN ({', '.join(f"'{x}'" for x in STOCK_DESTINATIONS)})
+				AND d.food_type IN ('UNIVERSAL', 'MEASURED', 'PROCESSED'))""",
+			(), 'INSERT OR UPDATE OF detail_id'),
+		('inventory_quantity', "在庫の残量が0未満か購入数量を超えている", 't_inventory',
+			"""{a}.current_quantity < -1e-9
+				OR {a}.current_quantity > (SELECT d.quantity FROM t_transaction_details d WHERE d.id = {a}.detail_id) + 1e-9""",
+			(), 'INSERT OR UPDATE OF current_quantity, detail_id'),
+		('meal_inventory_detail', "消費明細の detail_id が在庫ロットの由来明細と違う", 't_meal_details',
+			"NOT EXISTS (SELECT 1 FROM t_inventory inv WHERE inv.id = {a}.inventory_id AND inv.detail_id = {a}.detail_id)",
+			(), 'INSERT OR UPDATE OF inventory_id, detail_id'),
+	]
+	# 違反条件の中で参照している別テーブル (そのテーブルの行が更新されたら規則を全件で見直す)
+	REFERENCES = {
+		'inventory_destination': ('t_transaction_details',),
+		'inventory_quantity': ('t_transaction_details',),
+		'meal_inventory_detail': ('t_inventory',),
+	}
+
+	def __init__(self, db: Database):
+		self.db = db
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_integrity_state (
+				rule TEXT PRIMARY KEY,
+				watermark INTEGER NOT NULL,          -- 検査済みの最大ID
+				violations INTEGER NOT NULL,
+				checked_at REAL
+			)
+		""")
+		# 前回の検査以降に更新・削除された行 (差分検査で見直す)
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_integrity_touched (
+				table_name TEXT NOT NULL,
+				row_id INTEGER NOT NULL,
+				PRIMARY KEY (table_name, row_id)
+			) WITHOUT ROWID
+		""")
+		tables = sorted({rule[2] for rule in self.RULES} | {t for refs in self.REFERENCES.values() for t in refs})
+		for table in tables:
+			for op, ref in (('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+				cur.execute(f"""
+					CREATE TRIGGER IF NOT EXISTS trg_touch_{table}_{op.lower()} AFTER {op} ON {table}
+					BEGIN
+						INSERT OR IGNORE INTO t_integrity_touched (table_name, row_id) VALUES ('{table}', {ref}.id);
+					END
+				""")
+		self.db.conn.commit()
+
+	def check(self, incremental=False):
+		"""
+		全規則を検査する。戻り値: {規則名: 違反行IDのリスト} (違反の無い規則は含まない)
+		外部キー (PRAGMA foreign_key_check) は全件検査の時だけ見る。
+		"""
+		cur = self.db.cursor
+		now = datetime_to_serial(datetime.datetime.now())
+		cur.execute("SELECT rule, watermark FROM t_integrity_state")
+		marks = {r['rule']: r['watermark'] for r in cur.fetchall()}
+		cur.execute("SELECT DISTINCT table_name FROM t_integrity_touched")
+		touched = {r[0] for r in cur.fetchall()}
+		found = {}
+		for rule, _desc, table, cond, deps, _ops in self.RULES:
+			cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+			top = cur.fetchone()[0]
+			since = 0
+			if incremental and (not deps or self.db.derived_is_fresh(f"integrity:{rule}", deps)) and not touched & set(self.REFERENCES.get(rule, ())):
+				since = marks.get(rule, 0)
+			cur.execute(f"""
+				SELECT x.id FROM {table} x
+				WHERE (x.id > ? AND x.id <= ? OR x.id IN (SELECT row_id FROM t_integrity_touched WHERE table_name = ?))
+				  AND ({cond.format(a='x')})
+				ORDER BY x.id
+			""", (since, top, table))
+			ids = [r[0] for r in cur.fetchall()]
+			if ids: found[rule] = ids
+			# 差分検査では過去の違反件数を引き継ぐ
+			cur.execute("""
+				INSERT INTO t_integrity_state (rule, watermark, violations, checked_at) VALUES (?, ?, ?, ?)
+				ON CONFLICT(rule) DO UPDATE SET watermark = excluded.watermark, checked_at = excluded.checked_at,
+					violations = CASE WHEN ? THEN violations + excluded.violations ELSE excluded.violations END
+			""", (rule, top, len(ids), now, since > 0))
+			if deps: self.db.mark_derived(f"integrity:{rule}", deps)
+		cur.execute("DELETE FROM t_integrity_touched")
+		if not incremental:
+			cur.execute("PRAGMA foreign_key_check")
+			fk = [f"{r[0]}#{r[1]}->{r[2]}" for r in cur.fetchall()]
+			if fk: found['foreign_key'] = fk
+		self.db.conn.commit()
+		return found
+
+	# --- 行トリガーモード ---
+	def _trigger_names(self):
+		return [f"trg_chk_{rule}_{i}" for rule, *_ in self.RULES for i in (0, 1)]
+
+	def triggers_enabled(self):
+		self.db.cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_chk_%'")
+		return self.db.cursor.fetchone()[0] > 0
+
+	def enable_triggers(self):
+		cur = self.db.cursor
+		for rule, desc, table, cond, _deps, ops in self.RULES:
+			# "INSERT OR UPDATE OF ..." は INSERT と UPDATE OF の2本に分ける
+			for i, op in enumerate(ops.split(' OR ')):
+				cur.execute(f"""
+					CREATE TRIGGER IF NOT EXISTS trg_chk_{rule}_{i}
+					BEFORE {op} ON {table}
+					WHEN {cond.format(a='NEW')}
+					BEGIN
+						SELECT RAISE(ABORT, '整合性違反 ({rule}): {desc}');
+					END
+				""")
+		self.db.conn.commit()
+
+	def disable_triggers(self):
+		for name in self._trigger_names():
+			self.db.cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+		self.db.conn.commit()
+
+	@contextlib.contextmanager
+	def deferred(self):
+		"""
+		一括登録用。処理全体を1つのトランザクションにし、例外が出たら全て取り消す (途中までの行を残さない)。
+		行トリガーが有効なら処理の間だけ外し、終わったら差分検査して違反を表示する。
+		"""
+		tracking = self.triggers_enabled()
+		if tracking:
+			self.disable_triggers()
+		else:
+			self.db.conn.commit()  # 取り消しの範囲をこの処理だけにする
+		try:
+			yield
+		except BaseException:
+			# 途中まで書いた内容を確定させないよう、トリガーを戻す(コミットする)前に取り消す
+			self.db.conn.rollback()
+			if tracking: self.enable_triggers()
+			raise
+		self.db.conn.commit()
+		if not tracking: return
+		self.enable_triggers()
+		found = self.check(incremental=True)
+		if found: self.print_violations(found)
+
+	def print_violations(self, found):
+		descs = {rule: desc for rule, desc, *_ in self.RULES}
+		descs['foreign_key'] = "外部キーの参照先が無い (テーブル#行ID->参照先)"
+		print("\n[整合性違反]")
+		for rule, ids in found.items():
+			shown = ", ".join(str(i) for i in ids[:10]) + (" ..." if len(ids) > 10 else "")
+			print(f"  {descs[rule]}: {len(ids)}件 ({shown})")
+
+	def show_integrity_menu(self):
+		print("\n=== 整合性チェック ===")
+		print(" 1. 全件検査")
+		print(" 2. 差分検査 (前回以降に追加・更新された行)")
+		print(f" 3. 行トリガーによる即時チェック: {'有効' if self.triggers_enabled() else '無効'} (切り替え)")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		if sel in ('1', '2'):
+			started = time.perf_counter()
+			found = self.check(incremental=(sel == '2'))
+			elapsed = time.perf_counter() - started
+			if found: self.print_violations(found)
+			else: print("違反はありません。")
+			print(f"({elapsed:.2f}秒)")
+		elif sel == '3':
+			if self.triggers_enabled():
+				self.disable_triggers()
+				print("行トリガーを無効にしました。")
+			else:
+				found = self.check()
+				if found:
+					self.print_violations(found)
+					print("既存の違反を直してから有効にしてください。")
+					return
+				self.enable_triggers()
+				print("行トリガーを有効にしました。")
+
+# ==========================================
+# 24. 分析用カラムナ出力 (Parquet / Arrow)
+# ==========================================
+class _RowDigest:
+	"""行の内容から順序に依存しない月別ダイジェストを作る集約関数 (vl_digest)"""
+	MASK = (1 << 64) - 1
+
+	def __init__(self):
+		self.total = 0
+		self.count = 0
+
+	def step(self, *values):
+		h = hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).digest()
+		self.total = (self.total + int.from_bytes(h, 'big')) & self.MASK
+		self.count += 1
+
+	def finalize(self):
+		return f"{self.count}:{self.total:016x}"
+
+class ColumnarExporter:
+	"""
+	非正規化したファクト表を年月ごとのパーティションに分けて Parquet / Arrow(IPC) で出力する。
+	  {出力先}/{ファクト名}/month=YYYYMM/part.parquet (または part.arrow)
+	- consumption: 消費1件ごと (在庫消費 + 即食・外食) の原価と栄養素
+	- spending: 明細1行ごとの税込金額とブランド・店舗・カテゴリ
+	- payments: 決済1件ごとの金額と、取引時点のレートでの円換算額
+	月ごとの行内容のダイジェスト(vl_digest)を _manifest.json に記録し、変化した月だけ書き直す。
+	元テーブルのバージョンが前回と同じならダイジェストの計算も省く。
+	取引・明細・決済・食事の変更はトリガーで t_export_months に年月ごとの通番として記録し、
+	前回の出力以降に変わった月だけダイジェストを計算する (マスタが変わった時は全ての月)。
+	同じ明細を消費した食事は先入先出の原価が連動するので、その全ての月を変更扱いにする。
+	Arrow(IPC) は無圧縮で書くので、読む側はメモリマップしてそのまま使える。
+	"""
+	FORMATS = ('parquet', 'arrow')
+	MANIFEST = '_manifest.json'
+	SOURCE_TABLES = ['t_transactions', 't_transaction_details', 't_meal_logs', 't_meal_details', 't_payments',
+		'm_foods_universal', 'm_foods_measured', 'm_foods_processed', 'm_categories', 'm_store_branches', 'm_brands',
+		'm_wallets', 'm_currencies', 't_currency_rates']
+
+	# ファクトの元になる台帳テーブル (これ以外の SOURCE_TABLES の変更は全ての月に影響する)
+	FACT_TABLES = ['t_transactions', 't_transaction_details', 't_payments', 't_meal_logs', 't_meal_details']
+
+	def __init__(self, db: Database):
+		self.db = db
+		self.db.conn.create_aggregate('vl_digest', -1, _RowDigest)
+		self._ensure_tracking()
+
+	@staticmethod
+	def _touched_months_sql(table, ref):
+		"""テーブルの1行 (ref = NEW / OLD) の変更で内容が変わる年月を返す SELECT 文"""
+		month = lambda col: f"{serial_month_sql(col)} AS month"
+		shared_meals = f"""
+			SELECT {month('ml.eaten_at')} FROM t_meal_details md JOIN t_meal_logs ml ON ml.id = md.meal_id
+			WHERE md.detail_id"""
+		return {
+			't_transactions': f"SELECT {month(f'{ref}.transaction_at')}",
+			't_transaction_details': f"""
+				SELECT {month('t.transaction_at')} FROM t_transactions t WHERE t.id = {ref}.transaction_id
+				UNION {shared_meals} = {ref}.id""",
+			't_payments': f"SELECT {month('t.transaction_at')} FROM t_transactions t WHERE t.id = {ref}.transaction_id",
+			't_meal_logs': f"""
+				SELECT {month(f'{ref}.eaten_at')}
+				UNION {shared_meals} IN (SELECT detail_id FROM t_meal_details WHERE meal_id = {ref}.id)""",
+			't_meal_details': f"""
+				SELECT {month('ml.eaten_at')} FROM t_meal_logs ml WHERE ml.id = {ref}.meal_id
+				UNION {shared_meals} = {ref}.detail_id""",
+		}[table]
+
+	def _ensure_tracking(self):
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS t_export_months (
+				month TEXT PRIMARY KEY,              -- YYYYMM
+				seq INTEGER NOT NULL                 -- 最後に変更された時の通番 (マニフェストの month_seq と比べる)
+			) WITHOUT ROWID
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_export_months_seq ON t_export_months(seq)")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_meal_details_detail ON t_meal_details(detail_id)")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_meal_details_meal ON t_meal_details(meal_id)")
+		for table in self.FACT_TABLES:
+			for op in ('INSERT', 'UPDATE', 'DELETE'):
+				refs = {'INSERT': ['NEW'], 'UPDATE': ['OLD', 'NEW'], 'DELETE': ['OLD']}[op]
+				months = " UNION ".join(self._touched_months_sql(table, ref) for ref in refs)
+				cur.execute(f"""
+					CREATE TRIGGER IF NOT EXISTS trg_export_{table}_{op.lower()} AFTER {op} ON {table}
+					BEGIN
+						INSERT INTO t_export_months (month, seq)
+						SELECT month, (SELECT COALESCE(MAX(seq), 0) + 1 FROM t_export_months)
+						FROM ({months}) WHERE month IS NOT NULL
+						ON CONFLICT(month) DO UPDATE SET seq = excluded.seq;
+					END
+				""")
+		self.db.conn.commit()
+
+	def _facts(self):
+		"""{ファクト名: ([(列名, 型)], 月の列 month を含む SELECT 文)}"""
+		src = ArchiveManager(self.db).sources(['t_transactions', 't_transaction_details', 't_payments'])
+		food_joins = """
+			LEFT JOIN m_foods_measured fm ON c.food_id = fm.id AND c.food_type = 'MEASURED'
+			LEFT JOIN m_foods_universal fu ON c.food_id = fu.id AND c.food_type = 'UNIVERSAL'
+			LEFT JOIN m_foods_processed fp ON c.food_id = fp.id AND c.food_type IN ('PROCESSED', 'OUT_EAT')
+		"""
+		nutrients = ", ".join(f"c.amount * {nutrient_per_qty_sql(f, 'c.food_type')} as {f}" for f in NUTRIENT_FIELDS)
+		return {
+			'consumption': (
+				[('source', 'string'), ('source_id', 'int64'), ('consumed_at', 'float64'), ('detail_id', 'int64'),
+				 ('food_type', 'string'), ('food_id', 'int64'), ('food_name', 'string'), ('consume_type', 'string'),
+				 ('amount', 'float64'), ('cost_jpy', 'float64')] + [(f, 'float64') for f in NUTRIENT_FIELDS],
+				f"""
+				SELECT c.month, c.source, c.source_id, c.consumed_at, c.detail_id, c.food_type, c.food_id, c.food_name,
+					c.consume_type, c.amount, c.cost_jpy, {nutrients}
+				FROM t_consumption_costs c
+				{food_joins}
+				"""),
+			'spending': (
+				[('detail_id', 'int64'), ('transaction_id', 'int64'), ('transaction_at', 'float64'), ('transaction_name', 'string'),
+				 ('brand', 'string'), ('branch', 'string'), ('category', 'string'), ('food_type', 'string'), ('food_id', 'int64'),
+				 ('item_name', 'string'), ('quantity', 'float64'), ('unit_price_ex_tax', 'float64'), ('discount', 'float64'),
+				 ('tax_rate', 'float64'), ('gross_jpy', 'int64'), ('destination', 'string'), ('is_public', 'int64')],
+				f"""
+				SELECT {serial_month_sql('t.transaction_at')} as month, td.id, t.id, t.transaction_at, t.transaction_name,
+					b.name, sb.branch_name, cat.name, td.food_type, td.food_id, td.item_name_receipt,
+					td.quantity, td.unit_price_ex_tax, COALESCE(td.discount_amount, 0), td.tax_rate,
+					{LINE_GROSS_SQL}, td.destination, t.is_public
+				FROM {src['t_transaction_details']} td
+				JOIN {src['t_transactions']} t ON td.transaction_id = t.id
+				LEFT JOIN m_store_branches sb ON t.branch_id = sb.id
+				LEFT JOIN m_brands b ON sb.brand_id = b.id
+				LEFT JOIN m_categories cat ON td.category_id = cat.id
+				"""),
+			'payments': (
+				[('payment_id', 'int64'), ('transaction_id', 'int64'), ('transaction_at', 'float64'), ('wallet_id', 'int64'),
+				 ('wallet', 'string'), ('currency', 'string'), ('amount', 'int64'), ('rate_to_jpy', 'float64'),
+				 ('amount_jpy', 'float64'), ('expiry_at', 'float64'), ('usage_restriction', 'string')],
+				f"""
+				SELECT month, id, transaction_id, transaction_at, wallet_id, wallet, currency, amount, rate, amount * rate,
+					expiry_at, usage_restriction
+				FROM (
+					SELECT {serial_month_sql('t.transaction_at')} as month, p.id, p.transaction_id, t.transaction_at,
+						p.wallet_id, w.name as wallet, c.code as currency, p.amount, p.expiry_at, p.usage_restriction,
+						COALESCE((SELECT r.rate_to_jpy FROM t_currency_rates r
+							WHERE r.currency_id = w.currency_id AND r.effective_at <= t.transaction_at
+							ORDER BY r.effective_at DESC, r.id DESC LIMIT 1), 1.0) as rate
+					FROM {src['t_payments']} p
+					JOIN {src['t_transactions']} t ON p.transaction_id = t.id
+					LEFT JOIN m_wallets w ON p.wallet_id = w.id
+					LEFT JOIN m_currencies c ON w.currency_id = c.id
+				)
+				"""),
+		}
+
+	def _load_manifest(self, out_dir):
+		path = os.path.join(out_dir, self.MANIFEST)
+		if not os.path.exists(path): return {}
+		with open(path, encoding='utf-8') as f:
+			return json.load(f)
+
+	def _write_partition(self, path, columns, rows, fmt):
+		"""1か月分の行を列ごとの配列にして書き出す (一時ファイルに書いてから置き換える)"""
+		types = {'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string()}
+		schema = pa.schema([(name, types[t]) for name, t in columns])
+		arrays = [pa.array([r[i] for r in rows], type=schema.field(i).type) for i in range(len(columns))]
+		table = pa.Table.from_arrays(arrays, schema=schema)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = path + '.tmp'
+		if fmt == 'parquet': pq.write_table(table, tmp)
+		else: pa_feather.write_feather(table, tmp, compression='uncompressed')
+		os.replace(tmp, path)
+
+	@staticmethod
+	def _remove_partitions(out_dir, fact, months, fmt):
+		for m in months:
+			path = os.path.join(out_dir, fact, f"month={m}", f"part.{fmt}")
+			if os.path.exists(path): os.remove(path)
+			if os.path.isdir(os.path.dirname(path)) and not os.listdir(os.path.dirname(path)):
+				os.rmdir(os.path.dirname(path))
+
+	def export(self, out_dir, fmt='parquet', full=False):
+		"""
+		変化した月のパーティションだけを書き直す。
+		戻り値: {ファクト名: (書き直した月数, 削除した月数, 変化なしの月数)}
+		"""
+		ConsumptionCostEngine(self.db).refresh()
+		versions = list(self.db.table_version(*self.SOURCE_TABLES))
+		manifest = self._load_manifest(out_dir)
+		if manifest and manifest.get('format') != fmt:
+			# 前の形式のファイルは残さない
+			for fact, months in manifest.get('facts', {}).items():
+				self._remove_partitions(out_dir, fact, months, manifest.get('format'))
+			manifest = {}
+		if full: manifest = {}
+		if manifest.get('versions') == versions: return {}
+
+		cur = self.db.cursor
+		cur.execute("SELECT COALESCE(MAX(seq), 0) FROM t_export_months")
+		month_seq = cur.fetchone()[0]
+		# 前回からマスタが変わっていなければ、変更のあった月だけダイジェストを計算する
+		masters = [i for i, t in enumerate(self.SOURCE_TABLES) if t not in self.FACT_TABLES]
+		touched = None
+		if 'month_seq' in manifest and all(manifest['versions'][i] == versions[i] for i in masters):
+			cur.execute("SELECT month FROM t_export_months WHERE seq > ?", (manifest['month_seq'],))
+			touched = [r[0] for r in cur.fetchall()]
+
+		digests_all, result = {}, {}
+		for fact, (columns, sql) in self._facts().items():
+			names = ", ".join(name for name, _ in columns)
+			fact_cte = f"WITH fact(month, {names}) AS ({sql})"
+			old = manifest.get('facts', {}).get(fact, {})
+			if touched is None:
+				cur.execute(f"{fact_cte} SELECT month, vl_digest({names}) FROM fact GROUP BY month")
+				digests = {r[0]: r[1] for r in cur.fetchall()}
+				removed = [m for m in old if m not in digests]
+			else:
+				cur.execute(f"{fact_cte} SELECT month, vl_digest({names}) FROM fact WHERE month IN (SELECT value FROM json_each(?)) GROUP BY month",
+					(json.dumps(touched),))
+				fresh = {r[0]: r[1] for r in cur.fetchall()}
+				removed = [m for m in touched if m in old and m not in fresh]
+				digests = {m: d for m, d in old.items() if m not in removed}
+				digests.update(fresh)
+			changed = sorted(m for m, d in digests.items() if old.get(m) != d)
+			part = lambda m: os.path.join(out_dir, fact, f"month={m}", f"part.{fmt}")
+			if changed:
+				marks = ",".join("?" * len(changed))
+				cur.execute(f"{fact_cte} SELECT * FROM fact WHERE month IN ({marks}) ORDER BY month, {columns[0][0]}", changed)
+				rows_by_month = {}
+				for r in cur:
+					rows_by_month.setdefault(r[0], []).append(tuple(r)[1:])
+				for m in changed:
+					self._write_partition(part(m), columns, rows_by_month[m], fmt)
+			self._remove_partitions(out_dir, fact, removed, fmt)
+			digests_all[fact] = digests
+			result[fact] = (len(changed), len(removed), len(digests) - len(changed))
+
+		os.makedirs(out_dir, exist_ok=True)
+		with open(os.path.join(out_dir, self.MANIFEST) + '.tmp', 'w', encoding='utf-8') as f:
+			json.dump({'format': fmt, 'versions': versions, 'month_seq': month_seq, 'facts': digests_all}, f, ensure_ascii=False, indent=1)
+		os.replace(os.path.join(out_dir, self.MANIFEST) + '.tmp', os.path.join(out_dir, self.MANIFEST))
+		return result
+
+	def show_export_menu(self):
+		print("\n=== 分析用カラムナ出力 (Parquet / Arrow) ===")
+		if not require_pyarrow("カラムナ出力"): return
+		out_dir = get_input("出力フォルダ [def:analytics]", required=False) or "analytics"
+		fmt = (get_input("形式 parquet / arrow [def:parquet]", required=False) or 'parquet').lower()
+		if fmt not in self.FORMATS:
+			print("形式エラー")
+			return
+		full = (get_input("全パーティションを書き直しますか？ (y/N)", required=False) or '').lower() == 'y'
+		started = time.perf_counter()
+		result = self.export(out_dir, fmt, full)
+		if not result:
+			print("前回の出力から変更はありません。")
+			return
+		for fact, (written, removed, same) in result.items():
+			print(f"  {fact}: 書き直し {written}か月 / 削除 {removed}か月 / 変化なし {same}か月")
+		print(f"{out_dir} に出力しました ({time.perf_counter() - started:.1f}秒)")
+
+# ==========================================
+# 25. 決済ロットの整理 (期限切れ失効・残高行の畳み込み)
+# ==========================================
+class LotCompactor:
+	"""
+	期限・用途付きのお金(ロット)を整理して、handle_payment / update_balance_snapshot が見る行を小さく保つ。
+	1. 同じ財布・同じ属性の残高行が複数あれば1行にまとめる
+	2. 期限切れで残高の残るロットを失効させる (期限日付けの調整取引に、残高を打ち消す決済を記録)
+	3. 残高行の起源(origin_payment_id)以外の期限・用途付き決済は remaining_amount を0にして閉じ、
+	   起源の決済の remaining_amount は残高行の現在額に合わせる
+	4. 0円になった期限・用途付きの残高行を削除する (履歴は t_payments に残る)
+	残っているロットは (wallet_id, remaining_amount) の索引で0以外の範囲だけを読めばよくなる。
+	"""
+	WRITE_OFF_PREFIX = "期限切れ失効 "
+	LIMITED_SQL = "(expiry_at IS NOT NULL OR usage_restriction IS NOT NULL)"
+
+	def __init__(self, db: Database):
+		self.db = db
+		cur = self.db.cursor
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_wallet_remaining ON t_payments(wallet_id, remaining_amount)")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_balances_wallet ON t_wallet_balances(wallet_id)")
+		self.db.conn.commit()
+
+	def _merge_duplicates(self):
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT wb.id, wb.wallet_id, wb.current_amount, wb.origin_payment_id, p.expiry_at, p.usage_restriction
+			FROM t_wallet_balances wb LEFT JOIN t_payments p ON wb.origin_payment_id = p.id
+			ORDER BY wb.id
+		""")
+		groups = {}
+		for r in cur.fetchall():
+			key = (r['wallet_id'], None, None) if r['origin_payment_id'] is None else (r['wallet_id'], r['expiry_at'], r['usage_restriction'])
+			groups.setdefault(key, []).append(r)
+		keep, drop = [], []
+		for rows in groups.values():
+			if len(rows) < 2: continue
+			origins = [r['origin_payment_id'] for r in rows if r['origin_payment_id'] is not None]
+			keep.append((sum(r['current_amount'] for r in rows), max(origins) if origins else None, rows[0]['id']))
+			drop += [(r['id'],) for r in rows[1:]]
+		cur.executemany("UPDATE t_wallet_balances SET current_amount = ?, origin_payment_id = ? WHERE id = ?", keep)
+		cur.executemany("DELETE FROM t_wallet_balances WHERE id = ?", drop)
+		return len(drop)
+
+	def _expire(self, now_serial):
+		"""期限切れロットを失効させる。戻り値: {財布ID: 失効額}"""
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT wb.id as bal_id, wb.wallet_id, wb.current_amount, p.expiry_at, p.usage_restriction
+			FROM t_wallet_balances wb JOIN t_payments p ON wb.origin_payment_id = p.id
+			WHERE p.expiry_at < ? AND wb.current_amount != 0
+			ORDER BY p.expiry_at, wb.id
+		""", (now_serial,))
+		lots = cur.fetchall()
+		by_expiry = {}
+		for lot in lots:
+			by_expiry.setdefault(lot['expiry_at'], []).append(lot)
+
+		write_offs, lapsed = [], {}
+		for expiry, group in by_expiry.items():
+			label = self.WRITE_OFF_PREFIX + format_serial(expiry, '%Y/%m/%d')
+			cur.execute("INSERT INTO t_transactions (transaction_name, transaction_at, total_amount_jpy, is_public) VALUES (?, ?, 0, 1)",
+				(label, expiry))
+			trans_id = cur.lastrowid
+			cur.execute("""
+				INSERT INTO t_transaction_details (transaction_id, item_name_receipt, food_type, unit_price_ex_tax, quantity, tax_rate)
+				VALUES (?, ?, 'ADJUSTMENT', 0, 1, 0)
+			""", (trans_id, label))
+			for lot in group:
+				write_offs.append((trans_id, lot['wallet_id'], -lot['current_amount'], lot['expiry_at'], lot['usage_restriction']))
+				lapsed[lot['wallet_id']] = lapsed.get(lot['wallet_id'], 0) + lot['current_amount']
+		cur.executemany("INSERT INTO t_payments (transaction_id, wallet_id, amount, remaining_amount, expiry_at, usage_restriction) VALUES (?, ?, ?, 0, ?, ?)",
+			write_offs)
+		cur.executemany("UPDATE t_wallet_balances SET current_amount = 0, updated_at = ? WHERE id = ?", [(now_serial, lot['bal_id']) for lot in lots])
+		return lapsed
+
+	def _close_lots(self):
+		"""戻り値: (閉じた決済数, 残額を合わせた起源決済数)"""
+		cur = self.db.cursor
+		cur.execute(f"""
+			UPDATE t_payments SET remaining_amount = 0
+			WHERE remaining_amount != 0 AND {self.LIMITED_SQL}
+			  AND id NOT IN (SELECT origin_payment_id FROM t_wallet_balances WHERE origin_payment_id IS NOT NULL AND current_amount != 0)
+		""")
+		closed = cur.rowcount
+		cur.execute("""
+			UPDATE t_payments SET remaining_amount = wb.current_amount
+			FROM t_wallet_balances wb
+			WHERE wb.origin_payment_id = t_payments.id AND wb.current_amount != 0 AND t_payments.remaining_amount != wb.current_amount
+		""")
+		return closed, cur.rowcount
+
+	def compact(self, now_serial=None, dry_run=False):
+		"""
+		1〜4を1トランザクションで行う。dry_run なら件数だけ数えてロールバックする。
+		戻り値: {'merged', 'lapsed'({財布ID: 失効額}), 'closed', 'reconciled', 'folded', 'live'}
+		"""
+		now_serial = now_serial if now_serial is not None else datetime_to_serial(datetime.datetime.now())
+		cur = self.db.cursor
+		self.db.conn.commit()
+		stats = {'merged': self._merge_duplicates(), 'lapsed': self._expire(now_serial)}
+		stats['closed'], stats['reconciled'] = self._close_lots()
+		cur.execute("DELETE FROM t_wallet_balances WHERE current_amount = 0 AND origin_payment_id IS NOT NULL")
+		stats['folded'] = cur.rowcount
+		cur.execute(f"SELECT COUNT(*) FROM t_payments WHERE remaining_amount != 0 AND {self.LIMITED_SQL}")
+		stats['live'] = cur.fetchone()[0]
+		if dry_run: self.db.conn.rollback()
+		else: self.db.conn.commit()
+		return stats
+
+	def _print_stats(self, stats):
+		wallets = {w['id']: w for w in MasterManager(self.db).get_wallets_with_currency()}
+		print(f"  重複した残高行の統合: {stats['merged']}件")
+		for wallet_id, amount in stats['lapsed'].items():
+			w = wallets.get(wallet_id)
+			print(f"  失効: {w['name'] if w else wallet_id} {amount:,}{w['display_unit'] if w else ''}")
+		print(f"  閉じるロット: {stats['closed']}件 / 残額を合わせるロット: {stats['reconciled']}件")
+		print(f"  削除する0円の残高行: {stats['folded']}件")
+		print(f"  整理後に残るロット: {stats['live']}件")
+
+	def show_compaction_menu(self):
+		print("\n=== 決済ロットの整理 ===")
+		stats = self.compact(dry_run=True)
+		self._print_stats(stats)
+		if not (stats['merged'] or stats['lapsed'] or stats['closed'] or stats['reconciled'] or stats['folded']):
+			print("整理するものはありません。")
+			return
+		if (get_input("実行しますか？ (y/n)", required=False) or '').lower() != 'y': return
+		self.compact()
+		print("整理しました。")
+
+# ==========================================
+# 26. 定期取引 (テンプレートと一括登録)
+# ==========================================
+class RecurringScheduler:
+	"""
+	給与・お小遣い・サブスク・定期券など毎月決まった取引をテンプレート(明細 + 決済 + 周期)として持ち、
+	期日を過ぎた回をまとめて取引として登録する。
+	前回から何か月空いていても、全ての回を1トランザクションで executemany により挿入し、
+	残高スナップショットは財布ごとに1回だけ更新する。
+	テンプレートは既存の取引からコピーして作る。決済は期限・用途の無いお金のみ (限定お金の相殺は対話入力で行う)。
+	"""
+	SCHEDULES = {'MONTHLY': '毎月', 'WEEKLY': '毎週', 'YEARLY': '毎年'}
+	STOCK_DESTINATIONS = ('FRIDGE', 'FREEZER', 'PANTRY')
+
+	def __init__(self, db: Database, trans_mgr: TransactionManager):
+		self.db = db
+		self.trans_mgr = trans_mgr
+		cur = self.db.cursor
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_recurring (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				name TEXT NOT NULL,
+				branch_id INTEGER,
+				is_public INTEGER DEFAULT 1,
+				schedule TEXT NOT NULL CHECK(schedule IN ('MONTHLY', 'WEEKLY', 'YEARLY')),
+				anchor_at REAL NOT NULL,             -- 初回の日時 (月末日などの基準日)
+				end_at REAL,                         -- 終了日時 (NULL=無期限)
+				next_at REAL NOT NULL,               -- 次に登録する回の日時
+				count INTEGER NOT NULL DEFAULT 0,    -- 登録済みの回数
+				is_active INTEGER DEFAULT 1
+			)
+		""")
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_recurring_details (
+				recurring_id INTEGER NOT NULL,
+				item_name_receipt TEXT,
+				food_type TEXT DEFAULT 'NONE',
+				food_id INTEGER,
+				category_id INTEGER,
+				unit_price_ex_tax REAL,
+				quantity REAL NOT NULL,
+				content_amount_per_unit REAL,
+				tax_rate REAL NOT NULL,
+				discount_amount REAL DEFAULT 0,
+				destination TEXT,
+				FOREIGN KEY (recurring_id) REFERENCES m_recurring(id)
+			)
+		""")
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS m_recurring_payments (
+				recurring_id INTEGER NOT NULL,
+				wallet_id INTEGER,
+				amount INTEGER NOT NULL,             -- 財布の増減 (支出は負)
+				FOREIGN KEY (recurring_id) REFERENCES m_recurring(id)
+			)
+		""")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_recurring_details ON m_recurring_details(recurring_id)")
+		cur.execute("CREATE INDEX IF NOT EXISTS idx_recurring_payments ON m_recurring_payments(recurring_id)")
+		self.db.conn.commit()
+
+	@staticmethod
+	def occurrence(schedule, anchor_at, n):
+		"""基準日から n 回目 (0始まり) の日時。月末の基準日は短い月では月末日に丸める"""
+		if schedule == 'WEEKLY': return anchor_at + 7 * n
+		base = serial_to_datetime(anchor_at)
+		months = n if schedule == 'MONTHLY' else 12 * n
+		y, m = divmod(base.month - 1 + months, 12)
+		y, m = base.year + y, m + 1
+		day = min(base.day, calendar.monthrange(y, m)[1])
+		return datetime_to_serial(base.replace(year=y, month=m, day=day))
+
+	def save_from_transaction(self, trans_id, name, schedule, anchor_at, end_at=None):
+		"""既存の取引の明細・決済をコピーしてテンプレートを作る。戻り値: テンプレートID"""
+		cur = self.db.cursor
+		cur.execute("SELECT branch_id, is_public FROM t_transactions WHERE id = ?", (trans_id,))
+		t = cur.fetchone()
+		cur.execute("""
+			INSERT INTO m_recurring (name, branch_id, is_public, schedule, anchor_at, end_at, next_at)
+			VALUES (?, ?, ?, ?, ?, ?, ?)
+		""", (name, t['branch_id'], t['is_public'], schedule, anchor_at, end_at, anchor_at))
+		rec_id = cur.lastrowid
+		cur.execute("""
+			INSERT INTO m_recurring_details (recurring_id, item_name_receipt, food_type, food_id, category_id, unit_price_ex_tax,
+				quantity, content_amount_per_unit, tax_rate, discount_amount, destination)
+			SELECT ?, item_name_receipt, food_type, food_id, category_id, unit_price_ex_tax,
+				quantity, content_amount_per_unit, tax_rate, COALESCE(discount_amount, 0), destination
+			FROM t_transaction_details WHERE transaction_id = ? ORDER BY id
+		""", (rec_id, trans_id))
+		cur.execute("""
+			INSERT INTO m_recurring_payments (recurring_id, wallet_id, amount)
+			SELECT ?, wallet_id, amount FROM t_payments
+			WHERE transaction_id = ? AND expiry_at IS NULL AND usage_restriction IS NULL ORDER BY id
+		""", (rec_id, trans_id))
+		self.db.conn.commit()
+		return rec_id
+
+	def due(self, now_serial):
+		"""期日を過ぎた回: [(テンプレート行, [(回数, 日時)])]"""
+		cur = self.db.cursor
+		cur.execute("SELECT * FROM m_recurring WHERE is_active = 1 AND next_at <= ? ORDER BY id", (now_serial,))
+		result = []
+		for r in cur.fetchall():
+			runs, n = [], r['count']
+			at = r['next_at']
+			while at <= now_serial and (r['end_at'] is None or at <= r['end_at']):
+				runs.append((n, at))
+				n += 1
+				at = self.occurrence(r['schedule'], r['anchor_at'], n)
+			if runs: result.append((r, runs))
+		return result
+
+	def materialize(self, now_serial=None):
+		"""
+		期日を過ぎた全ての回を1トランザクションで登録する。
+		戻り値: 作成した取引IDのリスト
+		"""
+		now_serial = now_serial if now_serial is not None else datetime_to_serial(datetime.datetime.now())
+		due = self.due(now_serial)
+		if not due: return []
+		cur = self.db.cursor
+		ids = [r['id'] for r, _ in due]
+		marks = ",".join("?" * len(ids))
+		cur.execute(f"SELECT * FROM m_recurring_details WHERE recurring_id IN ({marks}) ORDER BY rowid", ids)
+		details = {}
+		for d in cur.fetchall():
+			details.setdefault(d['recurring_id'], []).append(d)
+		cur.execute(f"SELECT * FROM m_recurring_payments WHERE recurring_id IN ({marks}) ORDER BY rowid", ids)
+		payments = {}
+		for p in cur.fetchall():
+			payments.setdefault(p['recurring_id'], []).append(p)
+
+		with IntegrityChecker(self.db).deferred():
+			trans_ids, detail_rows, payment_rows, stock, per_wallet, advance = [], [], [], [], {}, []
+			for r, runs in due:
+				lines = details.get(r['id'], [])
+				total = sum(int(max(d['unit_price_ex_tax'] * d['quantity'] - d['discount_amount'], 0) * (1 + d['tax_rate'])) for d in lines)
+				for n, at in runs:
+					cur.execute("INSERT INTO t_transactions (transaction_name, branch_id, transaction_at, total_amount_jpy, is_public) VALUES (?, ?, ?, ?, ?)",
+						(r['name'], r['branch_id'], at, total, r['is_public']))
+					tid = cur.lastrowid
+					trans_ids.append(tid)
+					for d in lines:
+						detail_rows.append((tid, d['item_name_receipt'], d['food_type'], d['food_id'], d['category_id'], d['unit_price_ex_tax'],
+							d['quantity'], d['content_amount_per_unit'], d['tax_rate'], d['discount_amount'], d['destination']))
+						if d['destination'] in self.STOCK_DESTINATIONS: stock.append((len(detail_rows) - 1, d['quantity'], at))
+					for p in payments.get(r['id'], []):
+						payment_rows.append((tid, p['wallet_id'], p['amount']))
+						if p['wallet_id'] is not None:
+							per_wallet[p['wallet_id']] = per_wallet.get(p['wallet_id'], 0) + p['amount']
+				last_n = runs[-1][0] + 1
+				advance.append((self.occurrence(r['schedule'], r['anchor_at'], last_n), last_n, r['id']))
+
+			cur.execute("SELECT COALESCE(MAX(id), 0) FROM t_transaction_details")
+			before_id = cur.fetchone()[0]
+			cur.executemany("""
+				INSERT INTO t_transaction_details (transaction_id, item_name_receipt, food_type, food_id, category_id, unit_price_ex_tax,
+					quantity, content_amount_per_unit, tax_rate, discount_amount, destination)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""", detail_rows)
+			# 在庫になる明細: 新しい明細IDは挿入順に振られるので、挿入後に読み出して対応付ける
+			if stock:
+				cur.execute("SELECT id FROM t_transaction_details WHERE id > ? ORDER BY id", (before_id,))
+				new_ids = [r[0] for r in cur.fetchall()]
+				cur.executemany("INSERT INTO t_inventory (detail_id, current_quantity, updated_at) VALUES (?, ?, ?)",
+					[(new_ids[k], qty, at) for k, qty, at in stock])
+			cur.executemany("INSERT INTO t_payments (transaction_id, wallet_id, amount, remaining_amount) VALUES (?, ?, ?, 0)", payment_rows)
+			for wallet_id, delta in per_wallet.items():
+				self.trans_mgr.update_balance_snapshot(wallet_id, delta, None, None, None)
+			cur.executemany("UPDATE m_recurring SET next_at = ?, count = ? WHERE id = ?", advance)
+
+			self.trans_mgr.cube.apply_transactions(trans_ids)
+			self.trans_mgr.prices.apply_transactions(trans_ids)
+			self.trans_mgr.budget.apply_transactions(trans_ids)
+			self.trans_mgr.suggest.add_transactions(trans_ids)
+			self.db.conn.commit()
+		return trans_ids
+
+	def show_due(self, due):
+		"""期日の来た回の一覧を表示する"""
+		rep = ReportManager(self.db)
+		rep._print_header([("ID", 4, 'right'), ("名前", 24, 'left'), ("回数", 4, 'right'), ("最初", 10, 'left'), ("最後", 10, 'left')])
+		for r, runs in due:
+			rep._print_row([(str(r['id']), 4, 'right'), (r['name'], 24, 'left'), (str(len(runs)), 4, 'right'),
+				(format_serial(runs[0][1], '%Y/%m/%d'), 10, 'left'), (format_serial(runs[-1][1], '%Y/%m/%d'), 10, 'left')])
+
+	def list_templates(self):
+		cur = self.db.cursor
+		cur.execute("""
+			SELECT r.*, COALESCE((SELECT SUM(amount) FROM m_recurring_payments p WHERE p.recurring_id = r.id), 0) as amount
+			FROM m_recurring r ORDER BY r.is_active DESC, r.next_at
+		""")
+		rows = cur.fetchall()
+		if not rows:
+			print("定期取引はありません。")
+			return rows
+		rep = ReportManager(self.db)
+		rep._print_header([("ID", 4, 'right'), ("名前", 24, 'left'), ("周期", 4, 'left'), ("次回", 10, 'left'), ("終了", 10, 'left'),
+			("財布増減", 10, 'right'), ("回数", 4, 'right'), ("状態", 4, 'left')])
+		for r in rows:
+			rep._print_row([(str(r['id']), 4, 'right'), (r['name'], 24, 'left'), (self.SCHEDULES[r['schedule']], 4, 'left'),
+				(format_serial(r['next_at'], '%Y/%m/%d'), 10, 'left'), (format_serial(r['end_at'], '%Y/%m/%d') if r['end_at'] else '-', 10, 'left'),
+				(f"{r['amount']:,}", 10, 'right'), (str(r['count']), 4, 'right'), ("有効" if r['is_active'] else "停止", 4, 'left')])
+		return rows
+
+	def show_recurring_menu(self):
+		print("\n=== 定期取引 ===")
+		self.list_templates()
+		print(" 1. 既存の取引から定期取引を作る")
+		print(" 2. 定期取引を停止する")
+		print(" 3. 期日の来た回を今すぐ登録する")
+		sel = get_input("選択 (Enterで戻る)", required=False)
+		cur = self.db.cursor
+		if sel == '1':
+			trans_id = get_input("コピー元の取引ID", cast_func=int)
+			cur.execute("SELECT transaction_name, transaction_at FROM t_transactions WHERE id = ?", (trans_id,))
+			t = cur.fetchone()
+			if not t:
+				print("取引が見つかりません。")
+				return
+			name = get_input(f"名前 [def:{t['transaction_name'] or ''}]", required=False) or t['transaction_name'] or f"定期取引{trans_id}"
+			sch_in = get_input("周期 1:毎月 2:毎週 3:毎年 [def:1]", required=False) or '1'
+			schedule = {'1': 'MONTHLY', '2': 'WEEKLY', '3': 'YEARLY'}.get(sch_in, 'MONTHLY')
+			# 既定の初回はコピー元の次の回 (時刻もコピー元に合わせる)
+			anchor_at = self.occurrence(schedule, t['transaction_at'], 1)
+			start_in = get_input(f"初回 YYYYMMDD [def:{format_serial(anchor_at, '%Y%m%d')}]", required=False)
+			if start_in:
+				start = parse_date_input(start_in)
+				if start is None:
+					print("日付エラー")
+					return
+				anchor_at = int(start) + (t['transaction_at'] % 1)
+			end_in = get_input("終了 YYYYMMDD (任意)", required=False)
+			end_at = parse_date_input(end_in) + 0.99999 if end_in else None
+			rec_id = self.save_from_transaction(trans_id, name, schedule, anchor_at, end_at)
+			print(f"定期取引 {rec_id} を登録しました。")
+		elif sel == '2':
+			rec_id = get_input("停止するID", cast_func=int)
+			cur.execute("UPDATE m_recurring SET is_active = 0 WHERE id = ?", (rec_id,))
+			self.db.conn.commit()
+		elif sel == '3':
+			started = time.perf_counter()
+			trans_ids = self.materialize()
+			print(f"{len(trans_ids)}件の取引を登録しました ({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+# ==========================================
+# 27. Main Loop
+# ==========================================
+class LifeManagerApp:
+	def __init__(self):
+		self.db = Database()
+		self.master = MasterManager(self.db)
+		self.reporter = ReportManager(self.db)
+		self.trans = TransactionManager(self.db, self.master)
+		self.similarity = FoodSimilarityIndex(self.db, self.master.store)
+		self.planner = MealPlanner(self.db)
+		self.search = ReceiptSearch(self.db)
+		self.sync = LedgerSync(self.db)
+		self.archive = ArchiveManager(self.db)
+		self.dashboard = Dashboard(self.db)
+		self.costs = ConsumptionCostEngine(self.db)
+		self.recipes = RecipeManager(self.db, self.master)
+		self.forecast = ConsumptionForecast(self.db, self.master.store)
+		self.reconciler = StatementReconciler(self.db, self.trans)
+		self.statements = MonthlyStatementExporter(self.db)
+		self.currency_events = CurrencyEventProcessor(self.db)
+		self.linker = BatchLinker(self.db, self.master)
+		self.integrity = IntegrityChecker(self.db)
+		self.columnar = ColumnarExporter(self.db)
+		self.lots = LotCompactor(self.db)
+		self.recurring = RecurringScheduler(self.db, self.trans)
+
+	def run(self):
+		# 前回の起動以降に期日の来た定期取引を確認してからまとめて登録
+		now_serial = datetime_to_serial(datetime.datetime.now())
+		due = self.recurring.due(now_serial)
+		if due:
+			print("\n期日の来た定期取引があります。")
+			self.recurring.show_due(due)
+			if (get_input("まとめて登録しますか？ (y/n)", required=False) or '').lower() == 'y':
+				created = self.recurring.materialize(now_serial)
+				print(f"定期取引 {len(created)}件を登録しました。")
 		while True:
 			print("\n" + "="*36)
 			print(" 生活管理 DB System")
@@ -1206,6 +5783,8 @@ class LifeManagerApp:
 			print(" [入力]")
 			print(" 1. 取引入力 (買物・収入)")
 			print(" 2. 在庫消費 (料理・食べる)")
+			print(" 2r. レシピ (登録・一括消費)")
+			print(" 2t. 定期取引 (給与・サブスク等)")
 			print(" [一覧]")
 			print(" 3. 直近1ヶ月の取引一覧")
 			print(" 4. 月指定で取引一覧")
@@ -1213,20 +5792,66 @@ class LifeManagerApp:
 			print(" 5. 直近1ヶ月の栄養素 (日別リスト)")
 			print(" 6. 月指定で栄養素 (日別リスト)")
 			print(" 7. 直近1年の栄養素 (月別平均)")
+			print(" 7g. 栄養目標・移動平均")
 			print(" 8. 資産・在庫レポート")
+			print(" 8d. ダッシュボード (純資産・期限・栄養を並列集計)")
+			print(" 8s. 月次明細ファイルの一括出力")
+			print(" 8p. 分析用カラムナ出力 (Parquet / Arrow)")
+			print(" [分析]")
+			print(" 9. 似た食品・代替食品の検索")
+			print(" 10. 献立計画 (期限の近い在庫から)")
+			print(" 11. 支出集計 (月・カテゴリ・ブランド別)")
+			print(" 12. 購入履歴の商品名検索")
+			print(" 15. 食費・廃棄コスト分析")
+			print(" 16. 消費ペース予測・買い物リスト")
+			print(" 19. 価格履歴 (最安店舗・月別推移)")
+			print(" 20. 予算 (設定・今月の状況)")
+			print(" [管理]")
+			print(" 13. バックアップ・同期")
+			print(" 14. 年別アーカイブ")
+			print(" 17. 銀行・カード明細の照合")
+			print(" 18. 通貨イベント (ポイント統合・デノミ) の適用")
+			print(" 21. 未リンク明細の一括リンク")
+			print(" 22. 整合性チェック")
+			print(" 23. 決済ロットの整理 (期限切れ失効・残高行の畳み込み)")
 			print(" q. 終了")
 
 			c = input("選択 > ").strip().lower()
 			if c == '1': self.trans.create_transaction()
 			elif c == '2': self.trans.consume_inventory()
+			elif c == '2r': self.recipes.show_recipe_menu()
 			elif c == '3': self.reporter.show_recent_transactions()
 			elif c == '4': self.reporter.show_monthly_transactions()
 			elif c == '5': self.reporter.show_recent_month_nutrition()
 			elif c == '6': self.reporter.show_monthly_nutrition()
 			elif c == '7': self.reporter.show_yearly_nutrition_report()
+			elif c == '7g': self.reporter.show_nutrition_goals()
 			elif c == '8':
 				self.reporter.show_wallets()
 				self.reporter.show_inventory()
+			elif c == '8d': self.dashboard.show_dashboard()
+			elif c == '8s': self.statements.show_export_menu()
+			elif c == '8p': self.columnar.show_export_menu()
+			elif c == '9': self.similarity.show_similar_foods(self.master)
+			elif c == '10': self.planner.show_meal_plan()
+			elif c == '11': self.trans.cube.show_spending_report()
+			elif c == '12': self.search.show_search()
+			elif c == '13':
+				self.sync.show_sync_menu()
+				self.trans.suggest = ReceiptSuggestIndex(self.db)  # 取り込んだ明細を補完候補に反映
+			elif c == '14': self.archive.show_archive_menu()
+			elif c == '15': self.costs.show_cost_report()
+			elif c == '16': self.forecast.show_forecast()
+			elif c == '17': self.reconciler.show_reconcile_menu()
+			elif c == '18': self.currency_events.show_currency_events()
+			elif c == '19': self.trans.prices.show_price_report(self.master)
+			elif c == '20': self.trans.budget.show_budget_menu()
+			elif c == '21':
+				self.linker.show_linker_menu()
+				self.trans.suggest = ReceiptSuggestIndex(self.db)  # リンクし直した明細を補完候補に反映
+			elif c == '22': self.integrity.show_integrity_menu()
+			elif c == '23': self.lots.show_compaction_menu()
+			elif c == '2t': self.recurring.show_recurring_menu()
 			elif c == 'q':
 				self.db.close()
 				break
@@ -269,7 +269,7 @@ INSERT INTO m_currencies (id, code, name, display_unit, start_at, end_at, succes
 (1, 'JPY', '日本円', '円', NULL, NULL, NULL),
 (2, 'G_PT', 'ゴールドポイント', 'pt', 32599.0, NULL, NULL),
 (3, 'R_PT', '楽天ポイント', 'pt', 37438.0, NULL, NULL),
-(4, 'T_PT', 'Tポイント', 'pt', 37895.0, 45404.0, 5), -- Tポイントは 2024/04/22 00:00:00 (45404.0) に終了
+(4, 'T_PT', 'Tポイント', 'pt', 37895.0, 45404.0, 11), -- Tポイントは 2024/04/22 00:00:00 (45404.0) に終了
 (5, 'N_PT', 'nanacoポイント', 'pt', 39195.0, NULL, NULL),
 (6, 'W_PT', 'WAONポイント', 'pt', 39199.0, NULL, NULL),
 (7, 'A_PT', 'Amazonポイント', 'pt', 39324.0, NULL, NULL), -- 2007/08/30 導入